@@ -1,5 +1,172 @@
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.db import DEFAULT_DB_ALIAS
+
+from . import sharding
 from .models import Address
+from .pagination import EstimatedCountPaginator
+from .search import search_addresses
+from .signals import addresses_changed
+from .utils import address_row, delete_addresses
+
+
+class ShardFilter(admin.SimpleListFilter):
+    """
+    Lists the addresses of one shard at a time, the default database unless another one is picked.
+    """
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(alias, alias) for alias in settings.ADDRESS_BOOK_SHARDS]
+
+    def alias(self):
+        return self.value() if self.value() in settings.ADDRESS_BOOK_SHARDS else DEFAULT_DB_ALIAS
+
+    def choices(self, changelist):
+        # there is no "All", every listing reads a single database
+        for alias, title in self.lookup_choices:
+            yield {
+                'selected': self.alias() == alias,
+                'query_string': changelist.get_query_string({self.parameter_name: alias}),
+                'display': title,
+            }
+
+    def queryset(self, request, queryset):
+        return queryset.using(self.alias())
+
+
+def _attach_users(addresses):
+    # users live on the default database, a lookup through a shard's address finds none
+    field = Address._meta.get_field('user')
+    missing = [address for address in addresses if address.user_id is not None and not field.is_cached(address)]
+    users = User.objects.using(DEFAULT_DB_ALIAS).in_bulk({address.user_id for address in missing})
+    for address in missing:
+        field.set_cached_value(address, users.get(address.user_id))
+
+
+class AddressChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        self.result_list = list(self.result_list)
+        _attach_users(self.result_list)
+
+
+@admin.register(Address)
+class AddressAdmin(admin.ModelAdmin):
+    """
+    Changelist and forms that stay usable on address tables of millions of rows.
+
+    The changelist shows one shard picked with ShardFilter, the views of a
+    single address work on the shard holding it.
+    """
+    list_display = ('id', 'street', 'city', 'postcode', 'country', 'user')
+    list_filter = (ShardFilter,)
+    list_select_related = ('user',)
+    raw_id_fields = ('user',)
+    # enables the search box, get_search_results runs the indexed search instead
+    search_fields = ('street',)
+    ordering = ('-id',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['delete_selected_addresses']
+
+    def get_changelist(self, request, **kwargs):
+        return AddressChangeList
+
+    def get_list_select_related(self, request):
+        # a join on another shard finds its empty auth_user, AddressChangeList loads the users instead
+        if request.GET.get(ShardFilter.parameter_name, DEFAULT_DB_ALIAS) != DEFAULT_DB_ALIAS:
+            return ()
+        return self.list_select_related
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None:
+            _attach_users([obj])
+        return obj
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'user':
+            # the raw id widget and its validation look the user up on the default database
+            kwargs['using'] = DEFAULT_DB_ALIAS
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def get_shard(self, request, object_id=None):
+        # moved address books keep their ids, so the id does not tell the shard
+        if object_id is not None:
+            for alias in settings.ADDRESS_BOOK_SHARDS:
+                try:
+                    if Address.objects.using(alias).filter(pk=object_id).exists():
+                        return alias
+                except (ValueError, ValidationError):
+                    break
+        user_id = request.POST.get('user', '')
+        if user_id.isdigit() and User.objects.filter(pk=user_id).exists():
+            return sharding.shard_for_user(int(user_id))
+        return DEFAULT_DB_ALIAS
+
+    def get_readonly_fields(self, request, obj=None):
+        # an address cannot follow a change of user to another shard
+        return ('user',) if obj is not None else ()
+
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        with sharding.use_shard(self.get_shard(request, object_id)):
+            return super().changeform_view(request, object_id, form_url, extra_context)
+
+    def delete_view(self, request, object_id, extra_context=None):
+        with sharding.use_shard(self.get_shard(request, object_id)):
+            return super().delete_view(request, object_id, extra_context)
+
+    def history_view(self, request, object_id, extra_context=None):
+        with sharding.use_shard(self.get_shard(request, object_id)):
+            return super().history_view(request, object_id, extra_context)
+
+    def get_search_results(self, request, queryset, search_term):
+        return search_addresses(queryset, search_term), False
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        # the stock action deletes row by row and skips addresses_changed
+        actions.pop('delete_selected', None)
+        return actions
+
+    def save_model(self, request, obj, form, change):
+        # the same notifications as the API, so versions, sync and counts follow admin edits
+        old = address_row(Address.objects.get(pk=obj.pk)) if change else None
+        super().save_model(request, obj, form, change)
+        if obj.user_id is None:
+            return
+        if change:
+            addresses_changed.send(sender=Address, updated=[(old, address_row(obj))])
+        else:
+            addresses_changed.send(sender=Address, created=[address_row(obj)])
+
+    def delete_model(self, request, obj):
+        row = address_row(obj)
+        super().delete_model(request, obj)
+        if row['user_id'] is not None:
+            addresses_changed.send(sender=Address, deleted=[row])
+
+    def delete_queryset(self, request, queryset):
+        deleted = 0
+        user_ids = queryset.order_by().values_list('user_id', flat=True).distinct()
+        for user_id in list(user_ids):
+            if user_id is None:
+                # rows without a user are in no address book, there is nothing to notify
+                deleted += queryset.filter(user=None).delete()[0]
+                continue
+            try:
+                with sharding.for_user(user_id, write=True):
+                    deleted += delete_addresses(queryset.filter(user_id=user_id), user_id)
+            except sharding.AddressBookMoving:
+                self.message_user(request, 'Addresses of user %s are being moved, try again shortly.' % user_id, messages.WARNING)
+        return deleted
 
-# Register your models here.
-admin.site.register(Address)
+    @admin.action(description='Delete selected addresses', permissions=['delete'])
+    def delete_selected_addresses(self, request, queryset):
+        deleted = self.delete_queryset(request, queryset)
+        self.message_user(request, 'Deleted %s addresses.' % deleted, messages.SUCCESS)
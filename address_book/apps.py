@@ -0,0 +1,24 @@
+from django.apps import AppConfig
+
+
+class AddressBookConfig(AppConfig):
+    default_auto_field = 'django.db.models.BigAutoField'
+    name = 'address_book'
+
+    def ready(self):
+        from django.contrib.auth.models import User
+        from django.core.signals import request_started
+        from django.db.models.signals import post_migrate, pre_delete
+
+        from . import autocomplete, geo, routers, sharding, stats, sync
+        from .signals import addresses_changed
+
+        request_started.connect(routers.check_connections, dispatch_uid='address_book.routers')
+        post_migrate.connect(sharding.reserve_id_range, sender=self, dispatch_uid='address_book.sharding')
+        pre_delete.connect(stats.forget_user, sender=User, dispatch_uid='address_book.stats')
+        pre_delete.connect(sharding.delete_user_data, sender=User, dispatch_uid='address_book.sharding')
+
+        addresses_changed.connect(autocomplete.update_index, dispatch_uid='address_book.autocomplete')
+        addresses_changed.connect(sync.record_changes, dispatch_uid='address_book.sync')
+        addresses_changed.connect(stats.record_changes, dispatch_uid='address_book.stats')
+        addresses_changed.connect(geo.geocode_changes, dispatch_uid='address_book.geo')
@@ -0,0 +1,17 @@
+"""
+address_book.urls served by async views, used instead of it when
+ADDRESS_BOOK_ASYNC_VIEWS is on (the ASGI deployment, see main/asgi.py).
+
+Address list, retrieve, export and changes are what benefits, the other
+views go through the database pool too so that every query of the process
+is bounded by it and recorded by PerformanceMiddleware.
+"""
+from django.urls import URLPattern
+
+from .async_views import async_view
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    URLPattern(pattern.pattern, async_view(pattern.callback), pattern.default_args, pattern.name)
+    for pattern in sync_urlpatterns
+]
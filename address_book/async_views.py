@@ -0,0 +1,163 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler as DjangoASGIHandler
+from django.db import close_old_connections, connections, transaction
+from django.http import StreamingHttpResponse
+
+from . import metrics, routers
+
+
+class DatabasePool:
+    """
+    Threads running the ORM calls of async views, ADDRESS_BOOK_ASYNC_DB_THREADS of them.
+
+    The pool size bounds the database connections of a process however many
+    clients are connected. Every thread keeps its connections between calls
+    and drops broken or expired ones like a request would. With 0 threads the
+    calls go to Django's single thread sensitive executor instead.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=settings.ADDRESS_BOOK_ASYNC_DB_THREADS, thread_name_prefix='address-book-db'
+                )
+        return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        # the shard, replica and metrics context of the request follows the call into the thread
+        call = functools.partial(_call, func, *args, **kwargs)
+        if not settings.ADDRESS_BOOK_ASYNC_DB_THREADS:
+            # the handler already checks that thread's connections around every request
+            return await sync_to_async(call, thread_sensitive=True)()
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, context.run, _recycling, call)
+
+
+db_pool = DatabasePool()
+
+
+def _call(func, *args, **kwargs):
+    with ExitStack() as stack:
+        stats = metrics.current_request.get()
+        if stats is not None:
+            # query wrappers are per thread, PerformanceMiddleware only installed them on its own
+            for connection in connections.all():
+                if stats.record_query not in connection.execute_wrappers:
+                    stack.enter_context(connection.execute_wrapper(stats.record_query))
+        return func(*args, **kwargs)
+
+
+def _recycling(call):
+    # what request_started and request_finished do for the connections of a request thread,
+    # the signals themselves run on another thread and never see this one's connections
+    close_old_connections()
+    routers.check_connections()
+    try:
+        return call()
+    finally:
+        close_old_connections()
+
+
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    """
+    Streaming response whose chunks are produced on the database pool.
+
+    ASGIHandler below pulls them without blocking the event loop, any other
+    handler iterates them in its own thread as usual.
+    """
+
+    def __init__(self, response):
+        super().__init__(response.streaming_content, status=response.status_code)
+        for header, value in response.items():
+            self[header] = value
+        self.cookies = response.cookies
+        self._resource_closers.append(response.close)
+        self.iterate_async = False
+
+    def __iter__(self):
+        if self.iterate_async:
+            # sent by ASGIHandler.send_response
+            return iter(())
+        return super().__iter__()
+
+    async def chunks(self):
+        iterator = iter(self.streaming_content)
+        done = object()
+        while True:
+            chunk = await db_pool.run(next, iterator, done)
+            if chunk is done:
+                return
+            yield chunk
+
+
+class ASGIHandler(DjangoASGIHandler):
+    """
+    Django's ASGI handler streaming AsyncStreamingHttpResponse bodies from the database pool.
+    """
+
+    async def send_response(self, response, send):
+        if not isinstance(response, AsyncStreamingHttpResponse):
+            return await super().send_response(response, send)
+
+        async def send_chunks(message):
+            # the body goes out right before the closing message of the streaming branch
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                async for part in response.chunks():
+                    for chunk, _ in self.chunk_bytes(part):
+                        await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send(message)
+
+        response.iterate_async = True
+        await super().send_response(response, send_chunks)
+
+
+def _render(view, request, *args, **kwargs):
+    response = view(request, *args, **kwargs)
+    if hasattr(response, 'render') and callable(response.render):
+        response.render()
+    return response
+
+
+def _make_atomic(view):
+    # what Django's handler does for ATOMIC_REQUESTS, done in the pool thread running the view
+    non_atomic_requests = getattr(view, '_non_atomic_requests', set())
+    for connection in connections.all():
+        if connection.settings_dict['ATOMIC_REQUESTS'] and connection.alias not in non_atomic_requests:
+            view = transaction.atomic(using=connection.alias)(view)
+    return view
+
+
+def async_view(view):
+    """
+    Run a sync view on the database pool from an async view.
+
+    The event loop only holds the connection to the client, so slow clients
+    and long streams no longer take up a worker thread each. Views keep the
+    request transactions ATOMIC_REQUESTS gives them, only the ones marked
+    non-atomic, like the address views, go without.
+    """
+    atomic_view = _make_atomic(view)
+
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        response = await db_pool.run(_render, atomic_view, request, *args, **kwargs)
+        if response.streaming:
+            response = AsyncStreamingHttpResponse(response)
+        return response
+    # the handler cannot wrap an async view in a transaction, atomic_view already is
+    wrapper._non_atomic_requests = set(settings.DATABASES)
+    return wrapper
@@ -0,0 +1,276 @@
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.hashers import check_password, make_password
+from django.core.cache import caches
+from django.db import connections, router, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import APIException, AuthenticationFailed
+
+from .utils import LRUCache
+
+
+class TokenCache:
+    """
+    Remembers the (user, token) pair of recently seen token keys.
+
+    Entries live in a per-process LRU with a short TTL, which bounds how long
+    other workers keep accepting a revoked token. With
+    ADDRESS_BOOK_TOKEN_CACHE_ALIAS they live in that Django cache instead, so
+    a token invalidated by one worker is gone for all of them.
+    """
+    key_prefix = 'address_book:token:'
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._local = None
+        self._lock = threading.Lock()
+
+    @property
+    def local(self):
+        if self._local is None:
+            self._local = LRUCache(settings.ADDRESS_BOOK_TOKEN_CACHE_SIZE, settings.ADDRESS_BOOK_TOKEN_CACHE_TTL)
+        return self._local
+
+    @property
+    def shared(self):
+        alias = settings.ADDRESS_BOOK_TOKEN_CACHE_ALIAS
+        return caches[alias] if alias else None
+
+    def get(self, key):
+        if self.shared is not None:
+            value = self.shared.get(self.key_prefix + key)
+        else:
+            value = self.local.get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.shared is not None:
+            self.shared.set(self.key_prefix + key, value, settings.ADDRESS_BOOK_TOKEN_CACHE_TTL)
+        else:
+            self.local.set(key, value)
+
+    def invalidate(self, key):
+        self.invalidate_many([key])
+
+    def invalidate_many(self, keys):
+        if self.shared is not None:
+            self.shared.delete_many([self.key_prefix + key for key in keys])
+        for key in keys:
+            self.local.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        self.hits = self.misses = 0
+
+    def stats(self):
+        size = len(self.local) if self.shared is None else None
+        return {'hits': self.hits, 'misses': self.misses, 'size': size}
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that skips the Token/User query for recently seen keys.
+    """
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is None:
+            cached = super().authenticate_credentials(key)
+            token_cache.set(key, cached)
+        # hand every request its own instances, the cached ones are shared between threads
+        user, token = map(copy.copy, cached)
+
+        now = timezone.now()
+        if token_expired(token, now):
+            token_cache.invalidate(key)
+            Token.objects.filter(key=key, created__lt=expiry_cutoff(now)).delete()
+            raise AuthenticationFailed('Token has expired.')
+        if now - token.created > timedelta(seconds=settings.ADDRESS_BOOK_TOKEN_REFRESH_SECONDS):
+            # sliding expiry, written at most once per refresh period instead of on every request
+            Token.objects.filter(key=key).update(created=now)
+            token.created = now
+            token_cache.set(key, (user, token))
+        return user, token
+
+
+def expiry_cutoff(now=None):
+    """
+    Tokens created or refreshed before the returned time have expired, None when tokens never expire.
+    """
+    if settings.ADDRESS_BOOK_TOKEN_TTL is None:
+        return None
+    return (now or timezone.now()) - timedelta(seconds=settings.ADDRESS_BOOK_TOKEN_TTL)
+
+
+def token_expired(token, now=None):
+    cutoff = expiry_cutoff(now)
+    return cutoff is not None and token.created < cutoff
+
+
+def issue_token(user):
+    """
+    Return the token handed out on login.
+
+    With ADDRESS_BOOK_TOKEN_REUSE a still valid token is kept and refreshed,
+    in a single upsert where the database supports it. Otherwise every login
+    replaces the user's token.
+    """
+    if not settings.ADDRESS_BOOK_TOKEN_REUSE:
+        tokens = Token.objects.filter(user=user)
+        token_cache.invalidate_many(list(tokens.values_list('key', flat=True)))
+        tokens.delete()
+        return Token.objects.create(user=user)
+
+    now = timezone.now()
+    connection = connections[router.db_for_write(Token)]
+    if connection.vendor in ('postgresql', 'sqlite'):
+        token = _upsert_token(connection, user, now)
+    else:
+        with transaction.atomic(using=connection.alias):
+            token, created = Token.objects.select_for_update().get_or_create(user=user)
+            if not created and token_expired(token, now):
+                token.delete()
+                token = Token.objects.create(user=user)
+            elif not created:
+                Token.objects.filter(key=token.key).update(created=now)
+                token.created = now
+    # cached copies still carry the previous expiry
+    token_cache.invalidate(token.key)
+    return token
+
+
+def _upsert_token(connection, user, now):
+    # the new key only replaces an expired one, comparisons see the row as it was
+    cutoff = expiry_cutoff(now)
+    table, key, user_id, created = map(connection.ops.quote_name, (Token._meta.db_table, 'key', 'user_id', 'created'))
+    sql = (
+        'INSERT INTO {table} ({key}, {user_id}, {created}) VALUES (%s, %s, %s) '
+        'ON CONFLICT ({user_id}) DO UPDATE SET '
+        '{key} = CASE WHEN {table}.{created} < %s THEN excluded.{key} ELSE {table}.{key} END, '
+        '{created} = excluded.{created} '
+        'RETURNING {key}'
+    ).format(table=table, key=key, user_id=user_id, created=created)
+    params = [
+        Token.generate_key(), user.pk, connection.ops.adapt_datetimefield_value(now),
+        connection.ops.adapt_datetimefield_value(cutoff),
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        key = cursor.fetchone()[0]
+    token = Token(key=key, user=user, created=now)
+    token._state.adding = False
+    token._state.db = connection.alias
+    return token
+
+
+def sweep_expired_tokens(batch_size=None):
+    """
+    Delete expired tokens ``batch_size`` at a time and return how many were removed.
+    """
+    cutoff = expiry_cutoff()
+    if cutoff is None:
+        return 0
+    batch_size = batch_size or settings.ADDRESS_BOOK_DELETE_BATCH_SIZE
+    query_set = Token.objects.filter(created__lt=cutoff)
+    deleted = 0
+    while True:
+        keys = list(query_set.values_list('key', flat=True)[:batch_size])
+        if not keys:
+            return deleted
+        # a token refreshed since it was selected is left alone
+        deleted += query_set.filter(key__in=keys).delete()[0]
+        # one round trip per batch, through the shared cache every worker reads
+        token_cache.invalidate_many(keys)
+
+
+class PasswordCheckBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many logins in progress, try again shortly.'
+    default_code = 'password_check_busy'
+
+
+class PasswordHashPool:
+    """
+    Runs password hashing on ADDRESS_BOOK_PASSWORD_HASH_WORKERS threads.
+
+    PBKDF2 releases the GIL, so the checks run in parallel while their number
+    stays bounded. Up to ADDRESS_BOOK_PASSWORD_HASH_QUEUE more wait for a
+    worker, requests beyond that get a 503 instead of piling up.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._executor is None:
+                workers = settings.ADDRESS_BOOK_PASSWORD_HASH_WORKERS
+                self._slots = threading.BoundedSemaphore(workers + settings.ADDRESS_BOOK_PASSWORD_HASH_QUEUE)
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='address-book-hash')
+
+    def run(self, func, *args, **kwargs):
+        if not settings.ADDRESS_BOOK_PASSWORD_HASH_WORKERS:
+            return func(*args, **kwargs)
+        if self._executor is None:
+            self._start()
+        if not self._slots.acquire(blocking=False):
+            raise PasswordCheckBusy()
+        try:
+            return self._executor.submit(func, *args, **kwargs).result()
+        finally:
+            self._slots.release()
+
+
+password_pool = PasswordHashPool()
+
+
+def _check_password(password, encoded):
+    # the hash is upgraded by the caller, the pool threads stay away from the database
+    outdated = []
+    return check_password(password, encoded, setter=outdated.append), bool(outdated)
+
+
+class PooledModelBackend(ModelBackend):
+    """
+    ModelBackend verifying passwords on the password hash pool.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # hash anyway so that unknown usernames take as long as known ones
+            password_pool.run(make_password, password)
+            return None
+        valid, outdated = password_pool.run(_check_password, password, user.password)
+        if not valid or not self.user_can_authenticate(user):
+            return None
+        if outdated:
+            user.set_password(password)
+            user.save(update_fields=['password'])
+        return user
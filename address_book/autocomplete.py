@@ -0,0 +1,151 @@
+import functools
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import router, transaction
+from django.db.models import Count
+
+from .caching import get_version
+from .models import Address
+from .utils import LRUCache
+
+AUTOCOMPLETE_FIELDS = ('city', 'country', 'postcode')
+
+
+class PrefixIndex:
+    """
+    Sorted array of distinct values answering prefix lookups with a binary search.
+
+    Values are reference counted so that rows can be added and removed one at
+    a time, and the index stops taking new values once it holds ``max_size``.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.keys = []
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, value, count=1):
+        key = value.casefold()
+        entry = self.entries.get(key)
+        if entry is not None:
+            entry[1] += count
+        elif len(self.keys) < self.max_size:
+            self.entries[key] = [value, count]
+            insort(self.keys, key)
+
+    def remove(self, value, count=1):
+        key = value.casefold()
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        entry[1] -= count
+        if entry[1] <= 0:
+            del self.entries[key]
+            del self.keys[bisect_left(self.keys, key)]
+
+    def complete(self, prefix, limit):
+        prefix = prefix.casefold()
+        results = []
+        position = bisect_left(self.keys, prefix)
+        while position < len(self.keys) and len(results) < limit:
+            key = self.keys[position]
+            if not key.startswith(prefix):
+                break
+            results.append(self.entries[key][0])
+            position += 1
+        return results
+
+
+class AutocompleteIndex:
+    """
+    Per-process prefix indexes of the distinct city, country and postcode
+    values of each user's own addresses.
+
+    A user's indexes are built from their rows on first use and kept for
+    ADDRESS_BOOK_AUTOCOMPLETE_CACHE_SIZE users, tagged with the address book
+    version they reflect. addresses_changed moves them to the next version in
+    place, any other version, like one written by another process, makes the
+    next lookup rebuild them.
+    """
+
+    def __init__(self):
+        self._cache = None
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = LRUCache(settings.ADDRESS_BOOK_AUTOCOMPLETE_CACHE_SIZE, settings.ADDRESS_BOOK_AUTOCOMPLETE_TTL)
+        return self._cache
+
+    def build(self, user_id):
+        indexes = {}
+        for field in AUTOCOMPLETE_FIELDS:
+            index = PrefixIndex(settings.ADDRESS_BOOK_AUTOCOMPLETE_MAX_VALUES)
+            query_set = Address.objects.filter(user_id=user_id).values_list(field).annotate(count=Count('id')).order_by()
+            for value, count in query_set:
+                index.add(value, count)
+            indexes[field] = index
+        return indexes
+
+    def complete(self, user_id, field, prefix, limit=10):
+        version = get_version(user_id)
+        entry = self.cache.get(user_id)
+        if entry is None or entry[0] != version:
+            entry = (version, self.build(user_id))
+            # a write committed during the build may or may not be in it, such indexes are not kept
+            if get_version(user_id) == version:
+                self.cache.set(user_id, entry)
+        with self._lock:
+            return entry[1][field].complete(prefix, limit)
+
+    def apply(self, user_id, created=(), updated=(), deleted=()):
+        if self.cache.get(user_id) is None:
+            return
+        version = get_version(user_id)
+        with self._lock:
+            entry = self.cache.get(user_id)
+            if entry is None:
+                return
+            if entry[0] + 1 != version:
+                # other writes committed in between, rebuild instead of guessing
+                self.cache.delete(user_id)
+                return
+            for field, index in entry[1].items():
+                for row in created:
+                    index.add(row[field])
+                for old, new in updated:
+                    if old[field] != new[field]:
+                        index.remove(old[field])
+                        index.add(new[field])
+                for row in deleted:
+                    index.remove(row[field])
+            self.cache.set(user_id, (version, entry[1]))
+
+    def reset(self):
+        self.cache.clear()
+
+
+autocomplete_index = AutocompleteIndex()
+
+
+def update_index(sender, created=(), updated=(), deleted=(), **kwargs):
+    changes = defaultdict(lambda: ([], [], []))
+    for row in created:
+        changes[row['user_id']][0].append(row)
+    for old, new in updated:
+        changes[new['user_id']][1].append((old, new))
+    for row in deleted:
+        changes[row['user_id']][2].append(row)
+    for user_id, (user_created, user_updated, user_deleted) in changes.items():
+        # only committed rows make it into the index
+        transaction.on_commit(
+            functools.partial(autocomplete_index.apply, user_id, user_created, user_updated, user_deleted),
+            using=router.db_for_write(Address, user_id=user_id)
+        )
@@ -0,0 +1,102 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import router, transaction
+from django.utils.cache import patch_vary_headers
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import AddressBookVersion
+from .utils import LRUCache
+
+
+class ResponseCache:
+    """
+    LRU of rendered-ready response data keyed by user, address book version and request.
+
+    Entries weigh the size of their JSON, so a few large pages cannot hold
+    more than ADDRESS_BOOK_RESPONSE_CACHE_BYTES between them.
+    """
+
+    def __init__(self):
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = LRUCache(settings.ADDRESS_BOOK_RESPONSE_CACHE_BYTES, settings.ADDRESS_BOOK_RESPONSE_CACHE_TTL)
+        return self._cache
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, data):
+        self.cache.set(key, data, size=len(json.dumps(data, cls=JSONEncoder)))
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        return self.cache.stats()
+
+
+response_cache = ResponseCache()
+
+
+def get_version(user_id):
+    version = AddressBookVersion.objects.filter(user_id=user_id).values_list('version', flat=True).first()
+    return version or 0
+
+
+def bump_version(user_id):
+    """
+    Move the user's address book to its next version and return it.
+
+    The version row stays locked until the surrounding transaction ends, so
+    concurrent writers of one address book are serialized.
+    """
+    with transaction.atomic(using=router.db_for_write(AddressBookVersion, user_id=user_id)):
+        book, _ = AddressBookVersion.objects.select_for_update().get_or_create(user_id=user_id)
+        book.version += 1
+        book.save(update_fields=['version'])
+    return book.version
+
+
+class VersionedCacheMixin:
+    """
+    Caches list and retrieve responses per user and address book version,
+    and answers matching If-None-Match requests with 304 before the view runs.
+    """
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        version = get_version(request.user.pk)
+        key = (request.user.pk, version, request.get_full_path(), request.META.get('HTTP_ACCEPT', ''))
+        etag = '"%s"' % hashlib.md5(repr(key).encode()).hexdigest()
+
+        if etag in self.if_none_match(request):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            data = response_cache.get(key)
+            if data is not None:
+                response = Response(data)
+            else:
+                response = handler(request, *args, **kwargs)
+                if response.status_code == status.HTTP_200_OK:
+                    response_cache.set(key, response.data)
+
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        patch_vary_headers(response, ['Authorization'])
+        return response
+
+    def if_none_match(self, request):
+        header = request.META.get('HTTP_IF_NONE_MATCH', '')
+        return {value.strip().replace('W/', '', 1) for value in header.split(',') if value.strip()}
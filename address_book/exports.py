@@ -0,0 +1,57 @@
+import csv
+import io
+import json
+
+from django.conf import settings
+
+from .serializers import ADDRESS_FIELDS
+from .utils import iter_batches
+
+EXPORT_FIELDS = ADDRESS_FIELDS
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def export_addresses(query_set, output, batch_size=None, progress=None):
+    """
+    Yield the addresses of ``query_set`` as chunks of NDJSON or CSV text.
+
+    ``progress`` is called with the number of rows exported so far after every batch.
+    """
+    batch_size = batch_size or settings.ADDRESS_BOOK_EXPORT_BATCH_SIZE
+    batches = iter_batches(query_set, EXPORT_FIELDS, batch_size)
+    if progress is not None:
+        batches = _reporting(batches, progress)
+    if output == 'csv':
+        return _csv_chunks(batches)
+    return _ndjson_chunks(batches)
+
+
+def _reporting(batches, progress):
+    exported = 0
+    for rows in batches:
+        yield rows
+        exported += len(rows)
+        progress(exported)
+
+
+def _ndjson_chunks(batches):
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    for rows in batches:
+        yield ''.join(encoder.encode(dict(zip(EXPORT_FIELDS, row))) + '\n' for row in rows)
+
+
+def _csv_chunks(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
@@ -0,0 +1,31 @@
+"""
+Fake address generation for load-test data, kept free of Django imports so
+that worker processes can run it without setting Django up.
+"""
+from faker import Faker
+
+from .fingerprint import address_fingerprint
+
+# building a Faker is slow, so each process keeps one and reseeds it per unit
+_fake = None
+
+
+def generate_addresses(unit):
+    """
+    Generate ``count`` addresses for a work unit of ``(user_id, seed, count)``.
+
+    The same seed always yields the same rows.
+    """
+    global _fake
+    if _fake is None:
+        _fake = Faker()
+    fake = _fake
+    user_id, seed, count = unit
+    fake.seed_instance(seed)
+    rows = []
+    for _ in range(count):
+        street = fake.street_address()[:100]
+        city = fake.city()[:50]
+        country = fake.country()[:50]
+        rows.append((user_id, street, city, fake.postcode()[:50], country, address_fingerprint(street, city, country)))
+    return rows
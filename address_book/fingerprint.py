@@ -0,0 +1,94 @@
+import hashlib
+import re
+from collections import defaultdict
+from difflib import SequenceMatcher
+
+# Common street suffix abbreviations and the word they stand for
+STREET_ABBREVIATIONS = {
+    'ave': 'avenue',
+    'av': 'avenue',
+    'blvd': 'boulevard',
+    'cl': 'close',
+    'ct': 'court',
+    'cres': 'crescent',
+    'dr': 'drive',
+    'gdns': 'gardens',
+    'gr': 'grove',
+    'hwy': 'highway',
+    'ln': 'lane',
+    'pde': 'parade',
+    'pk': 'park',
+    'pl': 'place',
+    'rd': 'road',
+    'sq': 'square',
+    'st': 'street',
+    'ter': 'terrace',
+    'terr': 'terrace',
+    'ul': 'ulica',
+}
+
+PUNCTUATION = re.compile(r"[^\w\s-]+")
+
+# Largest group of candidates compared pairwise when looking for near-duplicates
+MAX_BLOCK_SIZE = 500
+
+
+def normalize(value):
+    return ' '.join(PUNCTUATION.sub(' ', value.casefold()).split())
+
+
+def normalize_street(value):
+    return ' '.join(STREET_ABBREVIATIONS.get(word, word) for word in normalize(value).split())
+
+
+def address_fingerprint(street, city, country):
+    """
+    Return a signed 64 bit hash identifying an address regardless of case,
+    spacing, punctuation and common street abbreviations.
+    """
+    key = '\x1f'.join((normalize_street(street), normalize(city), normalize(country)))
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def find_near_duplicates(rows, threshold):
+    """
+    Group ``(id, street, city, postcode, country)`` rows that probably describe the same place.
+
+    Candidates sharing a postcode, or a city and house number, are compared by
+    street similarity. Returns lists of ids, one per group.
+    """
+    blocks = defaultdict(list)
+    streets = {}
+    for pk, street, city, postcode, country in rows:
+        street = normalize_street(street)
+        streets[pk] = street
+        country = normalize(country)
+        blocks[('postcode', normalize(postcode).replace(' ', ''), country)].append(pk)
+        number = street.split(' ', 1)[0]
+        if any(char.isdigit() for char in number):
+            blocks[('number', number, normalize(city), country)].append(pk)
+
+    parents = {}
+
+    def find(pk):
+        while parents.get(pk, pk) != pk:
+            pk = parents[pk]
+        return pk
+
+    for members in blocks.values():
+        members = members[:MAX_BLOCK_SIZE]
+        for index, first in enumerate(members):
+            for second in members[index + 1:]:
+                if find(first) == find(second):
+                    continue
+                if SequenceMatcher(None, streets[first], streets[second]).ratio() >= threshold:
+                    parents[find(second)] = find(first)
+
+    groups = defaultdict(list)
+    for pk in parents:
+        groups[find(pk)].append(pk)
+    for root, members in groups.items():
+        if root not in members:
+            members.append(root)
+    return [sorted(members) for members in groups.values()]
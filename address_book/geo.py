@@ -0,0 +1,295 @@
+import csv
+import heapq
+import io
+import math
+import threading
+from array import array
+from collections import defaultdict
+
+from django.conf import settings
+
+from . import sharding
+from .caching import get_version
+from .models import Address
+from .utils import LRUCache
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+
+def normalize_postcode(value):
+    return ''.join(value.split()).upper()
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance between two points given in degrees.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class PostcodeTable:
+    """
+    Postcode to coordinates lookup held in a few flat arrays.
+
+    Normalized postcodes are sorted and packed into one bytes blob with an
+    offsets array next to it, so a country sized dataset takes tens of
+    megabytes instead of a dict of Python objects, and lookups are a binary search.
+    """
+
+    def __init__(self, rows):
+        rows = sorted({normalize_postcode(postcode).encode(): (lat, lon) for postcode, lat, lon in rows if postcode.strip()}.items())
+        self._blob = b''.join(key for key, _ in rows)
+        self._offsets = array('Q', [0])
+        for key, _ in rows:
+            self._offsets.append(self._offsets[-1] + len(key))
+        self._latitudes = array('d', (lat for _, (lat, _) in rows))
+        self._longitudes = array('d', (lon for _, (_, lon) in rows))
+
+    @classmethod
+    def from_csv(cls, stream):
+        """
+        Read a binary CSV stream with postcode, latitude and longitude columns.
+        """
+        reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+        missing = {'postcode', 'latitude', 'longitude'} - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError('Dataset lacks the column(s): %s' % ', '.join(sorted(missing)))
+
+        def rows():
+            for row in reader:
+                try:
+                    yield row['postcode'], float(row['latitude']), float(row['longitude'])
+                except (TypeError, ValueError):
+                    continue
+        return cls(rows())
+
+    def __len__(self):
+        return len(self._latitudes)
+
+    def _key(self, index):
+        return self._blob[self._offsets[index]:self._offsets[index + 1]]
+
+    def get(self, postcode):
+        key = normalize_postcode(postcode).encode()
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self._key(low) == key:
+            return self._latitudes[low], self._longitudes[low]
+        return None
+
+
+class GridIndex:
+    """
+    Points bucketed into square cells of ``cell_size`` degrees.
+
+    A radius query only visits the cells overlapping the circle's bounding
+    box, and a nearest query walks rings of cells outwards until no closer
+    point can be left. Longitudes are not wrapped around the antimeridian.
+    """
+
+    def __init__(self, points, cell_size):
+        self.cell_size = cell_size
+        buckets = defaultdict(list)
+        for pk, lat, lon in points:
+            buckets[self._cell(lat, lon)].append((pk, lat, lon))
+        self.cells = {
+            cell: (array('q', (pk for pk, _, _ in rows)), array('d', (lat for _, lat, _ in rows)), array('d', (lon for _, _, lon in rows)))
+            for cell, rows in buckets.items()
+        }
+        self.size = sum(len(rows) for rows in buckets.values())
+        rows = [row for row, _ in self.cells] or [0]
+        columns = [column for _, column in self.cells] or [0]
+        self.bounds = min(rows), max(rows), min(columns), max(columns)
+        # cells shrink towards the poles, so their size depends on the row only
+        self._half_diagonals = {row: self._half_diagonal(row) for row in set(rows)}
+
+    def __len__(self):
+        return self.size
+
+    def _cell(self, lat, lon):
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def _scan(self, cell, lat, lon):
+        points = self.cells.get(cell)
+        if points is None:
+            return
+        for pk, point_lat, point_lon in zip(*points):
+            yield distance_km(lat, lon, point_lat, point_lon), pk
+
+    def within(self, lat, lon, radius_km, limit=None):
+        """
+        Return ``(distance, id)`` pairs of the points within ``radius_km``, nearest first.
+        """
+        lat_span = radius_km / KM_PER_DEGREE
+        cos_lat = math.cos(math.radians(min(89.9, abs(lat) + lat_span)))
+        lon_span = min(180.0, radius_km / (KM_PER_DEGREE * cos_lat))
+        bottom, left = self._cell(lat - lat_span, lon - lon_span)
+        top, right = self._cell(lat + lat_span, lon + lon_span)
+
+        first_row, last_row, first_column, last_column = self.bounds
+        found = []
+        for row in range(max(bottom, first_row), min(top, last_row) + 1):
+            for column in range(max(left, first_column), min(right, last_column) + 1):
+                found.extend(match for match in self._scan((row, column), lat, lon) if match[0] <= radius_km)
+        found.sort()
+        return found[:limit] if limit else found
+
+    def nearest(self, lat, lon, k):
+        """
+        Return the ``k`` nearest ``(distance, id)`` pairs, nearest first.
+        """
+        if not self.size or k < 1:
+            return []
+        best = []
+
+        def visit(cells):
+            for cell in cells:
+                for distance, pk in self._scan(cell, lat, lon):
+                    if len(best) < k:
+                        heapq.heappush(best, (-distance, pk))
+                    elif distance < -best[0][0]:
+                        heapq.heapreplace(best, (-distance, pk))
+
+        center_row, center_column = self._cell(lat, lon)
+        walked = ring = 0
+        while walked + max(1, 8 * ring) <= len(self.cells):
+            # everything closer than ``ring`` whole cells has been seen
+            if len(best) == k and -best[0][0] <= self._ring_distance(lat, ring - 1):
+                return sorted((-distance, pk) for distance, pk in best)
+            visit(self._ring(center_row, center_column, ring))
+            walked += max(1, 8 * ring)
+            ring += 1
+
+        # far from the points walking rings costs more than sorting the occupied cells left
+        remaining = sorted(
+            (self._cell_distance(cell, lat, lon), cell) for cell in self.cells
+            if max(abs(cell[0] - center_row), abs(cell[1] - center_column)) >= ring
+        )
+        for bound, cell in remaining:
+            if len(best) == k and -best[0][0] <= bound:
+                break
+            visit([cell])
+        return sorted((-distance, pk) for distance, pk in best)
+
+    def _half_diagonal(self, row):
+        center = (row + 0.5) * self.cell_size, 0.5 * self.cell_size
+        return max(distance_km(*center, row * self.cell_size, 0), distance_km(*center, (row + 1) * self.cell_size, 0))
+
+    def _cell_distance(self, cell, lat, lon):
+        # no point of the cell is closer than its center less the half diagonal
+        row, column = cell
+        center = (row + 0.5) * self.cell_size, (column + 0.5) * self.cell_size
+        return max(0.0, distance_km(lat, lon, *center) - self._half_diagonals[row])
+
+    def _ring(self, center_row, center_column, ring):
+        if ring == 0:
+            yield center_row, center_column
+            return
+        for column in range(center_column - ring, center_column + ring + 1):
+            yield center_row - ring, column
+            yield center_row + ring, column
+        for row in range(center_row - ring + 1, center_row + ring):
+            yield row, center_column - ring
+            yield row, center_column + ring
+
+    def _ring_distance(self, lat, ring):
+        # a degree of longitude shrinks towards the poles, take the narrowest one in reach
+        if ring < 1:
+            return 0.0
+        cos_lat = math.cos(math.radians(min(90.0, abs(lat) + (ring + 1) * self.cell_size)))
+        return ring * self.cell_size * KM_PER_DEGREE * cos_lat
+
+
+class GeoIndexCache:
+    """
+    Per-process grid indexes of users' geocoded addresses, keyed by address
+    book version so that every change builds a fresh one on next use.
+    """
+
+    def __init__(self):
+        self._cache = None
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = LRUCache(settings.ADDRESS_BOOK_GEO_INDEX_CACHE_SIZE, settings.ADDRESS_BOOK_GEO_INDEX_TTL)
+        return self._cache
+
+    def get(self, user_id):
+        key = (user_id, get_version(user_id))
+        index = self.cache.get(key)
+        if index is None:
+            points = Address.objects.filter(user_id=user_id, latitude__isnull=False).values_list('id', 'latitude', 'longitude')
+            index = GridIndex(points.iterator(), settings.ADDRESS_BOOK_GEO_CELL_DEGREES)
+            self.cache.set(key, index)
+        return index
+
+    def clear(self):
+        self.cache.clear()
+
+
+geo_index = GeoIndexCache()
+
+
+class Geocoder:
+    """
+    Loads the ADDRESS_BOOK_POSTCODE_DATASET table on first use.
+    """
+
+    def __init__(self):
+        self._path = None
+        self._table = None
+        self._lock = threading.Lock()
+
+    @property
+    def table(self):
+        path = settings.ADDRESS_BOOK_POSTCODE_DATASET
+        if not path:
+            return None
+        with self._lock:
+            if self._path != path:
+                with open(path, 'rb') as stream:
+                    self._table = PostcodeTable.from_csv(stream)
+                self._path = path
+        return self._table
+
+
+geocoder = Geocoder()
+
+
+def geocode_rows(table, rows):
+    """
+    Return Address objects carrying the coordinates of ``(id, postcode)`` rows.
+    """
+    addresses = []
+    for pk, postcode in rows:
+        latitude, longitude = table.get(postcode) or (None, None)
+        addresses.append(Address(pk=pk, latitude=latitude, longitude=longitude))
+    return addresses
+
+
+def geocode_changes(sender, created=(), updated=(), **kwargs):
+    """
+    Store coordinates for new addresses and for addresses whose postcode changed.
+    """
+    table = geocoder.table
+    if table is None:
+        return
+    rows = defaultdict(list)
+    for row in created:
+        rows[row['user_id']].append((row['id'], row['postcode']))
+    for old, new in updated:
+        if old['postcode'] != new['postcode']:
+            rows[new['user_id']].append((new['id'], new['postcode']))
+    for user_id in sorted(rows):
+        with sharding.for_user(user_id):
+            addresses = geocode_rows(table, rows[user_id])
+            Address.objects.bulk_update(addresses, ['latitude', 'longitude'], batch_size=settings.ADDRESS_BOOK_BULK_BATCH_SIZE)
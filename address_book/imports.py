@@ -0,0 +1,74 @@
+import csv
+import io
+import json
+import time
+
+from django.conf import settings
+
+from .models import Address
+from .utils import bulk_insert_addresses
+
+IMPORT_FIELDS = ('street', 'city', 'postcode', 'country')
+IMPORT_FORMATS = ('csv', 'ndjson')
+
+MAX_LENGTHS = {field: Address._meta.get_field(field).max_length for field in IMPORT_FIELDS}
+
+
+def import_addresses(user, stream, input_format, batch_size=None):
+    """
+    Load addresses for ``user`` from a binary CSV or NDJSON stream.
+
+    The stream is parsed row by row and inserted in batches, so only one batch
+    is held in memory. Returns counts of inserted, duplicate and rejected rows.
+    """
+    batch_size = batch_size or settings.ADDRESS_BOOK_IMPORT_BATCH_SIZE
+    started = time.monotonic()
+    stats = {'rows': 0, 'inserted': 0, 'duplicate': 0, 'rejected': 0}
+
+    def valid_rows():
+        for row in _read_rows(stream, input_format):
+            stats['rows'] += 1
+            data = clean_row(row)
+            if data is None:
+                stats['rejected'] += 1
+            else:
+                yield stats['rows'], data
+
+    for _, address in bulk_insert_addresses(user, valid_rows(), batch_size):
+        stats['inserted' if address is not None else 'duplicate'] += 1
+
+    stats['seconds'] = round(time.monotonic() - started, 3)
+    stats['rows_per_second'] = round(stats['rows'] / stats['seconds']) if stats['seconds'] else stats['rows']
+    return stats
+
+
+def clean_row(row):
+    """
+    Return the normalized address fields of a parsed row, or None if it is invalid.
+    """
+    if not isinstance(row, dict):
+        return None
+    data = {}
+    for field in IMPORT_FIELDS:
+        value = row.get(field)
+        if not isinstance(value, str):
+            return None
+        value = ' '.join(value.split())
+        if not value or len(value) > MAX_LENGTHS[field]:
+            return None
+        data[field] = value
+    return data
+
+
+def _read_rows(stream, input_format):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if input_format == 'csv':
+        yield from csv.DictReader(text)
+        return
+    for line in text:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
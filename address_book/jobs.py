@@ -0,0 +1,137 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from . import exports, sharding
+from .models import Address, Job
+from .search import search_addresses
+from .utils import delete_addresses
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+_executor = None
+
+
+def register(kind):
+    """
+    Register a function as the handler for jobs of the given kind.
+    """
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+
+def submit(user, kind, **params):
+    """
+    Queue a job for ``user`` and return it; it starts once the current transaction commits.
+
+    With the "worker" backend the job waits in the table until run_job_worker picks it up.
+    """
+    if kind not in _handlers:
+        raise ValueError('Unknown job kind: %s' % kind)
+    job = Job.objects.create(user=user, kind=kind, params=params)
+    if settings.ADDRESS_BOOK_JOBS_EAGER:
+        run(job.pk)
+        job.refresh_from_db()
+    elif settings.ADDRESS_BOOK_JOBS_BACKEND == 'threads':
+        transaction.on_commit(lambda: _get_executor().submit(run_and_close, job.pk), using=router.db_for_write(Address, user_id=user.pk))
+    return job
+
+
+def claim(job_id):
+    # a conditional UPDATE lets exactly one of several workers take the job
+    now = timezone.now()
+    return Job.objects.filter(pk=job_id, status=Job.QUEUED).update(status=Job.RUNNING, started=now, updated=now) == 1
+
+
+def run(job_id):
+    """
+    Run a queued job and return it, or None when another worker took it first.
+    """
+    if not claim(job_id):
+        return None
+    job = Job.objects.get(pk=job_id)
+    try:
+        with sharding.for_user(job.user_id, write=True):
+            result = _handlers[job.kind](job, **job.params)
+    except Exception as exc:
+        logger.exception('Job %s failed', job.pk)
+        job.status = Job.FAILED
+        job.result = {'error': str(exc)}
+    else:
+        job.status = Job.DONE
+        job.result = result
+    job.finished = timezone.now()
+    job.save(update_fields=['status', 'result', 'finished', 'updated'])
+    return job
+
+
+def run_and_close(job_id):
+    try:
+        run(job_id)
+    finally:
+        connections.close_all()
+
+
+def next_jobs(limit, exclude=()):
+    """
+    Return the ids of up to ``limit`` queued jobs, oldest first.
+
+    Stale running jobs are queued again first, so a job whose worker died is
+    picked up by the next look at the queue.
+    """
+    requeue_stale()
+    query_set = Job.objects.filter(status=Job.QUEUED).exclude(pk__in=list(exclude)).order_by('pk')
+    return list(query_set.values_list('pk', flat=True)[:limit])
+
+
+def requeue_stale():
+    """
+    Put back running jobs whose worker stopped reporting and return how many there were.
+    """
+    stale = timezone.now() - timedelta(seconds=settings.ADDRESS_BOOK_JOBS_STALE_SECONDS)
+    requeued = Job.objects.filter(status=Job.RUNNING, updated__lt=stale).update(status=Job.QUEUED, started=None)
+    if requeued:
+        logger.warning('Requeued %s stale jobs', requeued)
+    return requeued
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.ADDRESS_BOOK_JOBS_THREADS, thread_name_prefix='address-book-job')
+    return _executor
+
+
+@register('purge_addresses')
+def purge_addresses(job, ids=None, version=None):
+    query_set = Address.objects.filter(user=job.user)
+    if ids:
+        query_set = query_set.filter(pk__in=ids)
+    if version is not None:
+        # rows created or changed after the purge was asked for carry a later version
+        query_set = query_set.filter(change_version__lte=version)
+    job.report(0, query_set.count())
+    return {'deleted': delete_addresses(query_set, job.user_id, progress=job.report)}
+
+
+@register('export_addresses')
+def export_addresses(job, output='ndjson', filters=None, q=None):
+    query_set = Address.objects.filter(user=job.user, **(filters or {}))
+    if q:
+        query_set = search_addresses(query_set, q)
+    job.report(0, query_set.count())
+
+    os.makedirs(settings.ADDRESS_BOOK_EXPORT_DIR, exist_ok=True)
+    path = os.path.join(settings.ADDRESS_BOOK_EXPORT_DIR, 'job-%s.%s' % (job.pk, output))
+    with open(path, 'w', encoding='utf-8', newline='') as stream:
+        for chunk in exports.export_addresses(query_set, output, progress=job.report):
+            stream.write(chunk)
+    return {'file': os.path.basename(path), 'content_type': exports.CONTENT_TYPES[output], 'exported': job.processed}
@@ -0,0 +1,173 @@
+import json
+import math
+import random
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.test.utils import (
+	CaptureQueriesContext, setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+)
+from rest_framework.test import APIClient
+from address_book.caching import bump_version, response_cache
+from address_book.fake import generate_addresses
+from address_book.models import Address
+from address_book.sharding import write_transaction
+
+USERNAME = 'benchmark'
+PASSWORD = 'benchmark-password'
+
+
+class Command(BaseCommand):
+	help = 'Benchmark the API against a throwaway database seeded at several sizes and print the results as JSON'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--sizes', default='1000,100000', help='comma separated address book sizes, e.g. 1000,100000,1000000')
+		parser.add_argument('--requests', type=int, default=30, help='requests per scenario')
+		parser.add_argument('--seed', type=int, default=42)
+		parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+		parser.add_argument('--keepdb', action='store_true', help='reuse the benchmark database between runs')
+
+	def handle(self, *args, **options):
+		try:
+			sizes = sorted(int(size) for size in options['sizes'].split(','))
+		except ValueError:
+			raise CommandError('--sizes must be a comma separated list of numbers')
+		if options['requests'] < 1:
+			raise CommandError('--requests must be positive')
+
+		setup_test_environment()
+		# every shard gets its throwaway database, the benchmark user lives on one of them
+		old_config = setup_databases(verbosity=0, interactive=False, keepdb=options['keepdb'])
+		try:
+			report = self.run(sizes, options['requests'], options['seed'])
+		finally:
+			teardown_databases(old_config, verbosity=0, keepdb=options['keepdb'])
+			teardown_test_environment()
+
+		output = json.dumps(report, indent=2, sort_keys=True)
+		if options['output']:
+			with open(options['output'], 'w') as report_file:
+				report_file.write(output + '\n')
+		else:
+			self.stdout.write(output)
+
+	def run(self, sizes, requests, seed):
+		self.random = random.Random(seed)
+		self.user, _ = User.objects.get_or_create(username=USERNAME)
+		self.user.set_password(PASSWORD)
+		self.user.save()
+
+		report = {
+			'database': connection.vendor, 'shards': len(settings.ADDRESS_BOOK_SHARDS), 'requests': requests, 'seed': seed, 'sizes': {}
+		}
+		for size in sizes:
+			self.seed_addresses(size, seed)
+			self.stderr.write('Benchmarking %s addresses' % size)
+			report['sizes'][str(size)] = self.run_scenarios(requests)
+		return report
+
+	def seed_addresses(self, size, seed):
+		existing = self.user.addresses.count()
+		batch = 5000
+		for start in range(existing, size, batch):
+			rows = generate_addresses((self.user.pk, '%s-%s' % (seed, start), min(batch, size - start)))
+			with write_transaction(self.user.pk) as alias:
+				# stamped with a new version like API writes, so cached responses and sync see them
+				version = bump_version(self.user.pk)
+				Address.objects.using(alias).bulk_create([
+					Address(
+						user_id=user_id, street=street, city=city, postcode=postcode, country=country,
+						fingerprint=fingerprint, change_version=version
+					)
+					for user_id, street, city, postcode, country, fingerprint in rows
+				], ignore_conflicts=True)
+
+	def run_scenarios(self, requests):
+		client = APIClient()
+		ids = list(self.user.addresses.values_list('pk', flat=True))
+		city = self.user.addresses.values_list('city', flat=True).first()
+		last_page = max(1, math.ceil(len(ids) / 10))
+		results = {}
+
+		results['login'] = self.measure(requests, lambda _: self.login(client))
+		self.login(client)
+		self.measure_reads(results, 'list_first_page', requests, lambda _: client.get('/api/addresses'))
+		self.measure_reads(results, 'list_deep_page', requests, lambda _: client.get('/api/addresses?page=%s' % last_page))
+		self.measure_reads(results, 'list_cursor', requests, lambda _: client.get('/api/addresses?pagination=cursor'))
+		self.measure_reads(results, 'filter', requests, lambda _: client.get('/api/addresses', {'city': city}))
+		picks = [self.random.choice(ids) for _ in range(requests)]
+		self.measure_reads(results, 'retrieve', requests, lambda index: client.get('/api/addresses/%s' % picks[index]))
+
+		created = []
+
+		def create(index):
+			response = client.post('/api/addresses', {
+				'street': 'Benchmark street %s' % self.random.getrandbits(64),
+				'city': 'Benchmark',
+				'postcode': 'B%s' % index,
+				'country': 'Benchmark'
+			}, format='json')
+			created.append(response.data.get('id'))
+			return response
+
+		results['create'] = self.measure(requests, create)
+
+		def delete_multiple(index):
+			pair = created[index * 2 % len(created):][:2]
+			return client.delete('/api/addresses/delete_multiple?ids=%s' % ','.join(str(pk) for pk in pair))
+
+		results['delete_multiple'] = self.measure(requests, delete_multiple)
+
+		results['logout'] = self.measure(requests, lambda _: client.post('/api/auth/logout'), prepare=lambda _: self.login(client))
+		return results
+
+	def login(self, client):
+		client.credentials()
+		response = client.post('/api/auth/login', {'username': USERNAME, 'password': PASSWORD}, format='json')
+		client.credentials(HTTP_AUTHORIZATION='Token ' + response.data['auth_token'])
+		return response
+
+	def measure_reads(self, results, name, requests, call):
+		# <name> misses the response cache on every request, <name>_cached repeats an already answered one
+		results[name] = self.measure(requests, call, prepare=lambda _: response_cache.clear())
+		results[name + '_cached'] = self.measure(requests, call, prepare=call)
+
+	def measure(self, requests, call, prepare=None):
+		timings = []
+		queries = []
+		statuses = Counter()
+		for index in range(requests):
+			if prepare is not None:
+				prepare(index)
+			with ExitStack() as stack:
+				contexts = [stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in settings.ADDRESS_BOOK_SHARDS]
+				begin = time.perf_counter()
+				response = call(index)
+				timings.append(time.perf_counter() - begin)
+			queries.append(sum(len(context.captured_queries) for context in contexts))
+			statuses[response.status_code] += 1
+		elapsed = sum(timings)
+		timings.sort()
+		result = {
+			'p50_ms': percentile(timings, 50) * 1000,
+			'p95_ms': percentile(timings, 95) * 1000,
+			'p99_ms': percentile(timings, 99) * 1000,
+			'mean_ms': sum(timings) / len(timings) * 1000,
+			'throughput_rps': requests / elapsed,
+			'queries_per_request': sum(queries) / len(queries),
+			'status_codes': {str(code): count for code, count in sorted(statuses.items())},
+		}
+		return {key: round(value, 3) if isinstance(value, float) else value for key, value in result.items()}
+
+
+def percentile(values, percent):
+	"""
+	Nearest-rank percentile of an already sorted list.
+	"""
+	rank = max(1, math.ceil(percent / 100 * len(values)))
+	return values[rank - 1]
@@ -0,0 +1,38 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+	help = 'Write the OpenAPI schema to ADDRESS_BOOK_SCHEMA_FILE, served as is at /openapi.json'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--output', default=None, help='defaults to ADDRESS_BOOK_SCHEMA_FILE')
+		parser.add_argument('--pretty', action='store_true', help='indent the JSON for reading')
+
+	def handle(self, *args, **options):
+		try:
+			from drf_yasg.app_settings import swagger_settings
+			from drf_yasg.codecs import OpenAPICodecJson
+			from drf_yasg.generators import OpenAPISchemaGenerator
+		except ImportError:
+			raise CommandError('drf_yasg is needed to build the schema, run with the development settings')
+
+		generator = OpenAPISchemaGenerator(info=swagger_settings.DEFAULT_INFO)
+		schema = generator.get_schema(request=None, public=True)
+		content = OpenAPICodecJson(validators=[], pretty=options['pretty']).encode(schema)
+
+		path = str(options['output'] or settings.ADDRESS_BOOK_SCHEMA_FILE)
+		# replace the file in one step so that it is never served half written
+		descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+		try:
+			with os.fdopen(descriptor, 'wb') as stream:
+				stream.write(content)
+			os.chmod(temporary, 0o644)
+			os.replace(temporary, path)
+		except BaseException:
+			os.unlink(temporary)
+			raise
+		self.stdout.write('Wrote %s paths to %s (%s bytes)' % (len(schema['paths']), path, len(content)))
@@ -1,27 +1,78 @@
-from django.core.management.base import BaseCommand
+import os
+import random
+import time
+from multiprocessing import Pool
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
+from address_book.caching import bump_version
+from address_book.fake import generate_addresses
+from address_book.sharding import write_transaction
 from address_book.models import Address
-from faker import Faker
-import random
 
 
 class Command(BaseCommand):
+	help = 'Fill the address books of existing or newly created users with fake addresses'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--users', type=int, default=None, help='create this many fake users instead of using the existing ones')
+		parser.add_argument('--per-user', type=int, default=100)
+		parser.add_argument('--seed', type=int, default=None, help='reuse a seed to regenerate the same data')
+		parser.add_argument('--batch-size', type=int, default=1000)
+		parser.add_argument('--workers', type=int, default=os.cpu_count())
 
 	def handle(self, *args, **options):
-		breakpoint()
-		fake = Faker()
-		for user in User.objects.all():
-			for _ in range(0, 100):
-				fake.seed_instance(random.randint(0, 99999))
-				try:
-					data = {
-						"user": user,
-						"street": fake.street_address(),
-						"city": fake.city(),
-						"postcode": fake.postcode(),
-						"country": fake.country()
-					}
-					Address.objects.create(**data)
-				except Exception:
+		seed = options['seed'] if options['seed'] is not None else random.randint(0, 99999)
+		batch_size = options['batch_size']
+		if options['per_user'] < 0 or batch_size < 1 or options['workers'] < 1:
+			raise CommandError('--per-user, --batch-size and --workers must be positive')
+
+		if options['users'] is None:
+			user_ids = list(User.objects.order_by('pk').values_list('pk', flat=True))
+		else:
+			user_ids = self.create_users(options['users'], seed)
+
+		# every unit carries its own seed so the output does not depend on the worker count
+		units = []
+		for index, user_id in enumerate(user_ids):
+			for start in range(0, options['per_user'], batch_size):
+				count = min(batch_size, options['per_user'] - start)
+				units.append((user_id, '%s-%s-%s' % (seed, index, start), count))
+
+		self.stdout.write('Generating %s addresses for %s users with seed %s' % (options['per_user'] * len(user_ids), len(user_ids), seed))
+		started = time.monotonic()
+		generated = 0
+		with Pool(options['workers']) as pool:
+			for (user_id, _, _), rows in zip(units, pool.imap(generate_addresses, units)):
+				with write_transaction(user_id) as alias:
+					# a new address book version, so sync clients and cached responses see the rows
+					version = bump_version(user_id)
+					addresses = [
+						Address(
+							user_id=user_id, street=street, city=city, postcode=postcode, country=country,
+							fingerprint=fingerprint, change_version=version
+						)
+						for user_id, street, city, postcode, country, fingerprint in rows
+					]
 					# there is a very slim chance we would trigger constrain, but still...
-					pass
+					Address.objects.using(alias).bulk_create(addresses, batch_size=batch_size, ignore_conflicts=True)
+				generated += len(addresses)
+				if options['verbosity'] > 1:
+					self.stdout.write('%s addresses' % generated)
+
+		elapsed = time.monotonic() - started
+		self.stdout.write('Generated %s addresses in %.1fs (%d/s)' % (generated, elapsed, generated / elapsed if elapsed else generated))
+		# the rows were inserted without addresses_changed, the counts are recomputed in one go
+		call_command('rebuild_address_stats', stdout=self.stdout)
+
+	def create_users(self, count, seed):
+		usernames = ['fake_%s_%s' % (seed, index) for index in range(count)]
+		existing = set(User.objects.filter(username__in=usernames).values_list('username', flat=True))
+		password = make_password(None)
+		User.objects.bulk_create(
+			[User(username=username, password=password) for username in usernames if username not in existing],
+			batch_size=1000
+		)
+		return list(User.objects.filter(username__in=usernames).order_by('pk').values_list('pk', flat=True))
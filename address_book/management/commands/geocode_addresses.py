@@ -0,0 +1,49 @@
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from address_book.caching import bump_version
+from address_book.geo import PostcodeTable, geocode_rows
+from address_book.models import Address
+from address_book.sharding import use_shard
+from address_book.utils import iter_batches
+
+
+class Command(BaseCommand):
+	help = 'Store the coordinates of every address looked up by postcode in a local CSV dataset'
+
+	def add_arguments(self, parser):
+		parser.add_argument('path', help='CSV file with postcode, latitude and longitude columns')
+		parser.add_argument('--missing-only', action='store_true', help='skip addresses that already have coordinates')
+		parser.add_argument('--batch-size', type=int, default=None)
+
+	def handle(self, *args, **options):
+		batch_size = options['batch_size'] or settings.ADDRESS_BOOK_BULK_BATCH_SIZE
+		started = time.monotonic()
+		try:
+			with open(options['path'], 'rb') as stream:
+				table = PostcodeTable.from_csv(stream)
+		except (OSError, ValueError) as exc:
+			raise CommandError(str(exc))
+		self.stdout.write('Loaded %s postcodes in %.1fs' % (len(table), time.monotonic() - started))
+
+		stats = {'addresses': 0, 'geocoded': 0}
+		for alias in settings.ADDRESS_BOOK_SHARDS:
+			with use_shard(alias):
+				query_set = Address.objects.all()
+				if options['missing_only']:
+					query_set = query_set.filter(latitude__isnull=True)
+				users = set()
+				for batch in iter_batches(query_set, ('id', 'user_id', 'postcode'), batch_size):
+					addresses = geocode_rows(table, [(pk, postcode) for pk, _, postcode in batch])
+					Address.objects.bulk_update(addresses, ['latitude', 'longitude'])
+					users.update(user_id for _, user_id, _ in batch if user_id is not None)
+					stats['addresses'] += len(addresses)
+					stats['geocoded'] += sum(address.latitude is not None for address in addresses)
+				# drop cached proximity indexes built from the old coordinates
+				for user_id in sorted(users):
+					bump_version(user_id)
+
+		stats['seconds'] = round(time.monotonic() - started, 3)
+		self.stdout.write(json.dumps(stats))
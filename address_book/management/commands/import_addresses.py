@@ -0,0 +1,34 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from address_book.imports import IMPORT_FORMATS, import_addresses
+from address_book.sharding import AddressBookMoving, for_user
+
+
+class Command(BaseCommand):
+	help = 'Stream a CSV or NDJSON file of addresses into a user\'s address book'
+
+	def add_arguments(self, parser):
+		parser.add_argument('username')
+		parser.add_argument('path')
+		parser.add_argument('--format', dest='input_format', choices=IMPORT_FORMATS, help='defaults to the file extension')
+		parser.add_argument('--batch-size', type=int, default=None)
+
+	def handle(self, *args, **options):
+		try:
+			user = User.objects.get(username=options['username'])
+		except User.DoesNotExist:
+			raise CommandError('User "%s" does not exist' % options['username'])
+
+		input_format = options['input_format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+		if input_format not in IMPORT_FORMATS:
+			raise CommandError('Unsupported format "%s", use --format' % input_format)
+
+		try:
+			with for_user(user.pk, write=True), open(options['path'], 'rb') as stream:
+				stats = import_addresses(user, stream, input_format, options['batch_size'])
+		except AddressBookMoving as exc:
+			raise CommandError(str(exc))
+		self.stdout.write(json.dumps(stats))
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import ssl
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+from .benchmark_api import percentile
+
+
+class Command(BaseCommand):
+	help = 'Hold many concurrent clients against a running server and print latency and throughput as JSON'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--url', default='http://127.0.0.1:8000', help='server to load, e.g. a runserver/WSGI or an ASGI deployment')
+		parser.add_argument('--username', required=True)
+		parser.add_argument('--password', required=True)
+		parser.add_argument('--path', default='/api/addresses', help='endpoint every client requests')
+		parser.add_argument('--concurrency', type=int, default=100, help='clients running at the same time')
+		parser.add_argument('--duration', type=float, default=10, help='seconds to keep the clients going')
+		parser.add_argument('--read-delay', type=float, default=0, help='slow clients: seconds to wait between reads of --read-size bytes')
+		parser.add_argument('--read-size', type=int, default=4096)
+		parser.add_argument('--timeout', type=float, default=30, help='seconds before a request counts as timed out')
+		parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+
+	def handle(self, *args, **options):
+		url = urlsplit(options['url'])
+		if url.scheme not in ('http', 'https') or not url.hostname:
+			raise CommandError('--url must be an http(s) URL')
+		if options['concurrency'] < 1 or options['duration'] <= 0:
+			raise CommandError('--concurrency and --duration must be positive')
+		self.host = url.hostname
+		self.port = url.port or (443 if url.scheme == 'https' else 80)
+		self.ssl = ssl.create_default_context() if url.scheme == 'https' else None
+		self.options = options
+
+		report = asyncio.run(self.run())
+		output = json.dumps(report, indent=2, sort_keys=True)
+		if options['output']:
+			with open(options['output'], 'w') as report_file:
+				report_file.write(output + '\n')
+		else:
+			self.stdout.write(output)
+
+	async def run(self):
+		options = self.options
+		body = json.dumps({'username': options['username'], 'password': options['password']}).encode()
+		status, _, content = await self.request('POST', '/api/auth/login', body=body)
+		if status != 200:
+			raise CommandError('Login failed with %s: %s' % (status, content[:200]))
+		self.token = json.loads(content)['auth_token']
+
+		self.results = []
+		self.in_flight = self.peak_in_flight = 0
+		started = time.perf_counter()
+		deadline = started + options['duration']
+		await asyncio.gather(*(self.client(deadline) for _ in range(options['concurrency'])))
+		elapsed = time.perf_counter() - started
+
+		ok = sorted(total for status, first_byte, total in self.results if status == 200)
+		first_bytes = sorted(first_byte for status, first_byte, total in self.results if first_byte is not None)
+		statuses = {}
+		for status, _, _ in self.results:
+			statuses[str(status)] = statuses.get(str(status), 0) + 1
+		result = {
+			'url': options['url'] + options['path'],
+			'concurrency': options['concurrency'],
+			'read_delay': options['read_delay'],
+			'requests': len(self.results),
+			'status_codes': statuses,
+			'throughput_rps': len(ok) / elapsed,
+			# clients actually being answered at once, a worker per request caps this at the worker count
+			'peak_in_flight': self.peak_in_flight,
+		}
+		if ok:
+			result.update({'p50_ms': percentile(ok, 50) * 1000, 'p95_ms': percentile(ok, 95) * 1000, 'p99_ms': percentile(ok, 99) * 1000})
+		if first_bytes:
+			result.update({'first_byte_p50_ms': percentile(first_bytes, 50) * 1000, 'first_byte_p99_ms': percentile(first_bytes, 99) * 1000})
+		return {key: round(value, 3) if isinstance(value, float) else value for key, value in result.items()}
+
+	async def client(self, deadline):
+		headers = {'Authorization': 'Token ' + self.token}
+		while time.perf_counter() < deadline:
+			begin = time.perf_counter()
+			try:
+				status, first_byte, _ = await asyncio.wait_for(
+					self.request('GET', self.options['path'], headers=headers, slow=True), self.options['timeout']
+				)
+			except asyncio.TimeoutError:
+				self.results.append(('timeout', None, None))
+				continue
+			except OSError as exc:
+				self.results.append((type(exc).__name__, None, None))
+				continue
+			self.results.append((status, first_byte - begin, time.perf_counter() - begin))
+
+	async def request(self, method, path, headers=None, body=b'', slow=False):
+		reader, writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+		try:
+			lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % self.host, 'Connection: close', 'Content-Length: %s' % len(body)]
+			if body:
+				lines.append('Content-Type: application/json')
+			lines.extend('%s: %s' % item for item in (headers or {}).items())
+			writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin1') + body)
+			await writer.drain()
+
+			status_line = await reader.readline()
+			first_byte = time.perf_counter()
+			if slow:
+				self.in_flight += 1
+				self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+			try:
+				status = int(status_line.split()[1])
+				response_headers = {}
+				while True:
+					line = await reader.readline()
+					if line in (b'\r\n', b'\n', b''):
+						break
+					name, _, value = line.decode('latin1').partition(':')
+					response_headers[name.strip().lower()] = value.strip()
+				content = []
+				while True:
+					chunk = await reader.read(self.options['read_size'])
+					if not chunk:
+						break
+					content.append(chunk)
+					if slow and self.options['read_delay']:
+						await asyncio.sleep(self.options['read_delay'])
+			finally:
+				if slow:
+					self.in_flight -= 1
+			content = b''.join(content)
+			if response_headers.get('transfer-encoding') == 'chunked':
+				content = dechunk(content)
+			return status, first_byte, content
+		finally:
+			writer.close()
+
+
+def dechunk(content):
+	body = []
+	while content:
+		size, _, content = content.partition(b'\r\n')
+		size = int(size.split(b';')[0], 16)
+		if not size:
+			break
+		body.append(content[:size])
+		content = content[size + 2:]
+	return b''.join(body)
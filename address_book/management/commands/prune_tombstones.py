@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from address_book.sync import prune_tombstones
+
+
+class Command(BaseCommand):
+	help = 'Delete tombstones of deleted addresses older than ADDRESS_BOOK_TOMBSTONE_RETENTION, once or every --every seconds'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--retention', type=float, default=None, help='seconds to keep tombstones for, defaults to ADDRESS_BOOK_TOMBSTONE_RETENTION')
+		parser.add_argument('--every', type=float, default=None, help='keep running and prune every this many seconds')
+
+	def handle(self, *args, **options):
+		if options['every'] is not None and options['every'] <= 0:
+			raise CommandError('--every must be positive')
+		if options['retention'] is not None and options['retention'] < 0:
+			raise CommandError('--retention must not be negative')
+		while True:
+			deleted = prune_tombstones(options['retention'])
+			if deleted or options['every'] is None:
+				self.stdout.write('Deleted %s tombstones' % deleted)
+			if options['every'] is None:
+				return
+			time.sleep(options['every'])
@@ -0,0 +1,52 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from address_book.models import Address, ShardPlacement
+from address_book.sharding import move_user, shard_map
+
+
+class Command(BaseCommand):
+	help = 'Move address books to the shard the hash ring assigns them, one user at a time'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--dry-run', action='store_true', help='only list the moves, placements of existing address books are still recorded')
+		parser.add_argument('--batch-size', type=int, default=None)
+		parser.add_argument('--grace', type=float, default=None, help='seconds to wait for requests using the old placement, defaults to ADDRESS_BOOK_SHARD_CACHE_TTL')
+
+	def handle(self, *args, **options):
+		if options['grace'] is not None and options['grace'] < 0:
+			raise CommandError('--grace must not be negative')
+
+		adopted = self.adopt()
+		if adopted:
+			self.stdout.write('Recorded the placement of %s existing address books' % adopted)
+
+		ring = shard_map.ring
+		moves = [
+			(placement.user_id, placement.alias, ring.get(placement.user_id))
+			for placement in ShardPlacement.objects.order_by('pk').iterator()
+			if placement.moving or placement.alias != ring.get(placement.user_id)
+		]
+		self.stdout.write('%s address books to move' % len(moves))
+
+		for user_id, source, target in moves:
+			if options['dry_run']:
+				self.stdout.write('user %s: %s -> %s' % (user_id, source, target))
+				continue
+			started = time.monotonic()
+			move_user(user_id, target, options['batch_size'], options['grace'])
+			self.stdout.write('user %s: %s -> %s in %.1fs' % (user_id, source, target, time.monotonic() - started))
+
+	def adopt(self):
+		# address books written before a placement was recorded stay where they are
+		placed = set(ShardPlacement.objects.values_list('user_id', flat=True))
+		adopted = []
+		for alias in settings.ADDRESS_BOOK_SHARDS:
+			user_ids = Address.objects.using(alias).exclude(user_id=None).values_list('user_id', flat=True).distinct()
+			for user_id in user_ids:
+				if user_id not in placed:
+					placed.add(user_id)
+					adopted.append(ShardPlacement(user_id=user_id, alias=alias))
+		ShardPlacement.objects.bulk_create(adopted, batch_size=1000, ignore_conflicts=True)
+		return len(adopted)
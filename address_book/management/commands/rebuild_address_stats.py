@@ -0,0 +1,23 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from address_book.stats import rebuild_counts
+
+
+class Command(BaseCommand):
+	help = 'Recompute the address counts per country and city from the address tables'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--database', action='append', dest='databases', help='shard to rebuild, defaults to all of them')
+
+	def handle(self, *args, **options):
+		databases = options['databases'] or settings.ADDRESS_BOOK_SHARDS
+		unknown = set(databases) - set(settings.ADDRESS_BOOK_SHARDS)
+		if unknown:
+			raise CommandError('Not a shard: %s' % ', '.join(sorted(unknown)))
+
+		for alias in databases:
+			started = time.monotonic()
+			count = rebuild_counts(alias)
+			self.stdout.write('%s: %s counts in %.1fs' % (alias, count, time.monotonic() - started))
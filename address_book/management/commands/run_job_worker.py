@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+import signal
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from address_book import jobs
+
+
+class Command(BaseCommand):
+	help = 'Run queued address book jobs in a pool of worker processes until stopped'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--processes', type=int, default=os.cpu_count(), help='0 runs the jobs in this process, handy for debugging')
+		parser.add_argument('--poll', type=float, default=1.0, help='seconds between looks at an empty queue')
+		parser.add_argument('--once', action='store_true', help='exit once the queue is empty')
+
+	def handle(self, *args, **options):
+		if options['processes'] < 0 or options['poll'] <= 0:
+			raise CommandError('--processes must not be negative and --poll must be positive')
+		self.stopping = False
+		signal.signal(signal.SIGTERM, self.stop)
+		signal.signal(signal.SIGINT, self.stop)
+
+		if options['processes'] == 0:
+			self.run_inline(options)
+		else:
+			self.run_pool(options)
+
+	def stop(self, signum, frame):
+		# let the running jobs finish, take no new ones
+		self.stopping = True
+
+	def run_inline(self, options):
+		while not self.stopping:
+			ids = jobs.next_jobs(1)
+			if ids:
+				job = jobs.run(ids[0])
+				if job is not None and options['verbosity'] > 1:
+					self.stdout.write('%s finished' % job)
+			elif options['once']:
+				return
+			else:
+				time.sleep(options['poll'])
+
+	def run_pool(self, options):
+		processes = options['processes']
+		# spawned children set up Django themselves instead of sharing this process' connections
+		context = multiprocessing.get_context('spawn')
+		connections.close_all()
+		with ProcessPoolExecutor(processes, mp_context=context, initializer=django.setup) as pool:
+			running = {}
+			while not self.stopping:
+				ids = jobs.next_jobs(processes - len(running), exclude=running.values())
+				for job_id in ids:
+					running[pool.submit(jobs.run_and_close, job_id)] = job_id
+				if not running:
+					if options['once']:
+						return
+					time.sleep(options['poll'])
+					continue
+				done, _ = wait(running, timeout=options['poll'], return_when=FIRST_COMPLETED)
+				for future in done:
+					job_id = running.pop(future)
+					if future.exception() is not None:
+						self.stderr.write('Job %s crashed its worker: %s' % (job_id, future.exception()))
+					elif options['verbosity'] > 1:
+						self.stdout.write('Job %s finished' % job_id)
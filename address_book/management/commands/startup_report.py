@@ -0,0 +1,50 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+	help = 'Boot the project in fresh interpreters and print the median cost of each startup step as JSON'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--runs', type=int, default=5, help='interpreters to start, the median of each step is reported')
+		parser.add_argument('--output', help='write the JSON report to this file instead of stdout')
+
+	def handle(self, *args, **options):
+		if options['runs'] < 1:
+			raise CommandError('--runs must be positive')
+		# the children load the settings this command runs with, e.g. --settings main.settings_production
+		env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+		runs = [self.run_once(env) for _ in range(options['runs'])]
+
+		report = {key: value for key, value in runs[0].items() if not isinstance(value, float)}
+		for key in runs[0]:
+			if isinstance(runs[0][key], float):
+				report[key] = statistics.median(run[key] for run in runs)
+		report['runs'] = len(runs)
+
+		output = json.dumps(report, indent=2, sort_keys=True)
+		if options['output']:
+			with open(options['output'], 'w') as report_file:
+				report_file.write(output + '\n')
+		else:
+			self.stdout.write(output)
+
+	def run_once(self, env):
+		started = time.perf_counter()
+		process = subprocess.run(
+			[sys.executable, '-m', 'address_book.startup'], env=env, cwd=settings.BASE_DIR, capture_output=True, text=True
+		)
+		elapsed = time.perf_counter() - started
+		if process.returncode:
+			raise CommandError('Startup failed:\n%s' % process.stderr)
+		run = json.loads(process.stdout)
+		# interpreter start and the imports before Django included
+		run['process_ms'] = round(elapsed * 1000, 2)
+		return run
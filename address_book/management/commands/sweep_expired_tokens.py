@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from address_book.authentication import sweep_expired_tokens
+
+
+class Command(BaseCommand):
+	help = 'Delete expired auth tokens in batches, once or every --every seconds'
+
+	def add_arguments(self, parser):
+		parser.add_argument('--batch-size', type=int, default=None, help='tokens deleted per statement, defaults to ADDRESS_BOOK_DELETE_BATCH_SIZE')
+		parser.add_argument('--every', type=float, default=None, help='keep running and sweep every this many seconds')
+
+	def handle(self, *args, **options):
+		if options['every'] is not None and options['every'] <= 0:
+			raise CommandError('--every must be positive')
+		while True:
+			deleted = sweep_expired_tokens(options['batch_size'])
+			if deleted or options['every'] is None:
+				self.stdout.write('Deleted %s expired tokens' % deleted)
+			if options['every'] is None:
+				return
+			time.sleep(options['every'])
@@ -0,0 +1,121 @@
+import contextvars
+import heapq
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 500)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+class RequestStats:
+    """
+    What a single request spent its time on, filled in while it runs.
+    """
+
+    def __init__(self, max_sql):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.serializer_seconds = 0.0
+        # min-heap of the max_sql slowest (duration, sql) seen so far
+        self.sql = []
+        self.max_sql = max_sql
+
+    def record_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.queries += 1
+            self.db_seconds += duration
+            if len(self.sql) < self.max_sql:
+                heapq.heappush(self.sql, (duration, sql))
+            elif self.sql and duration > self.sql[0][0]:
+                heapq.heapreplace(self.sql, (duration, sql))
+
+
+current_request = contextvars.ContextVar('address_book_request_stats', default=None)
+
+
+@contextmanager
+def serializer_timer():
+    """
+    Add the time spent in the block to the serializer time of the current request.
+    """
+    stats = current_request.get()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.serializer_seconds += time.perf_counter() - started
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self.series.items()):
+                label_text = ','.join('%s="%s"' % pair for pair in labels)
+                cumulative = 0
+                for bound, bucket_count in zip((*self.buckets, '+Inf'), counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket{%s,le="%s"} %s' % (self.name, label_text, bound, cumulative))
+                lines.append('%s_sum{%s} %s' % (self.name, label_text, total))
+                lines.append('%s_count{%s} %s' % (self.name, label_text, count))
+        return lines
+
+    def clear(self):
+        with self._lock:
+            self.series.clear()
+
+
+REQUEST_SECONDS = Histogram('address_book_request_seconds', 'Wall time of a request', LATENCY_BUCKETS)
+DB_QUERIES = Histogram('address_book_request_db_queries', 'Database queries run by a request', QUERY_BUCKETS)
+DB_SECONDS = Histogram('address_book_request_db_seconds', 'Time a request spent in the database', LATENCY_BUCKETS)
+SERIALIZER_SECONDS = Histogram('address_book_request_serializer_seconds', 'Time a request spent serializing', LATENCY_BUCKETS)
+RESPONSE_BYTES = Histogram('address_book_response_bytes', 'Size of a response body', SIZE_BUCKETS)
+
+HISTOGRAMS = (REQUEST_SECONDS, DB_QUERIES, DB_SECONDS, SERIALIZER_SECONDS, RESPONSE_BYTES)
+
+
+def observe_request(labels, stats, seconds, size):
+    labels = tuple(sorted(labels.items()))
+    REQUEST_SECONDS.observe(labels, seconds)
+    DB_QUERIES.observe(labels, stats.queries)
+    DB_SECONDS.observe(labels, stats.db_seconds)
+    SERIALIZER_SECONDS.observe(labels, stats.serializer_seconds)
+    if size is not None:
+        RESPONSE_BYTES.observe(labels, size)
+
+
+def render():
+    from .authentication import token_cache
+
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.render())
+    cache_stats = token_cache.stats()
+    for name in ('hits', 'misses'):
+        lines.append('# TYPE address_book_token_cache_%s_total counter' % name)
+        lines.append('address_book_token_cache_%s_total %s' % (name, cache_stats[name]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+
+from . import metrics
+
+logger = logging.getLogger('address_book.slow')
+
+
+class PerformanceMiddleware:
+    """
+    Records wall time, database queries and time, serializer time and response
+    size of every request per view and action, and logs slow requests with their SQL.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # lets the async views of the ASGI deployment run without a thread per request
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        stats, token, started = self.start()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(stats.record_query))
+                response = self.get_response(request)
+        finally:
+            metrics.current_request.reset(token)
+        self.finish(request, response, stats, started)
+        return response
+
+    async def __acall__(self, request):
+        # the views run on the database pool, which records their queries through current_request
+        stats, token, started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.current_request.reset(token)
+        self.finish(request, response, stats, started)
+        return response
+
+    def start(self):
+        stats = metrics.RequestStats(settings.ADDRESS_BOOK_SLOW_REQUEST_MAX_SQL)
+        return stats, metrics.current_request.set(stats), time.perf_counter()
+
+    def finish(self, request, response, stats, started):
+        seconds = time.perf_counter() - started
+
+        labels = self.get_labels(request)
+        size = None if response.streaming else len(response.content)
+        metrics.observe_request(labels, stats, seconds, size)
+
+        if seconds >= settings.ADDRESS_BOOK_SLOW_REQUEST_SECONDS:
+            slowest = sorted(stats.sql, key=lambda item: item[0], reverse=True)
+            logger.warning(
+                'Slow request %s %s (%s) took %.3fs, %s queries in %.3fs, serializer %.3fs\n%s',
+                request.method, request.path, labels['view'], seconds, stats.queries, stats.db_seconds,
+                stats.serializer_seconds, '\n'.join('%.4fs %s' % item for item in slowest)
+            )
+
+    def get_labels(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return {'view': 'unmatched', 'action': '', 'method': request.method}
+        view_class = getattr(match.func, 'cls', None)
+        view = view_class.__name__ if view_class is not None else match.view_name
+        actions = getattr(match.func, 'actions', None) or {}
+        return {'view': view, 'action': actions.get(request.method.lower(), ''), 'method': request.method}
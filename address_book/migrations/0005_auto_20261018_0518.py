@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_book', '0004_job'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'id'], name='address_boo_user_id_70b950_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'city', 'id'], name='address_boo_user_id_5c6541_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'country', 'id'], name='address_boo_user_id_102136_idx'),
+        ),
+    ]
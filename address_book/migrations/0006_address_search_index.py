@@ -0,0 +1,79 @@
+from django.db import migrations
+
+# Frozen copy of the index in address_book.search as of this migration, later
+# migrations that rebuild the address table on SQLite reinstall it from here
+SEARCH_COLUMNS = ('street', 'city', 'postcode', 'country')
+
+PG_INSTALL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS address_book_address_search_trgm "
+    "ON address_book_address USING gin ((%s) gin_trgm_ops)" % " || ' ' || ".join(SEARCH_COLUMNS),
+]
+PG_UNINSTALL = [
+    "DROP INDEX IF EXISTS address_book_address_search_trgm",
+]
+
+FTS_TABLE = 'address_book_address_fts'
+FTS_COLUMNS = ', '.join(SEARCH_COLUMNS)
+FTS_NEW = ', '.join('new.%s' % column for column in SEARCH_COLUMNS)
+FTS_OLD = ', '.join('old.%s' % column for column in SEARCH_COLUMNS)
+SQLITE_TRIGGERS = [
+    "CREATE TRIGGER {fts}_ai AFTER INSERT ON address_book_address BEGIN "
+    "INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+    "CREATE TRIGGER {fts}_ad AFTER DELETE ON address_book_address BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); END",
+    "CREATE TRIGGER {fts}_au AFTER UPDATE ON address_book_address BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+    "INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+]
+SQLITE_DROP_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS {fts}_ai",
+    "DROP TRIGGER IF EXISTS {fts}_ad",
+    "DROP TRIGGER IF EXISTS {fts}_au",
+]
+
+
+def sqlite_has_fts5(connection):
+    # the trigram tokenizer arrived in SQLite 3.34
+    if connection.Database.sqlite_version_info < (3, 34):
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def install_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        for sql in PG_INSTALL:
+            schema_editor.execute(sql)
+    elif connection.vendor == 'sqlite' and sqlite_has_fts5(connection):
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, content='address_book_address', "
+            "content_rowid='id', tokenize='trigram')" % (FTS_TABLE, FTS_COLUMNS)
+        )
+        for sql in SQLITE_DROP_TRIGGERS + SQLITE_TRIGGERS:
+            schema_editor.execute(sql.format(fts=FTS_TABLE, columns=FTS_COLUMNS, new=FTS_NEW, old=FTS_OLD))
+        schema_editor.execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (FTS_TABLE, FTS_TABLE))
+
+
+def uninstall_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        for sql in PG_UNINSTALL:
+            schema_editor.execute(sql)
+    elif connection.vendor == 'sqlite':
+        for sql in SQLITE_DROP_TRIGGERS:
+            schema_editor.execute(sql.format(fts=FTS_TABLE))
+        schema_editor.execute("DROP TABLE IF EXISTS %s" % FTS_TABLE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_book', '0005_auto_20261018_0518'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search_index, uninstall_search_index),
+    ]
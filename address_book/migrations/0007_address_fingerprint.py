@@ -0,0 +1,144 @@
+import hashlib
+import re
+from importlib import import_module
+
+from django.db import migrations, models
+from django.db.models import Q
+
+# the index as frozen by 0006, not the live address_book.search
+install_search_index = import_module('address_book.migrations.0006_address_search_index').install_search_index
+
+BATCH_SIZE = 2000
+
+
+# Frozen copy of address_book.fingerprint as of this migration, changes to the
+# live normalization must not change the fingerprints written here
+STREET_ABBREVIATIONS = {
+    'ave': 'avenue',
+    'av': 'avenue',
+    'blvd': 'boulevard',
+    'cl': 'close',
+    'ct': 'court',
+    'cres': 'crescent',
+    'dr': 'drive',
+    'gdns': 'gardens',
+    'gr': 'grove',
+    'hwy': 'highway',
+    'ln': 'lane',
+    'pde': 'parade',
+    'pk': 'park',
+    'pl': 'place',
+    'rd': 'road',
+    'sq': 'square',
+    'st': 'street',
+    'ter': 'terrace',
+    'terr': 'terrace',
+    'ul': 'ulica',
+}
+
+PUNCTUATION = re.compile(r"[^\w\s-]+")
+
+
+def normalize(value):
+    return ' '.join(PUNCTUATION.sub(' ', value.casefold()).split())
+
+
+def normalize_street(value):
+    return ' '.join(STREET_ABBREVIATIONS.get(word, word) for word in normalize(value).split())
+
+
+def address_fingerprint(street, city, country):
+    key = '\x1f'.join((normalize_street(street), normalize(city), normalize(country)))
+    digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class DuplicateAddresses(Exception):
+    pass
+
+
+def fill_fingerprints(apps, schema_editor):
+    """
+    Fingerprint existing addresses. Rows that normalize to an address the user
+    already has would break the new unique constraint; they are listed and the
+    migration fails, so they can be merged by hand before running it again.
+
+    Addresses are read in (user, id) order so only the fingerprints of one
+    address book are held in memory at a time.
+    """
+    Address = apps.get_model('address_book', 'Address')
+    # historical models are not routed to shards, stay on the database being migrated
+    addresses = Address.objects.using(schema_editor.connection.alias)
+
+    # addresses without a user never collide
+    last = 0
+    while True:
+        batch = list(addresses.filter(user__isnull=True, pk__gt=last).order_by('pk')[:BATCH_SIZE])
+        if not batch:
+            break
+        for address in batch:
+            address.fingerprint = address_fingerprint(address.street, address.city, address.country)
+        addresses.bulk_update(batch, ['fingerprint'])
+        last = batch[-1].pk
+
+    user_id, last, seen, conflicts = None, 0, {}, []
+    while True:
+        query_set = addresses.filter(user__isnull=False)
+        if user_id is not None:
+            query_set = query_set.filter(Q(user_id__gt=user_id) | Q(user_id=user_id, pk__gt=last))
+        batch = list(query_set.order_by('user_id', 'pk')[:BATCH_SIZE])
+        if not batch:
+            break
+        kept = []
+        for address in batch:
+            if address.user_id != user_id:
+                user_id, seen = address.user_id, {}
+            address.fingerprint = address_fingerprint(address.street, address.city, address.country)
+            if address.fingerprint in seen:
+                conflicts.append('address %s of user %s duplicates address %s: %r, %r, %r, %r' % (
+                    address.pk, user_id, seen[address.fingerprint], address.street, address.city, address.postcode, address.country
+                ))
+            else:
+                seen[address.fingerprint] = address.pk
+                kept.append(address)
+        if not conflicts:
+            # the batch is rolled back with the migration anyway once one is found
+            addresses.bulk_update(kept, ['fingerprint'])
+        last = batch[-1].pk
+
+    if conflicts:
+        raise DuplicateAddresses(
+            '%s addresses on %s are duplicates under the new fingerprint, merge or delete them and migrate again:\n%s'
+            % (len(conflicts), schema_editor.connection.alias, '\n'.join(conflicts))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_book', '0006_address_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='fingerprint',
+            field=models.BigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(fill_fingerprints, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='address',
+            name='fingerprint',
+            field=models.BigIntegerField(editable=False),
+        ),
+        migrations.AlterUniqueTogether(
+            name='address',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='address',
+            constraint=models.UniqueConstraint(fields=('user', 'fingerprint'), name='address_book_address_user_fingerprint'),
+        ),
+        # SQLite drops the search triggers when it rebuilds the table
+        migrations.RunPython(install_search_index, migrations.RunPython.noop),
+    ]
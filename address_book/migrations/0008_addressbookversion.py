@@ -0,0 +1,22 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('address_book', '0007_address_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AddressBookVersion',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='address_book_version', serialize=False, to='auth.user')),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:32
+
+from importlib import import_module
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# the index as frozen by 0006, not the live address_book.search
+install_search_index = import_module('address_book.migrations.0006_address_search_index').install_search_index
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('address_book', '0008_addressbookversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AddressTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('address_id', models.BigIntegerField()),
+                ('change_version', models.BigIntegerField()),
+                ('deleted', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='address',
+            name='change_version',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='address',
+            name='modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='address',
+            index=models.Index(fields=['user', 'change_version', 'id'], name='address_boo_user_id_dc4ca7_idx'),
+        ),
+        migrations.AddField(
+            model_name='addresstombstone',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='address_tombstones', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='addresstombstone',
+            index=models.Index(fields=['user', 'change_version', 'address_id'], name='address_boo_user_id_6f31ac_idx'),
+        ),
+        # SQLite drops the search triggers when it rebuilds the table
+        migrations.RunPython(install_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:41
+
+from importlib import import_module
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# the index as frozen by 0006, not the live address_book.search
+install_search_index = import_module('address_book.migrations.0006_address_search_index').install_search_index
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('address_book', '0009_auto_20261018_0532'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShardPlacement',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='shard_placement', serialize=False, to='auth.user')),
+                ('alias', models.CharField(max_length=50)),
+                ('moving', models.BooleanField(default=False)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='address',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='addresses', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='addressbookversion',
+            name='user',
+            field=models.OneToOneField(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='address_book_version', serialize=False, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='addresstombstone',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='address_tombstones', to=settings.AUTH_USER_MODEL),
+        ),
+        # SQLite drops the search triggers when it rebuilds the table
+        migrations.RunPython(install_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+from address_book.stats import rebuild_counts
+
+
+def count_addresses(apps, schema_editor):
+    rebuild_counts(schema_editor.connection.alias, apps)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('address_book', '0010_shardplacement'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AddressCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('country', 'Country'), ('city', 'City')], max_length=10)),
+                ('country', models.CharField(max_length=50)),
+                ('city', models.CharField(blank=True, max_length=50)),
+                ('count', models.BigIntegerField(default=0)),
+                ('user', models.ForeignKey(db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='address_counts', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='addresscount',
+            index=models.Index(fields=['user', 'kind', '-count'], name='address_boo_user_id_d10a72_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='addresscount',
+            constraint=models.UniqueConstraint(fields=('user', 'kind', 'country', 'city'), name='address_book_addresscount_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='addresscount',
+            constraint=models.UniqueConstraint(condition=models.Q(('user', None)), fields=('kind', 'country', 'city'), name='address_book_addresscount_global'),
+        ),
+        migrations.RunPython(count_addresses, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 05:47
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+# the index as frozen by 0006, not the live address_book.search
+install_search_index = import_module('address_book.migrations.0006_address_search_index').install_search_index
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_book', '0011_addresscount'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='address',
+            name='latitude',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='address',
+            name='longitude',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        # SQLite drops the search triggers when it rebuilds the table
+        migrations.RunPython(install_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 06:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('address_book', '0013_job_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='addressbookversion',
+            name='pruned_version',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
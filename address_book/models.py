@@ -1,16 +1,187 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.utils import timezone
+
+from .fingerprint import address_fingerprint
+
+
+class AddressBookQuerySet(models.QuerySet):
+    """
+    Queryset of a sharded model, ``filter(user=...)`` tells the router whose shard to use.
+    """
+
+    def _with_user_hint(self, kwargs):
+        user = kwargs.get('user', kwargs.get('user_id'))
+        if user is not None:
+            self._hints = {**self._hints, 'user_id': getattr(user, 'pk', user)}
+        return self
+
+    def _filter_or_exclude(self, negate, args, kwargs):
+        clone = super()._filter_or_exclude(negate, args, kwargs)
+        return clone if negate else clone._with_user_hint(kwargs)
+
+    def create(self, **kwargs):
+        return super(AddressBookQuerySet, self._chain()._with_user_hint(kwargs)).create(**kwargs)
+
+    def get_or_create(self, defaults=None, **kwargs):
+        return super(AddressBookQuerySet, self._chain()._with_user_hint(kwargs)).get_or_create(defaults, **kwargs)
+
+    def update_or_create(self, defaults=None, **kwargs):
+        return super(AddressBookQuerySet, self._chain()._with_user_hint(kwargs)).update_or_create(defaults, **kwargs)
 
 
 class Address(models.Model):
-    user = models.ForeignKey(User, related_name='addresses', null=True, on_delete=models.CASCADE)
+    # users live on the default database, addresses on the user's shard
+    user = models.ForeignKey(User, related_name='addresses', null=True, on_delete=models.CASCADE, db_constraint=False)
     street = models.CharField(max_length=100)
     city = models.CharField(max_length=50)
     postcode = models.CharField(max_length=50)
     country = models.CharField(max_length=50)
+    # hash of the normalized street, city and country, unique per user
+    fingerprint = models.BigIntegerField(editable=False)
+    # address book version of the last change, see AddressBookVersion
+    change_version = models.BigIntegerField(default=0, editable=False)
+    modified = models.DateTimeField(auto_now=True)
+    # looked up from the postcode dataset, see geocode_addresses
+    latitude = models.FloatField(null=True, blank=True, editable=False)
+    longitude = models.FloatField(null=True, blank=True, editable=False)
+
+    objects = AddressBookQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "fingerprint"], name="address_book_address_user_fingerprint"),
+        ]
+        # keyset pagination walks these in order within a single user
+        indexes = [
+            models.Index(fields=["user", "id"]),
+            models.Index(fields=["user", "city", "id"]),
+            models.Index(fields=["user", "country", "id"]),
+            # delta sync walks changes in (change_version, id) order
+            models.Index(fields=["user", "change_version", "id"]),
+        ]
+
+    def __str__(self):
+        return '%s, %s, %s, %s' % (self.street, self.city, self.postcode, self.country)
+
+    def save(self, *args, **kwargs):
+        self.fingerprint = address_fingerprint(self.street, self.city, self.country)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'fingerprint' not in update_fields:
+            kwargs['update_fields'] = [*update_fields, 'fingerprint']
+        super().save(*args, **kwargs)
+
+
+class Job(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    user = models.ForeignKey(User, related_name='jobs', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=50)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    params = models.JSONField(default=dict)
+    result = models.JSONField(null=True, blank=True)
+    # rows handled so far out of total, reported by the handler
+    processed = models.BigIntegerField(default=0)
+    total = models.BigIntegerField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    # touched by every progress report, running jobs that stop reporting are requeued
+    updated = models.DateTimeField(auto_now=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"]),
+        ]
+
+    def __str__(self):
+        return '%s #%s (%s)' % (self.kind, self.pk, self.status)
+
+    def report(self, processed, total=None):
+        self.processed = processed
+        if total is not None:
+            self.total = total
+        Job.objects.filter(pk=self.pk).update(processed=self.processed, total=self.total, updated=timezone.now())
+
+
+class AddressBookVersion(models.Model):
+    user = models.OneToOneField(User, related_name='address_book_version', primary_key=True, on_delete=models.CASCADE, db_constraint=False)
+    # bumped by every change to the user's addresses
+    version = models.BigIntegerField(default=0)
+    # tombstones up to this version were pruned, clients behind it must sync from scratch
+    pruned_version = models.BigIntegerField(default=0)
+
+    objects = AddressBookQuerySet.as_manager()
+
+    def __str__(self):
+        return '%s v%s' % (self.user_id, self.version)
+
+
+class AddressTombstone(models.Model):
+    user = models.ForeignKey(User, related_name='address_tombstones', on_delete=models.CASCADE, db_constraint=False)
+    address_id = models.BigIntegerField()
+    change_version = models.BigIntegerField()
+    deleted = models.DateTimeField(auto_now_add=True)
+
+    objects = AddressBookQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "change_version", "address_id"]),
+        ]
+
+    def __str__(self):
+        return '%s deleted at v%s' % (self.address_id, self.change_version)
+
+
+class ShardPlacement(models.Model):
+    user = models.OneToOneField(User, related_name='shard_placement', primary_key=True, on_delete=models.CASCADE)
+    # database alias holding the user's address book
+    alias = models.CharField(max_length=50)
+    # set while rebalance_shards copies the address book to another shard
+    moving = models.BooleanField(default=False)
+
+    def __str__(self):
+        return '%s on %s' % (self.user_id, self.alias)
+
+
+class AddressCount(models.Model):
+    COUNTRY = 'country'
+    CITY = 'city'
+    KIND_CHOICES = [
+        (COUNTRY, 'Country'),
+        (CITY, 'City'),
+    ]
+
+    # rows without a user hold the counts over all users of the shard
+    user = models.ForeignKey(User, related_name='address_counts', null=True, on_delete=models.CASCADE, db_constraint=False)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    country = models.CharField(max_length=50)
+    # empty for country counts
+    city = models.CharField(max_length=50, blank=True)
+    count = models.BigIntegerField(default=0)
+
+    objects = AddressBookQuerySet.as_manager()
 
     class Meta:
-        unique_together = ["user", "street", "city", "country"]
+        constraints = [
+            models.UniqueConstraint(fields=["user", "kind", "country", "city"], name="address_book_addresscount_user"),
+            models.UniqueConstraint(
+                fields=["kind", "country", "city"], condition=models.Q(user=None), name="address_book_addresscount_global"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["user", "kind", "-count"]),
+        ]
 
     def __str__(self):
-        return '%s, %s, %s, %s' % (self.street, self.city, self.postcode, self.country)
\ No newline at end of file
+        return '%s %s: %s' % (self.country, self.city, self.count)
@@ -0,0 +1,174 @@
+import binascii
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import BooleanField
+from django.db.models.expressions import RawSQL
+from django.utils.functional import cached_property
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import Cursor, CursorPagination, PageNumberPagination
+from rest_framework.utils.urls import replace_query_param
+
+
+class AddressPageNumberPagination(PageNumberPagination):
+    page_size_query_param = 'page_size'
+    max_page_size = settings.ADDRESS_BOOK_MAX_PAGE_SIZE
+
+
+class AddressCursorPagination(CursorPagination):
+    """
+    Keyset pagination over the user's addresses in ``(field, id)`` order.
+
+    The cursor carries the field value and id of the row the page starts
+    after, so every page is a ``(field, id) > (value, id)`` range scan of the
+    user's index, with no COUNT(*) and no OFFSET however many rows share a value.
+
+    ?pagination=cursor&ordering=city&page_size=100
+
+    """
+    ordering = 'id'
+    ordering_fields = ('id', 'street', 'city', 'country')
+    page_size_query_param = 'page_size'
+    max_page_size = settings.ADDRESS_BOOK_MAX_PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        field = request.query_params.get('ordering', self.ordering)
+        if field.lstrip('-') not in self.ordering_fields:
+            field = self.ordering
+        if field.lstrip('-') == 'id':
+            return (field,)
+        # id breaks ties so rows sharing a value keep a stable order
+        return (field, '-id' if field.startswith('-') else 'id')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is not None and len(self.cursor.position) != len(self.ordering):
+            # made for another ordering
+            raise NotFound(self.invalid_cursor_message)
+        reverse = self.cursor is not None and self.cursor.reverse
+
+        ordering = [order[1:] if order.startswith('-') else '-' + order for order in self.ordering] if reverse else self.ordering
+        queryset = queryset.order_by(*ordering)
+        if self.cursor is not None:
+            queryset = queryset.filter(self.keyset_after(queryset, ordering, self.cursor.position))
+
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        has_more = len(results) > self.page_size
+        if reverse:
+            self.page.reverse()
+            # a previous page was asked for from a later one
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, self.cursor is not None
+        if self.page:
+            self.next_position = self.get_position(self.page[-1])
+            self.previous_position = self.get_position(self.page[0])
+        else:
+            self.has_next = self.has_previous = False
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def keyset_after(self, queryset, ordering, position):
+        # a row value comparison the (user, field, id) indexes answer directly
+        operator = '<' if ordering[0].startswith('-') else '>'
+        columns = [queryset.model._meta.get_field(order.lstrip('-')).column for order in ordering]
+        table = queryset.model._meta.db_table
+        sql = '(%s) %s (%s)' % (
+            ', '.join('%s.%s' % (table, column) for column in columns), operator, ', '.join(['%s'] * len(columns))
+        )
+        return RawSQL(sql, list(position), output_field=BooleanField())
+
+    def get_position(self, row):
+        field = self.ordering[0].lstrip('-')
+        if isinstance(row, dict):
+            value, pk = row[field], row['id']
+        else:
+            value, pk = getattr(row, field), row.pk
+        return (pk,) if field == 'id' else (value, pk)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=False, position=self.next_position))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        return self.encode_cursor(Cursor(offset=0, reverse=True, position=self.previous_position))
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            data = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+            position = tuple(data['p'])
+            if len(position) not in (1, 2) or not isinstance(position[-1], int) or isinstance(position[-1], bool):
+                raise ValueError(position)
+            return Cursor(offset=0, reverse=bool(data.get('r')), position=position)
+        except (TypeError, ValueError, KeyError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, cursor):
+        data = {'p': list(cursor.position)}
+        if cursor.reverse:
+            data['r'] = 1
+        encoded = urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode()).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Admin changelist paginator that never counts a whole large table.
+
+    Unfiltered listings take the row estimate of the database statistics,
+    filtered ones are counted up to ADDRESS_BOOK_ADMIN_COUNT_LIMIT rows and
+    the pages stop there.
+    """
+
+    @cached_property
+    def count(self):
+        limit = settings.ADDRESS_BOOK_ADMIN_COUNT_LIMIT
+        query_set = self.object_list.order_by()
+        if not query_set.query.where:
+            estimate = estimate_count(query_set.model, query_set.db)
+            if estimate is not None and estimate > limit:
+                return estimate
+        return query_set[:limit].count()
+
+
+def estimate_count(model, using):
+    """
+    Row count of the model's table from the planner statistics, None when there are none.
+    """
+    connection = connections[using]
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass', [connection.ops.quote_name(table)])
+        elif connection.vendor == 'sqlite':
+            # filled in by ANALYZE
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'")
+            if cursor.fetchone() is None:
+                return None
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1', [table])
+        else:
+            return None
+        row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    # never analyzed tables report -1 on Postgres
+    estimate = int(float(str(row[0]).split()[0]))
+    return estimate if estimate >= 0 else None
@@ -0,0 +1,128 @@
+import contextvars
+import random
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from . import sharding
+
+_replica_reads = contextvars.ContextVar('address_book_replica_reads', default=False)
+
+
+@contextmanager
+def replica_reads():
+    """
+    Let address_book reads inside the block go to a replica of their primary.
+    """
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def use_primary():
+    _replica_reads.set(False)
+
+
+def replicas_of(alias):
+    return settings.ADDRESS_BOOK_DATABASE_REPLICAS.get(alias, [])
+
+
+def pin_to_primary(user_id):
+    """
+    Send the user's reads to the primary for a while so they see their own writes.
+    """
+    pins = caches[settings.ADDRESS_BOOK_REPLICA_PIN_CACHE_ALIAS]
+    pins.set('address_book:primary:%s' % user_id, True, settings.ADDRESS_BOOK_REPLICA_PIN_SECONDS)
+
+
+def is_pinned(user_id):
+    pins = caches[settings.ADDRESS_BOOK_REPLICA_PIN_CACHE_ALIAS]
+    return pins.get('address_book:primary:%s' % user_id, False)
+
+
+def check_connections(**kwargs):
+    """
+    Close persistent connections that went away while idle, so the request
+    opens a fresh one instead of failing on its first query.
+
+    A connection found usable is trusted for ADDRESS_BOOK_CONN_HEALTH_CHECK_INTERVAL
+    seconds, so busy workers do not ping every database on every request.
+    """
+    if not settings.ADDRESS_BOOK_CONN_HEALTH_CHECKS:
+        return
+    now = time.monotonic()
+    for connection in connections.all():
+        if connection.connection is None:
+            continue
+        checked = getattr(connection, 'address_book_checked', None)
+        if checked is not None and now - checked < settings.ADDRESS_BOOK_CONN_HEALTH_CHECK_INTERVAL:
+            continue
+        if connection.is_usable():
+            connection.address_book_checked = now
+        else:
+            connection.close()
+
+
+class AddressBookRouter:
+    """
+    Sends a user's address book to the shard holding it, and its reads made
+    inside replica_reads() to a replica of that shard. Everything else stays
+    on the default database.
+
+    The shard comes from the instance, the surrounding for_user() block or the
+    user the query filters on. With several shards, address book queries
+    that have none of these raise ShardNotResolved instead of quietly using
+    the default database.
+    """
+
+    def shard(self, model, hints):
+        if model not in sharding.SHARDED_MODELS:
+            return None
+        instance = hints.get('instance')
+        if isinstance(instance, sharding.SHARDED_MODELS) and instance.user_id is not None:
+            return sharding.shard_for_user(instance.user_id)
+        if isinstance(instance, User):
+            # related managers, e.g. user.addresses
+            return sharding.shard_for_user(instance.pk)
+        alias = sharding.current_shard()
+        if alias is not None:
+            return alias
+        if hints.get('user_id') is not None:
+            # filter(user=...) outside for_user()
+            return sharding.shard_for_user(hints['user_id'])
+        if len(settings.ADDRESS_BOOK_SHARDS) > 1:
+            # the default database only holds some of the address books
+            raise sharding.ShardNotResolved(
+                'Query on %s without a user, use sharding.for_user() or .using()' % model._meta.label
+            )
+        return None
+
+    def db_for_read(self, model, **hints):
+        alias = self.shard(model, hints)
+        if model._meta.app_label != 'address_book' or not _replica_reads.get():
+            return alias
+        replicas = replicas_of(alias or DEFAULT_DB_ALIAS)
+        return random.choice(replicas) if replicas else alias
+
+    def db_for_write(self, model, **hints):
+        return self.shard(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # users and their addresses may live on different databases
+        aliases = set(settings.ADDRESS_BOOK_SHARDS)
+        for alias in settings.ADDRESS_BOOK_SHARDS:
+            aliases.update(replicas_of(alias))
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if any(db in replicas for replicas in settings.ADDRESS_BOOK_DATABASE_REPLICAS.values()):
+            return False
+        return None
@@ -0,0 +1,161 @@
+import operator
+from functools import reduce
+
+from django.db import connections
+from django.db.models import BooleanField, FloatField, Q
+from django.db.models.expressions import RawSQL
+from rest_framework.compat import coreapi, coreschema
+from rest_framework.filters import BaseFilterBackend
+
+SEARCH_COLUMNS = ('street', 'city', 'postcode', 'country')
+
+# Trigram indexes can only match terms of at least this many characters
+MIN_INDEXED_TERM = 3
+
+PG_DOCUMENT = " || ' ' || ".join(SEARCH_COLUMNS)
+PG_INSTALL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS address_book_address_search_trgm "
+    "ON address_book_address USING gin ((%s) gin_trgm_ops)" % PG_DOCUMENT,
+]
+PG_UNINSTALL = [
+    "DROP INDEX IF EXISTS address_book_address_search_trgm",
+]
+
+FTS_TABLE = 'address_book_address_fts'
+FTS_COLUMNS = ', '.join(SEARCH_COLUMNS)
+FTS_NEW = ', '.join('new.%s' % column for column in SEARCH_COLUMNS)
+FTS_OLD = ', '.join('old.%s' % column for column in SEARCH_COLUMNS)
+SQLITE_TRIGGERS = [
+    "CREATE TRIGGER {fts}_ai AFTER INSERT ON address_book_address BEGIN "
+    "INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+    "CREATE TRIGGER {fts}_ad AFTER DELETE ON address_book_address BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); END",
+    "CREATE TRIGGER {fts}_au AFTER UPDATE ON address_book_address BEGIN "
+    "INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+    "INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+]
+SQLITE_DROP_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS {fts}_ai",
+    "DROP TRIGGER IF EXISTS {fts}_ad",
+    "DROP TRIGGER IF EXISTS {fts}_au",
+]
+
+_fts_available = {}
+
+
+def install_search_index(apps, schema_editor):
+    """
+    Create the text index for the current backend.
+
+    Migrations run their own frozen copy, see 0006_address_search_index; a
+    change to the index here needs a migration installing the new version.
+    """
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        for sql in PG_INSTALL:
+            schema_editor.execute(sql)
+    elif connection.vendor == 'sqlite' and _sqlite_has_fts5(connection):
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, content='address_book_address', "
+            "content_rowid='id', tokenize='trigram')" % (FTS_TABLE, FTS_COLUMNS)
+        )
+        for sql in SQLITE_DROP_TRIGGERS + SQLITE_TRIGGERS:
+            schema_editor.execute(sql.format(fts=FTS_TABLE, columns=FTS_COLUMNS, new=FTS_NEW, old=FTS_OLD))
+        schema_editor.execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (FTS_TABLE, FTS_TABLE))
+    _fts_available.clear()
+
+
+def uninstall_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'postgresql':
+        for sql in PG_UNINSTALL:
+            schema_editor.execute(sql)
+    elif connection.vendor == 'sqlite':
+        for sql in SQLITE_DROP_TRIGGERS:
+            schema_editor.execute(sql.format(fts=FTS_TABLE))
+        schema_editor.execute("DROP TABLE IF EXISTS %s" % FTS_TABLE)
+    _fts_available.clear()
+
+
+def search_addresses(query_set, q):
+    """
+    Narrow ``query_set`` to addresses containing every term of ``q`` and
+    annotate them with ``search_rank``, higher being a better match.
+    """
+    terms = q.split()
+    if not terms:
+        return query_set
+    indexed = [term for term in terms if len(term) >= MIN_INDEXED_TERM]
+    connection = connections[query_set.db]
+
+    if indexed and connection.vendor == 'postgresql':
+        for term in indexed:
+            query_set = query_set.filter(RawSQL('(%s) ILIKE %%s' % PG_DOCUMENT, [_like(term)], output_field=BooleanField()))
+        rank = RawSQL('word_similarity(%%s, %s)' % PG_DOCUMENT, [q], output_field=FloatField())
+        query_set = query_set.annotate(search_rank=rank)
+    elif indexed and connection.vendor == 'sqlite' and _sqlite_fts_installed(connection):
+        match = ' '.join('"%s"' % term.replace('"', '""') for term in indexed)
+        query_set = query_set.filter(RawSQL(
+            'address_book_address.id IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (FTS_TABLE, FTS_TABLE),
+            [match], output_field=BooleanField()))
+        rank = RawSQL(
+            '(SELECT -bm25(%s) FROM %s WHERE %s MATCH %%s AND rowid = address_book_address.id)' % (FTS_TABLE, FTS_TABLE, FTS_TABLE),
+            [match], output_field=FloatField())
+        query_set = query_set.annotate(search_rank=rank)
+    else:
+        indexed = []
+
+    # terms too short for the index are matched on the already narrowed rows
+    for term in terms:
+        if term not in indexed:
+            query_set = query_set.filter(reduce(operator.or_, (Q(**{'%s__icontains' % column: term}) for column in SEARCH_COLUMNS)))
+
+    if 'search_rank' in query_set.query.annotations:
+        return query_set.order_by('-search_rank', 'id')
+    return query_set
+
+
+def _like(term):
+    return '%%%s%%' % term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _sqlite_has_fts5(connection):
+    # the trigram tokenizer arrived in SQLite 3.34
+    if connection.Database.sqlite_version_info < (3, 34):
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def _sqlite_fts_installed(connection):
+    if connection.alias not in _fts_available:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+            _fts_available[connection.alias] = cursor.fetchone() is not None
+    return _fts_available[connection.alias]
+
+
+class AddressSearchFilter(BaseFilterBackend):
+    """
+    ?q=fetter london
+
+    """
+    search_param = 'q'
+
+    def filter_queryset(self, request, queryset, view):
+        q = request.query_params.get(self.search_param, '')
+        return search_addresses(queryset, q) if q.strip() else queryset
+
+    def get_schema_fields(self, view):
+        assert coreapi is not None, 'coreapi must be installed to use `get_schema_fields()`'
+        assert coreschema is not None, 'coreschema must be installed to use `get_schema_fields()`'
+        return [
+            coreapi.Field(
+                name=self.search_param,
+                required=False,
+                location='query',
+                schema=coreschema.String(description='Search street, city, postcode and country')
+            )
+        ]
@@ -0,0 +1,300 @@
+import contextvars
+import hashlib
+import time
+from bisect import bisect
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from . import stats, utils
+from .models import Address, AddressBookVersion, AddressCount, AddressTombstone, ShardPlacement
+
+# Models stored on the shard of the user they belong to
+SHARDED_MODELS = (Address, AddressTombstone, AddressBookVersion, AddressCount)
+# Every shard hands out address ids from its own range so rows keep their id when moved
+ID_SPACE = 2 ** 40
+# Models whose ids are only used within a shard, moved rows get new ones from the target
+RENUMBERED_MODELS = (AddressTombstone, AddressCount)
+
+_current_shard = contextvars.ContextVar('address_book_shard', default=None)
+# user whose placement row the current write_transaction() holds
+_write_locked = contextvars.ContextVar('address_book_write_locked', default=None)
+
+
+class AddressBookMoving(Exception):
+    pass
+
+
+class ShardNotResolved(Exception):
+    pass
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Consistent hash of keys onto aliases, each alias owning ``points`` spots on the ring.
+
+    Adding an alias only takes over keys from its neighbours, so most users
+    keep their shard when the ring grows.
+    """
+
+    def __init__(self, aliases, points):
+        ring = sorted((_hash('%s:%s' % (alias, point)), alias) for alias in aliases for point in range(points))
+        self.aliases = tuple(aliases)
+        self._hashes = [position for position, _ in ring]
+        self._owners = [alias for _, alias in ring]
+
+    def get(self, key):
+        index = bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._owners[index]
+
+
+class ShardMap:
+    """
+    Where each user's address book lives.
+
+    New users are placed by the hash ring and the placement is recorded in
+    ShardPlacement, so changing the ring only affects users once they are
+    moved by rebalance_shards. Lookups are cached per process for
+    ADDRESS_BOOK_SHARD_CACHE_TTL seconds.
+    """
+
+    def __init__(self):
+        self._ring = None
+        self._cache = None
+
+    @property
+    def ring(self):
+        shards = tuple(settings.ADDRESS_BOOK_SHARDS)
+        if self._ring is None or self._ring.aliases != shards:
+            self._ring = HashRing(shards, settings.ADDRESS_BOOK_SHARD_RING_POINTS)
+        return self._ring
+
+    @property
+    def cache(self):
+        if self._cache is None:
+            self._cache = utils.LRUCache(settings.ADDRESS_BOOK_SHARD_CACHE_SIZE, settings.ADDRESS_BOOK_SHARD_CACHE_TTL)
+        return self._cache
+
+    def placement(self, user_id):
+        placement, _ = ShardPlacement.objects.using(DEFAULT_DB_ALIAS).get_or_create(
+            user_id=user_id, defaults={'alias': self.ring.get(user_id)}
+        )
+        self.cache.set(user_id, placement.alias)
+        return placement
+
+    def get(self, user_id):
+        alias = self.cache.get(user_id)
+        if alias is None:
+            alias = self.placement(user_id).alias
+        return alias
+
+    def invalidate(self, user_id):
+        self.cache.delete(user_id)
+
+    def clear(self):
+        self.cache.clear()
+
+
+shard_map = ShardMap()
+
+
+def shard_for_user(user_id):
+    return shard_map.get(user_id)
+
+
+def current_shard():
+    return _current_shard.get()
+
+
+@contextmanager
+def use_shard(alias):
+    token = _current_shard.set(alias)
+    try:
+        yield alias
+    finally:
+        _current_shard.reset(token)
+
+
+@contextmanager
+def for_user(user_id, write=False):
+    """
+    Route address book queries inside the block to the user's shard.
+
+    Writers skip the cached placement and get AddressBookMoving while the
+    address book is being moved to another shard.
+    """
+    if write:
+        placement = shard_map.placement(user_id)
+        if placement.moving:
+            raise AddressBookMoving('Address book of user %s is being moved' % user_id)
+        alias = placement.alias
+    else:
+        alias = shard_for_user(user_id)
+    with use_shard(alias):
+        yield alias
+
+
+@contextmanager
+def write_transaction(user_id):
+    """
+    Transaction on the user's shard that holds their placement row until it ends.
+
+    move_user flags a move through the same row, so it waits for the writes in
+    flight and every later one gets AddressBookMoving. Writers spanning many
+    transactions, like imports and purges, take one per batch. Nested blocks
+    for the same user are savepoints of the outer one.
+    """
+    if _write_locked.get() == user_id:
+        with transaction.atomic(using=current_shard()):
+            yield current_shard()
+        return
+
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        placement, _ = ShardPlacement.objects.using(DEFAULT_DB_ALIAS).select_for_update().get_or_create(
+            user_id=user_id, defaults={'alias': shard_map.ring.get(user_id)}
+        )
+        if placement.moving:
+            raise AddressBookMoving('Address book of user %s is being moved' % user_id)
+        shard_map.cache.set(user_id, placement.alias)
+        token = _write_locked.set(user_id)
+        try:
+            with use_shard(placement.alias), transaction.atomic(using=placement.alias):
+                yield placement.alias
+        finally:
+            _write_locked.reset(token)
+
+
+def reserve_id_range(using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Start the address id sequence of a shard at the beginning of its range.
+    """
+    if using not in settings.ADDRESS_BOOK_SHARDS:
+        return
+    start = settings.ADDRESS_BOOK_SHARDS.index(using) * ID_SPACE
+    if not start:
+        return
+    connection = connections[using]
+    table = Address._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence(%s, 'id'), GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM {})))".format(table),
+                [table, start]
+            )
+        elif connection.vendor == 'sqlite':
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, start])
+            elif row[0] < start:
+                cursor.execute("UPDATE sqlite_sequence SET seq = %s WHERE name = %s", [start, table])
+
+
+def delete_user_data(sender, instance, using=DEFAULT_DB_ALIAS, **kwargs):
+    # the user's own database cascades as usual, rows on other shards are removed here
+    for alias in settings.ADDRESS_BOOK_SHARDS:
+        if alias != using:
+            for model in SHARDED_MODELS:
+                model.objects.using(alias).filter(user_id=instance.pk).delete()
+
+
+def _copy_rows(model, source, target, user_id, batch_size):
+    fields = model._meta.local_concrete_fields
+    if model in RENUMBERED_MODELS:
+        fields = [field for field in fields if not field.primary_key]
+    query_set = model.objects.using(source).filter(user_id=user_id).order_by('pk')
+    last = None
+    while True:
+        batch_set = query_set if last is None else query_set.filter(pk__gt=last)
+        rows = list(batch_set[:batch_size])
+        if not rows:
+            return
+        # raw inserts keep ids and auto_now timestamps as they are, like loaddata
+        model._base_manager._insert(rows, fields=fields, using=target, raw=True)
+        last = rows[-1].pk
+
+
+def _delete_rows(model, alias, user_id, batch_size):
+    query_set = model.objects.using(alias).filter(user_id=user_id)
+    while True:
+        pks = list(query_set.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        model.objects.using(alias).filter(pk__in=pks).delete()
+
+
+def _copy_late_writes(source, target, user_id, version):
+    """
+    Copy address changes made on the source after the copy of ``version`` was
+    taken and return how many there were.
+
+    Writers go through write_transaction(), which refuses them once the move
+    is flagged, so this only finds writes of code that bypassed it.
+    """
+    changed = list(Address.objects.using(source).filter(user_id=user_id, change_version__gt=version))
+    deleted = list(AddressTombstone.objects.using(source).filter(user_id=user_id, change_version__gt=version))
+    if not changed and not deleted:
+        return 0
+    with transaction.atomic(using=target):
+        if changed:
+            Address.objects.using(target).filter(pk__in=[address.pk for address in changed]).delete()
+            Address._base_manager._insert(changed, fields=Address._meta.local_concrete_fields, using=target, raw=True)
+        if deleted:
+            Address.objects.using(target).filter(pk__in=[tombstone.address_id for tombstone in deleted]).delete()
+            fields = [field for field in AddressTombstone._meta.local_concrete_fields if not field.primary_key]
+            AddressTombstone._base_manager._insert(deleted, fields=fields, using=target, raw=True)
+        newest = max(row.change_version for row in changed + deleted)
+        AddressBookVersion.objects.using(target).get_or_create(user_id=user_id)
+        AddressBookVersion.objects.using(target).filter(user_id=user_id, version__lt=newest).update(version=newest)
+        stats.recount_user(user_id, target)
+    return len(changed) + len(deleted)
+
+
+def move_user(user_id, target, batch_size=None, grace=None):
+    """
+    Move a user's address book to the ``target`` shard while it stays readable.
+
+    Flagging the move waits for the user's writes in flight and refuses new
+    ones while the rows are copied. The placement is then switched, and the
+    old rows are deleted after ``grace`` seconds, once cached lookups of the
+    old placement expired, with anything written there meanwhile copied over
+    first. The user's share of the shard-wide address counts moves along.
+    """
+    batch_size = batch_size or settings.ADDRESS_BOOK_BULK_BATCH_SIZE
+    grace = settings.ADDRESS_BOOK_SHARD_CACHE_TTL if grace is None else grace
+    placement = shard_map.placement(user_id)
+    source = placement.alias
+    if source == target:
+        if placement.moving:
+            ShardPlacement.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_id).update(moving=False)
+        return False
+
+    # blocks until write transactions holding the placement row are done
+    ShardPlacement.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_id).update(moving=True)
+    shard_map.invalidate(user_id)
+
+    version = AddressBookVersion.objects.using(source).filter(user_id=user_id).values_list('version', flat=True).first() or 0
+    with transaction.atomic(using=target):
+        # leftovers of an interrupted move, their counts included
+        stats.shift_totals(user_id, target, -1)
+        for model in SHARDED_MODELS:
+            model.objects.using(target).filter(user_id=user_id).delete()
+            _copy_rows(model, source, target, user_id, batch_size)
+        # the shard-wide address counts follow the user
+        stats.shift_totals(user_id, target, 1)
+    ShardPlacement.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_id).update(alias=target, moving=False)
+    shard_map.invalidate(user_id)
+
+    time.sleep(grace)
+    _copy_late_writes(source, target, user_id, version)
+    with transaction.atomic(using=source):
+        stats.shift_totals(user_id, source, -1)
+        AddressCount.objects.using(source).filter(user_id=user_id).delete()
+    for model in SHARDED_MODELS:
+        _delete_rows(model, source, user_id, batch_size)
+    return True
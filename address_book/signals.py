@@ -0,0 +1,8 @@
+from django.dispatch import Signal
+
+# Sent by every address write path, including the bulk ones, inside the
+# transaction doing the write. Rows are dicts of ADDRESS_ROW_FIELDS:
+#   created - rows inserted
+#   updated - (old row, new row) pairs
+#   deleted - rows removed
+addresses_changed = Signal()
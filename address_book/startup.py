@@ -0,0 +1,56 @@
+"""
+Boot cost of a worker, measured by startup_report in a fresh interpreter.
+
+Only the standard library is imported at module level so that the
+measurement starts before Django is loaded.
+"""
+import json
+import resource
+import sys
+import time
+
+
+def measure():
+    """
+    Load Django the way a WSGI worker does and print the time spent in each step as JSON.
+    """
+    timings = {}
+    started = previous = time.perf_counter()
+    modules = len(sys.modules)
+
+    def step(name):
+        nonlocal previous
+        now = time.perf_counter()
+        timings[name] = round((now - previous) * 1000, 2)
+        previous = now
+
+    from django.conf import settings
+    settings.INSTALLED_APPS
+    step('settings_ms')
+
+    import django
+    django.setup(set_prefix=False)
+    step('apps_ms')
+
+    from django.core.handlers.wsgi import WSGIHandler
+    WSGIHandler()
+    step('middleware_ms')
+
+    from django.urls import get_resolver
+    get_resolver().url_patterns
+    step('urls_ms')
+
+    timings['total_ms'] = round((previous - started) * 1000, 2)
+    report = {
+        **timings,
+        'settings': settings.SETTINGS_MODULE,
+        'installed_apps': len(settings.INSTALLED_APPS),
+        'modules': len(sys.modules) - modules,
+        # kilobytes on Linux
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    sys.stdout.write(json.dumps(report))
+
+
+if __name__ == '__main__':
+    measure()
@@ -0,0 +1,138 @@
+from collections import Counter, defaultdict
+
+from django.apps import apps as global_apps
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connections, router, transaction
+from django.db.models import Count, F
+
+from . import sharding
+from .models import Address, AddressCount
+
+STATS_KINDS = (AddressCount.COUNTRY, AddressCount.CITY)
+
+
+def count_keys(row):
+    # every address counts for its user and for the shard-wide totals
+    for user_id in (row['user_id'], None):
+        yield user_id, AddressCount.COUNTRY, row['country'], ''
+        yield user_id, AddressCount.CITY, row['country'], row['city']
+
+
+def record_changes(sender, created=(), updated=(), deleted=(), **kwargs):
+    """
+    Apply the changes to the per user and shard-wide address counts.
+    """
+    deltas = defaultdict(Counter)
+    for row in created:
+        deltas[row['user_id']].update(count_keys(row))
+    for old, new in updated:
+        if (old['country'], old['city']) != (new['country'], new['city']):
+            deltas[old['user_id']].subtract(count_keys(old))
+            deltas[new['user_id']].update(count_keys(new))
+    for row in deleted:
+        deltas[row['user_id']].subtract(count_keys(row))
+
+    for user_id in sorted(deltas):
+        with sharding.for_user(user_id):
+            apply_deltas(deltas[user_id])
+
+
+def apply_deltas(deltas):
+    db = router.db_for_write(AddressCount)
+    for (user_id, kind, country, city), delta in sorted(deltas.items(), key=lambda item: item[0][1:]):
+        if not delta:
+            continue
+        query_set = AddressCount.objects.filter(user_id=user_id, kind=kind, country=country, city=city)
+        if query_set.update(count=F('count') + delta):
+            continue
+        try:
+            with transaction.atomic(using=db):
+                AddressCount.objects.create(user_id=user_id, kind=kind, country=country, city=city, count=delta)
+        except IntegrityError:
+            # inserted by a concurrent request in the meantime
+            query_set.update(count=F('count') + delta)
+
+
+def shift_totals(user_id, using, sign):
+    """
+    Add the user's counts on the ``using`` shard to its shard-wide totals, or
+    take them out with a ``sign`` of -1.
+    """
+    with sharding.use_shard(using):
+        rows = AddressCount.objects.filter(user_id=user_id).values_list('kind', 'country', 'city', 'count')
+        apply_deltas({(None, kind, country, city): sign * count for kind, country, city, count in rows})
+
+
+def recount_user(user_id, using):
+    """
+    Recompute the user's counts on the ``using`` shard from their addresses,
+    the shard-wide totals follow.
+    """
+    with transaction.atomic(using=using):
+        shift_totals(user_id, using, -1)
+        AddressCount.objects.using(using).filter(user_id=user_id).delete()
+        addresses = Address.objects.using(using).filter(user_id=user_id).order_by()
+        counts = [
+            AddressCount(user_id=user_id, kind=kind, **row)
+            for kind, fields in ((AddressCount.COUNTRY, ('country',)), (AddressCount.CITY, ('country', 'city')))
+            for row in addresses.values(*fields).annotate(count=Count('id'))
+        ]
+        AddressCount.objects.using(using).bulk_create(counts, batch_size=settings.ADDRESS_BOOK_BULK_BATCH_SIZE)
+        shift_totals(user_id, using, 1)
+
+
+def forget_user(sender, instance, **kwargs):
+    # deleting a user drops their rows without addresses_changed, take them out of the totals
+    with sharding.for_user(instance.pk) as alias:
+        shift_totals(instance.pk, alias, -1)
+
+
+def get_counts(kind, user_id=None, country=None, limit=None):
+    """
+    Return the largest ``limit`` counts of the kind for one user, or over all
+    users when ``user_id`` is None.
+    """
+    limit = limit or settings.ADDRESS_BOOK_STATS_MAX_LIMIT
+    fields = ('country', 'city') if kind == AddressCount.CITY else ('country',)
+    query_set = AddressCount.objects.filter(user_id=user_id, kind=kind, count__gt=0).order_by('-count', *fields)
+    if country is not None:
+        query_set = query_set.filter(country=country)
+
+    if user_id is not None:
+        with sharding.for_user(user_id):
+            return list(query_set.values(*fields, 'count')[:limit])
+
+    # every shard keeps its own totals, sum them up
+    totals = Counter()
+    for alias in settings.ADDRESS_BOOK_SHARDS:
+        rows = query_set.using(alias).values_list(*fields, 'count')
+        if len(settings.ADDRESS_BOOK_SHARDS) == 1:
+            rows = rows[:limit]
+        for *key, count in rows:
+            totals[tuple(key)] += count
+    ordered = sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    return [{**dict(zip(fields, key)), 'count': count} for key, count in ordered]
+
+
+def rebuild_counts(using=DEFAULT_DB_ALIAS, apps=global_apps):
+    """
+    Recompute every address count of a shard from its address table.
+    """
+    address_model = apps.get_model('address_book', 'Address')
+    count_model = apps.get_model('address_book', 'AddressCount')
+    connection = connections[using]
+    with transaction.atomic(using=using):
+        # block writers so that no change is counted twice or lost
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('LOCK TABLE %s IN SHARE MODE' % connection.ops.quote_name(address_model._meta.db_table))
+        count_model.objects.using(using).all().delete()
+
+        counts = []
+        addresses = address_model.objects.using(using).exclude(user=None).order_by()
+        for kind, fields in ((AddressCount.COUNTRY, ('country',)), (AddressCount.CITY, ('country', 'city'))):
+            for group in (('user_id', *fields), fields):
+                for row in addresses.values(*group).annotate(count=Count('id')):
+                    counts.append(count_model(kind=kind, **row))
+        count_model.objects.using(using).bulk_create(counts, batch_size=settings.ADDRESS_BOOK_BULK_BATCH_SIZE)
+    return len(counts)
@@ -0,0 +1,125 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from . import sharding
+from .caching import bump_version
+from .models import Address, AddressBookVersion, AddressTombstone
+
+
+class ResyncRequired(Exception):
+    pass
+
+
+def record_changes(sender, created=(), updated=(), deleted=(), **kwargs):
+    """
+    Move every touched address book to a new version, stamp changed rows with
+    it and leave tombstones for deleted ones.
+    """
+    changed = defaultdict(list)
+    removed = defaultdict(list)
+    for row in created:
+        changed[row['user_id']].append(row['id'])
+    for old, new in updated:
+        changed[new['user_id']].append(new['id'])
+    for row in deleted:
+        removed[row['user_id']].append(row['id'])
+
+    now = timezone.now()
+    for user_id in sorted(set(changed) | set(removed)):
+        with sharding.for_user(user_id):
+            version = bump_version(user_id)
+            if changed[user_id]:
+                Address.objects.filter(pk__in=changed[user_id]).update(change_version=version, modified=now)
+            if removed[user_id]:
+                AddressTombstone.objects.bulk_create([
+                    AddressTombstone(user_id=user_id, address_id=pk, change_version=version)
+                    for pk in removed[user_id]
+                ])
+
+
+# Position before any change, a client without a cursor starts here
+START = (-1, 0)
+MAX_ID = 2 ** 63 - 1
+
+
+def parse_cursor(value):
+    """
+    Turn a "<version>:<id>" cursor into a position, a bare version stands for
+    everything up to and including that version.
+    """
+    version, _, pk = value.partition(':')
+    return int(version), int(pk) if pk else MAX_ID
+
+
+def format_cursor(position):
+    return '%s:%s' % position
+
+
+def get_changes(user, since, limit, fields):
+    """
+    Return up to ``limit`` changes after the ``since`` position in
+    ``(change_version, id)`` order, merged from live rows and tombstones.
+
+    Raises ResyncRequired when tombstones the client has not seen were pruned.
+    """
+    version, pk = since
+    after = Q(change_version__gt=version) | Q(change_version=version, id__gt=pk)
+    rows = list(
+        Address.objects.filter(after, user=user).order_by('change_version', 'id')
+        .values('change_version', *fields)[:limit + 1]
+    )
+    changes = [((row.pop('change_version'), row['id']), row) for row in rows]
+
+    # a client syncing from scratch has nothing to delete
+    if version >= 0:
+        after = Q(change_version__gt=version) | Q(change_version=version, address_id__gt=pk)
+        tombstones = (
+            AddressTombstone.objects.filter(after, user=user).order_by('change_version', 'address_id')
+            .values_list('change_version', 'address_id')[:limit + 1]
+        )
+        changes.extend(((change_version, address_id), None) for change_version, address_id in tombstones)
+        changes.sort(key=lambda change: change[0])
+        # read after the tombstones, so a prune running meanwhile is noticed
+        pruned = AddressBookVersion.objects.filter(user=user).values_list('pruned_version', flat=True).first()
+        if version < (pruned or 0):
+            raise ResyncRequired('Changes since version %s are no longer kept' % version)
+
+    page = changes[:limit]
+    return {
+        'changed': [row for _, row in page if row is not None],
+        'deleted': [position[1] for position, row in page if row is None],
+        'cursor': format_cursor(page[-1][0] if page else since),
+        'has_more': len(changes) > limit,
+    }
+
+
+def prune_tombstones(retention=None):
+    """
+    Delete tombstones older than ``retention`` seconds on every shard and
+    return how many were removed.
+
+    Each user's pruned_version moves up to the newest version pruned in the
+    same transaction, so clients whose cursor is older get ResyncRequired
+    instead of silently missing deletions.
+    """
+    retention = settings.ADDRESS_BOOK_TOMBSTONE_RETENTION if retention is None else retention
+    cutoff = timezone.now() - timedelta(seconds=retention)
+    deleted = 0
+    for alias in settings.ADDRESS_BOOK_SHARDS:
+        expired = (
+            AddressTombstone.objects.using(alias).filter(deleted__lt=cutoff)
+            .values_list('user_id').annotate(version=Max('change_version')).order_by()
+        )
+        for user_id, version in list(expired):
+            with transaction.atomic(using=alias):
+                book, _ = AddressBookVersion.objects.using(alias).select_for_update().get_or_create(user_id=user_id)
+                if book.pruned_version < version:
+                    book.pruned_version = version
+                    book.save(update_fields=['pruned_version'])
+                deleted += AddressTombstone.objects.using(alias).filter(user_id=user_id, change_version__lte=version).delete()[0]
+    return deleted
@@ -1,15 +1,51 @@
-from django.test import TestCase
+from contextlib import ExitStack, contextmanager
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
-from .models import Address
+from rest_framework.renderers import JSONRenderer
+from django.db import connections, router, transaction
+from django.utils import timezone
+from . import jobs, metrics, routers, sharding, signals, stats
+from .authentication import TokenCache, issue_token, token_cache
+from .async_views import AsyncStreamingHttpResponse, async_view, db_pool
+from .autocomplete import autocomplete_index
+from .caching import bump_version, get_version, response_cache
+from .fingerprint import address_fingerprint
+from .geo import GridIndex, distance_km
+from .management.commands.benchmark_api import Command as BenchmarkCommand
+from .models import Address, AddressBookVersion, AddressCount, AddressTombstone, Job, ShardPlacement
+from .serializers import AddressSerializer
+from .utils import LRUCache, _insert_address_rows, bulk_insert_addresses
 from faker import Faker
+import csv
+import io
+import json
+import os
 import random
+import tempfile
+import threading
+from datetime import timedelta
 
 
 class AddressAPITestCase(TestCase):
+    databases = '__all__'
 
     def setUp(self):
+        for histogram in metrics.HISTOGRAMS:
+            histogram.clear()
+        response_cache.clear()
+        cache.clear()
+        sharding.shard_map.clear()
         self.username = 'testuser'
         self.username_alt = 'testuser1'
         self.password = '12345'
@@ -37,6 +73,16 @@ class AddressAPITestCase(TestCase):
             }
             Address.objects.create(**data)
 
+    @contextmanager
+    def assertNumQueriesOnAllShards(self, num):
+        # address book queries run on the user's shard, which is not always the default database
+        with ExitStack() as stack:
+            contexts = [
+                stack.enter_context(CaptureQueriesContext(connections[alias])) for alias in settings.ADDRESS_BOOK_SHARDS
+            ]
+            yield
+        self.assertEqual(sum(len(context) for context in contexts), num)
+
     # User is able to authenticate with a username and a password
     def testRetrievingToken(self):
         # make sure that user have no token assigned
@@ -65,6 +111,57 @@ class AddressAPITestCase(TestCase):
         self.assertEqual(response.data,{'success': 'Sucessfully logged out'})
         self.assertTrue(Token.objects.filter(user=self.user).first() is None)
 
+    # Logins reuse a valid token, tokens expire unless used and expired ones are swept
+    def testTokenReuseAndExpiry(self):
+        data = {'username': self.username, 'password': self.password}
+        response = self.client.post("/api/auth/login", data=data, format="json")
+        token = response.data['auth_token']
+        # the user lookup and the token upsert inside the request savepoint
+        with self.assertNumQueries(4):
+            response = self.client.post("/api/auth/login", data=data, format="json")
+        self.assertEqual(response.data['auth_token'], token)
+
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token)
+        hours_ago = timezone.now() - timedelta(hours=2)
+        Token.objects.filter(key=token).update(created=hours_ago)
+        response = self.client.get("/api/addresses", format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(Token.objects.get(key=token).created, hours_ago)
+
+        with self.settings(ADDRESS_BOOK_TOKEN_TTL=3600):
+            Token.objects.filter(key=token).update(created=hours_ago)
+            response = self.client.post("/api/auth/login", data=data, format="json")
+            self.assertNotEqual(response.data['auth_token'], token)
+
+        # workers sharing their token cache see revocations right away
+        with self.settings(ADDRESS_BOOK_TOKEN_TTL=3600, ADDRESS_BOOK_TOKEN_CACHE_ALIAS='shared'):
+            Token.objects.update(created=hours_ago)
+            alt_token = Token.objects.create(user=self.user_alt)
+            # as cached by another worker process
+            other_cache = TokenCache()
+            swept = Token.objects.get(user=self.user)
+            other_cache.set(swept.key, (self.user, swept))
+            out = io.StringIO()
+            call_command('sweep_expired_tokens', batch_size=1, stdout=out)
+            self.assertEqual(out.getvalue().strip(), 'Deleted 1 expired tokens')
+            self.assertEqual(list(Token.objects.values_list('key', flat=True)), [alt_token.key])
+            self.assertIsNone(other_cache.get(swept.key))
+
+        with self.settings(ADDRESS_BOOK_TOKEN_REUSE=False, ADDRESS_BOOK_TOKEN_CACHE_ALIAS='shared'):
+            replaced = issue_token(self.user_alt)
+            other_cache.set(replaced.key, (self.user_alt, replaced))
+            self.assertNotEqual(issue_token(self.user_alt).key, replaced.key)
+            self.assertIsNone(other_cache.get(replaced.key))
+
+        with self.settings(ADDRESS_BOOK_TOKEN_TTL=3600):
+            alt_token = Token.objects.get(user=self.user_alt)
+
+            # the failed request marks the test transaction for rollback, keep it last
+            Token.objects.filter(key=alt_token.key).update(created=hours_ago)
+            self.client.credentials(HTTP_AUTHORIZATION='Token ' + alt_token.key)
+            response = self.client.get("/api/addresses", format="json")
+            self.assertEqual(response.status_code, 401)
+
     # User is able to create a new address
     # User will not be able to add a duplicated address to their account
     def testUserAbilityToCreateNewAdressEndpoint(self):
@@ -89,7 +186,7 @@ class AddressAPITestCase(TestCase):
         self.assertEqual(response.data, {'error': 'User already have this address'})
         
         self.assertEqual(self.user.addresses.count(), 1)
-        self.assertEqual(Address.objects.all().count(), 1)
+        self.assertEqual(Address.objects.filter(user=self.user).count(), 1)
 
     # User is able to retrieve all their postal addresses
     def testUserAbilityToRetrieveAdressesEndpoint(self):
@@ -223,3 +320,1094 @@ class AddressAPITestCase(TestCase):
         url = "/api/addresses/delete_multiple?ids=%s" % ','.join([str(x) for x in ids])
         response = self.client.delete(url, format="json")
         self.assertEqual(1, self.user.addresses.count())
+
+    # User is able to create many addresses at once and gets a result per item
+    def testUserAbilityToBulkCreateAddressesEndpoint(self):
+        Address.objects.create(user=self.user, street='Dluga', city='Gdansk', postcode='111-93', country='Poland')
+        self.authenticate_client(self.username, self.password)
+
+        data = [{
+            "street": '133-137 Fetter Ln',
+            "city": 'London',
+            "postcode": 'EC4A 2BB',
+            "country": 'United Kingdom'
+        }, {
+            "street": 'Dluga',
+            "city": 'Gdansk',
+            "postcode": '111-93',
+            "country": 'Poland'
+        }, {
+            "street": '133-137 Fetter Ln',
+            "city": 'London',
+            "postcode": 'EC4A 2BB',
+            "country": 'United Kingdom'
+        }, {
+            "street": 'Rope street',
+            "city": 'London'
+        }]
+        response = self.client.post("/api/addresses/bulk", data=data, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['created'], 1)
+        self.assertEqual(response.data['duplicate'], 2)
+        self.assertEqual(response.data['invalid'], 1)
+        self.assertEqual([x['status'] for x in response.data['results']], ['created', 'duplicate', 'duplicate', 'invalid'])
+
+        created = self.user.addresses.get(street='133-137 Fetter Ln')
+        self.assertEqual(response.data['results'][0]['id'], created.id)
+        self.assertEqual(self.user.addresses.count(), 2)
+
+        # other users are not affected by this user's addresses
+        self.assertEqual(self.user_alt.addresses.count(), 0)
+
+    # Deleting addresses in the request commits chunk by chunk, a failure keeps the chunks already deleted
+    @override_settings(ADDRESS_BOOK_DELETE_BATCH_SIZE=2)
+    def testDeleteMultipleCommitsEveryChunk(self):
+        def fail_second_chunk(sender, deleted=(), **kwargs):
+            if deleted:
+                sent.append(deleted)
+                if len(sent) == 2:
+                    raise RuntimeError('chunk failed')
+
+        self.create_sample_addresses(self.user, 4)
+        ids = list(self.user.addresses.order_by('pk').values_list('pk', flat=True))
+        self.authenticate_client(self.username, self.password)
+        sent = []
+        signals.addresses_changed.connect(fail_second_chunk, dispatch_uid='test.delete_chunks')
+        try:
+            with self.assertRaises(RuntimeError):
+                self.client.delete("/api/addresses/delete_multiple?ids=%s" % ','.join(map(str, ids)), format="json")
+        finally:
+            signals.addresses_changed.disconnect(dispatch_uid='test.delete_chunks')
+        self.assertEqual(list(self.user.addresses.order_by('pk').values_list('pk', flat=True)), ids[2:])
+
+    # Deleting a large address book is handed off to a background purge job
+    @override_settings(ADDRESS_BOOK_PURGE_ASYNC_THRESHOLD=5, ADDRESS_BOOK_DELETE_BATCH_SIZE=2, ADDRESS_BOOK_JOBS_EAGER=True)
+    def testUserAbilityToPurgeAddressBookEndpoint(self):
+        self.create_sample_addresses(self.user, 7)
+        self.create_sample_addresses(self.user_alt, 3)
+        self.authenticate_client(self.username, self.password)
+
+        response = self.client.delete("/api/addresses/delete_multiple", format="json")
+        self.assertEqual(response.status_code, 202)
+        job = Job.objects.get(pk=response.data['job'])
+        self.assertEqual(job.status, Job.DONE)
+        self.assertEqual(job.result, {'deleted': 7})
+        self.assertEqual(self.user.addresses.count(), 0)
+        self.assertEqual(self.user_alt.addresses.count(), 3)
+
+        response = self.client.get("/api/jobs/%s" % job.pk, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['status'], Job.DONE)
+
+        # jobs are private to their owner
+        self.client = APIClient()
+        self.authenticate_client(self.username_alt, self.password_alt)
+        response = self.client.get("/api/jobs/%s" % job.pk, format="json")
+        self.assertEqual(response.status_code, 404)
+
+    # A queued purge leaves the addresses written after it was asked for alone
+    @override_settings(ADDRESS_BOOK_PURGE_ASYNC_THRESHOLD=5, ADDRESS_BOOK_JOBS_BACKEND='worker')
+    def testPurgeJobKeepsAddressesCreatedAfterSubmit(self):
+        self.create_sample_addresses(self.user, 7)
+        self.authenticate_client(self.username, self.password)
+
+        response = self.client.delete("/api/addresses/delete_multiple", format="json")
+        self.assertEqual(response.status_code, 202)
+        data = {"street": 'Rope street', "city": 'London', "postcode": 'SE16 7FJ', "country": 'United Kingdom'}
+        created = self.client.post("/api/addresses", data=data, format="json").data
+
+        job = jobs.run(response.data['job'])
+        self.assertEqual(job.result, {'deleted': 7})
+        self.assertEqual(list(self.user.addresses.values_list('pk', flat=True)), [created['id']])
+
+    # A claimed job whose worker stopped reporting is picked up again by the next look at the queue
+    @override_settings(ADDRESS_BOOK_JOBS_BACKEND='worker')
+    def testStaleJobIsRequeued(self):
+        self.create_sample_addresses(self.user, 3)
+        job = jobs.submit(self.user, 'purge_addresses')
+        self.assertTrue(jobs.claim(job.pk))
+        self.assertEqual(jobs.next_jobs(1), [])
+
+        Job.objects.filter(pk=job.pk).update(updated=timezone.now() - timedelta(seconds=settings.ADDRESS_BOOK_JOBS_STALE_SECONDS + 1))
+        with self.assertLogs('address_book.jobs', level='WARNING'):
+            self.assertEqual(jobs.next_jobs(1), [job.pk])
+        self.assertEqual(jobs.run(job.pk).result, {'deleted': 3})
+
+    # User is able to walk their addresses with cursor pagination
+    def testUserAbilityToRetrieveAddressesWithCursorEndpoint(self):
+        self.create_sample_addresses(self.user, 5)
+        self.create_sample_addresses(self.user_alt, 4)
+        self.authenticate_client(self.username, self.password)
+
+        seen = []
+        url = "/api/addresses?pagination=cursor&page_size=2"
+        while url:
+            response = self.client.get(url, format="json")
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('count', response.data)
+            seen.extend(x['id'] for x in response.data['results'])
+            url = response.data['next']
+
+        expected = list(self.user.addresses.order_by('id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+        # ordering by a non unique column keeps every row exactly once
+        response = self.client.get("/api/addresses?pagination=cursor&ordering=-country&page_size=100", format="json")
+        countries = [x['country'] for x in response.data['results']]
+        self.assertEqual(countries, sorted(countries, reverse=True))
+        self.assertEqual(len(countries), 5)
+
+    # Cursor pages keep going through any number of rows sharing the ordering value
+    def testCursorPaginationWalksRowsSharingAValue(self):
+        shard = sharding.shard_for_user(self.user.pk)
+        Address.objects.using(shard).bulk_create([
+            Address(user=self.user, street='Rope street %s' % index, city='London', postcode='SE16 7FJ', country='United Kingdom',
+                    fingerprint=address_fingerprint('Rope street %s' % index, 'London', 'United Kingdom'))
+            for index in range(1300)
+        ])
+        self.create_sample_addresses(self.user, 3)
+        self.authenticate_client(self.username, self.password)
+        expected = list(self.user.addresses.order_by('-city', '-id').values_list('id', flat=True))
+
+        seen = []
+        pages = []
+        url = "/api/addresses?pagination=cursor&ordering=-city&page_size=100"
+        while url:
+            response = self.client.get(url, format="json")
+            self.assertEqual(response.status_code, 200)
+            seen.extend(x['id'] for x in response.data['results'])
+            pages.append(response.data)
+            url = response.data['next']
+            self.assertLess(len(pages), 20)
+        self.assertEqual(seen, expected)
+
+        # previous links lead back to the page before
+        response = self.client.get(pages[-1]['previous'], format="json")
+        self.assertEqual(response.data['results'], pages[-2]['results'])
+        self.assertIsNone(pages[0]['previous'])
+
+        response = self.client.get("/api/addresses?pagination=cursor&cursor=bm9wZQ", format="json")
+        self.assertEqual(response.status_code, 404)
+
+    # Authenticated tokens are served from cache and logging out revokes them right away
+    def testTokenAuthenticationCache(self):
+        token_cache.clear()
+        self.create_sample_addresses(self.user, 1)
+        address = self.user.addresses.first()
+        self.authenticate_client(self.username, self.password)
+
+        url = "/api/addresses/%s" % address.id
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(token_cache.stats()['misses'], 1)
+
+        # token and user come from cache, only the address book version is read
+        with self.assertNumQueriesOnAllShards(1):
+            response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(token_cache.stats()['hits'], 1)
+
+        response = self.client.post("/api/auth/logout", format="json")
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get(url, format="json")
+        self.assertEqual(response.status_code, 401)
+
+    # With a shared token cache a token revoked through one worker is not served by another
+    @override_settings(ADDRESS_BOOK_TOKEN_CACHE_ALIAS='shared')
+    def testTokenRevocationReachesEveryCache(self):
+        token = Token.objects.create(user=self.user)
+        first, second = TokenCache(), TokenCache()
+        first.set(token.key, (self.user, token))
+        self.assertIsNotNone(second.get(token.key))
+
+        first.invalidate(token.key)
+        self.assertIsNone(second.get(token.key))
+
+    # User is able to export their whole address book as NDJSON or CSV
+    @override_settings(ADDRESS_BOOK_EXPORT_BATCH_SIZE=2)
+    def testUserAbilityToExportAddressesEndpoint(self):
+        self.create_sample_addresses(self.user, 5)
+        self.create_sample_addresses(self.user_alt, 2)
+        self.authenticate_client(self.username, self.password)
+        expected = list(self.user.addresses.order_by('id').values('id', 'street', 'city', 'postcode', 'country'))
+
+        response = self.client.get("/api/addresses/export", format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], expected)
+
+        response = self.client.get("/api/addresses/export?output=csv")
+        self.assertEqual(response.status_code, 200)
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([int(row['id']) for row in rows], [x['id'] for x in expected])
+        self.assertEqual(rows[0]['street'], expected[0]['street'])
+
+        response = self.client.get("/api/addresses/export?output=xml")
+        self.assertEqual(response.status_code, 400)
+
+    # User is able to export their address book in the background and download the file
+    def testUserAbilityToExportAddressesAsJobEndpoint(self):
+        self.create_sample_addresses(self.user, 5)
+        self.create_sample_addresses(self.user_alt, 2)
+        self.authenticate_client(self.username, self.password)
+        expected = list(self.user.addresses.order_by('id').values('id', 'street', 'city', 'postcode', 'country'))
+
+        with tempfile.TemporaryDirectory() as export_dir, self.settings(ADDRESS_BOOK_EXPORT_DIR=export_dir, ADDRESS_BOOK_EXPORT_BATCH_SIZE=2):
+            with self.settings(ADDRESS_BOOK_JOBS_EAGER=True):
+                response = self.client.post("/api/addresses/export", format="json")
+            self.assertEqual(response.status_code, 202)
+            response = self.client.get("/api/jobs/%s" % response.data['job'], format="json")
+            self.assertEqual(response.data['status'], Job.DONE)
+            self.assertEqual((response.data['processed'], response.data['total']), (5, 5))
+
+            response = self.client.get("/api/jobs/%s/download" % response.data['id'])
+            self.assertEqual(response.status_code, 200)
+            lines = b''.join(response.streaming_content).decode().splitlines()
+            self.assertEqual([json.loads(line) for line in lines], expected)
+
+            # with the worker backend the job waits for run_job_worker
+            with self.settings(ADDRESS_BOOK_JOBS_BACKEND='worker'):
+                response = self.client.post("/api/addresses/export?output=csv", format="json")
+            job = Job.objects.get(pk=response.data['job'])
+            self.assertEqual(job.status, Job.QUEUED)
+            response = self.client.get("/api/jobs/%s/download" % job.pk)
+            self.assertEqual(response.status_code, 404)
+
+            call_command('run_job_worker', processes=0, once=True, stdout=io.StringIO())
+            job.refresh_from_db()
+            self.assertEqual(job.status, Job.DONE)
+            response = self.client.get("/api/jobs/%s/download" % job.pk)
+            rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+            self.assertEqual([int(row['id']) for row in rows], [x['id'] for x in expected])
+
+    # User is able to import a CSV file, duplicates and broken rows are counted
+    @override_settings(ADDRESS_BOOK_IMPORT_BATCH_SIZE=2)
+    def testUserAbilityToImportAddressesEndpoint(self):
+        Address.objects.create(user=self.user, street='Dluga', city='Gdansk', postcode='111-93', country='Poland')
+        self.authenticate_client(self.username, self.password)
+
+        content = (
+            'street,city,postcode,country\n'
+            'Rope street,London,SE16 7FJ,United Kingdom\n'
+            'Dluga,Gdansk,111-93,Poland\n'
+            '133-137  Fetter Ln ,London,EC4A 2BB,United Kingdom\n'
+            '133-137 Fetter Ln,London,EC4A 2BB,United Kingdom\n'
+            'Missing,,,\n'
+        )
+        upload = SimpleUploadedFile('addresses.csv', content.encode(), content_type='text/csv')
+        response = self.client.post("/api/addresses/import", data={'file': upload}, format="multipart")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['rows'], 5)
+        self.assertEqual(response.data['inserted'], 2)
+        self.assertEqual(response.data['duplicate'], 2)
+        self.assertEqual(response.data['rejected'], 1)
+        self.assertEqual(self.user.addresses.count(), 3)
+        self.assertTrue(self.user.addresses.filter(street='133-137 Fetter Ln').exists())
+
+    # Imports commit every batch on its own rather than holding one transaction for the whole file
+    @override_settings(ADDRESS_BOOK_IMPORT_BATCH_SIZE=2)
+    def testImportCommitsInBatches(self):
+        self.authenticate_client(self.username, self.password)
+        shard = sharding.shard_for_user(self.user.pk)
+        outside = list(connections[shard].savepoint_ids)
+        transactions = []
+
+        def record(sender, created=(), **kwargs):
+            transactions.append(list(connections[shard].savepoint_ids))
+
+        signals.addresses_changed.connect(record, dispatch_uid='test.import')
+        self.addCleanup(signals.addresses_changed.disconnect, dispatch_uid='test.import')
+        content = ''.join('{"street": "Street %s", "city": "London", "postcode": "E1", "country": "UK"}\n' % index for index in range(5))
+        upload = SimpleUploadedFile('addresses.ndjson', content.encode())
+        response = self.client.post("/api/addresses/import", data={'file': upload}, format="multipart")
+        self.assertEqual(response.data['inserted'], 5)
+        # under the test's own transaction every batch is a savepoint right below it
+        self.assertEqual(len(transactions), 3)
+        self.assertEqual([savepoints[:-1] for savepoints in transactions], [outside] * 3)
+        self.assertEqual(len({savepoints[-1] for savepoints in transactions}), 3)
+
+    # User is able to search their addresses with free text, best matches first
+    def testUserAbilityToSearchAddressesEndpoint(self):
+        data = [{
+            "street": 'Rope street',
+            "city": 'London',
+            "postcode": 'SE16 7FJ',
+            "country": 'United Kingdom'
+        }, {
+            "street": '133-137 Fetter Ln',
+            "city": 'London',
+            "postcode": 'EC4A 2BB',
+            "country": 'United Kingdom'
+        }, {
+            "street": 'Dluga',
+            "city": 'Gdansk',
+            "postcode": '111-93',
+            "country": 'Poland'
+        }]
+        for entry in data:
+            Address.objects.create(user=self.user, **entry)
+        Address.objects.create(user=self.user_alt, **data[1])
+        self.authenticate_client(self.username, self.password)
+
+        response = self.client.get("/api/addresses?q=etter", format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([x['street'] for x in response.data['results']], ['133-137 Fetter Ln'])
+
+        response = self.client.get("/api/addresses?q=london kingdom", format="json")
+        self.assertEqual(response.data['count'], 2)
+
+        # short terms fall back to a plain contains match
+        response = self.client.get("/api/addresses?q=ec4a 2b", format="json")
+        self.assertEqual([x['postcode'] for x in response.data['results']], ['EC4A 2BB'])
+
+        # the index follows updates and deletes, writes bypassing the API bump the version themselves
+        Address.objects.filter(user=self.user, street='Dluga').update(city='Sopot')
+        bump_version(self.user.pk)
+        response = self.client.get("/api/addresses?q=gdansk", format="json")
+        self.assertEqual(response.data['count'], 0)
+        response = self.client.get("/api/addresses?q=sopot", format="json")
+        self.assertEqual(response.data['count'], 1)
+        self.user.addresses.filter(city='Sopot').delete()
+        bump_version(self.user.pk)
+        response = self.client.get("/api/addresses?q=sopot", format="json")
+        self.assertEqual(response.data['count'], 0)
+
+    # User gets city suggestions from their own addresses that follow address changes
+    def testAutocompleteEndpoint(self):
+        autocomplete_index.reset()
+        shard = sharding.shard_for_user(self.user.pk)
+        Address.objects.create(user=self.user, street='Dluga', city='Gdansk', postcode='111-93', country='Poland')
+        Address.objects.create(user=self.user, street='Rope street', city='London', postcode='SE16 7FJ', country='United Kingdom')
+        Address.objects.create(user=self.user_alt, street='Lange Gasse', city='Lobau', postcode='1220', country='Austria')
+        bump_version(self.user.pk)
+        self.authenticate_client(self.username, self.password)
+
+        response = self.client.get("/api/addresses/autocomplete?field=city&prefix=lo", format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], ['London'])
+
+        with self.captureOnCommitCallbacks(using=shard, execute=True):
+            response = self.client.post("/api/addresses", data={
+                "street": '133-137 Fetter Ln',
+                "city": 'Londonderry',
+                "postcode": 'BT48',
+                "country": 'United Kingdom'
+            }, format="json")
+        address_id = response.data['id']
+        # the cached index was moved to the new version instead of being rebuilt,
+        # lookups only read the version
+        self.assertEqual(autocomplete_index.cache.get(self.user.pk)[0], get_version(self.user.pk))
+        with self.assertNumQueriesOnAllShards(1):
+            response = self.client.get("/api/addresses/autocomplete?field=city&prefix=LON", format="json")
+        self.assertEqual(response.data['results'], ['London', 'Londonderry'])
+
+        with self.captureOnCommitCallbacks(using=shard, execute=True):
+            self.client.delete("/api/addresses/%s" % address_id, format="json")
+        response = self.client.get("/api/addresses/autocomplete?field=city&prefix=lon", format="json")
+        self.assertEqual(response.data['results'], ['London'])
+
+        # a version the index did not see, like another process' write, rebuilds it
+        Address.objects.create(user=self.user, street='Rynek', city='Lodz', postcode='90-001', country='Poland')
+        bump_version(self.user.pk)
+        response = self.client.get("/api/addresses/autocomplete?field=city&prefix=lo", format="json")
+        self.assertEqual(response.data['results'], ['Lodz', 'London'])
+
+        self.authenticate_client(self.username_alt, self.password_alt)
+        response = self.client.get("/api/addresses/autocomplete?field=city&prefix=lo", format="json")
+        self.assertEqual(response.data['results'], ['Lobau'])
+
+        response = self.client.get("/api/addresses/autocomplete?field=street&prefix=r", format="json")
+        self.assertEqual(response.status_code, 400)
+
+    # Addresses differing only in case, spacing or abbreviations are duplicates
+    def testUserCannotCreateNormalizedDuplicateAddressEndpoint(self):
+        self.authenticate_client(self.username, self.password)
+        data = {
+            "street": '133-137 Fetter Ln',
+            "city": 'London',
+            "postcode": 'EC4A 2BB',
+            "country": 'United Kingdom'
+        }
+        response = self.client.post("/api/addresses", data=data, format="json")
+        self.assertEqual(response.status_code, 201)
+
+        data['street'] = '133-137 fetter  lane.'
+        data['city'] = 'LONDON'
+        response = self.client.post("/api/addresses", data=data, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data, {'error': 'User already have this address'})
+        self.assertEqual(self.user.addresses.count(), 1)
+
+        # the same address is still fine for another user
+        Address.objects.create(user=self.user_alt, **data)
+        self.assertEqual(self.user_alt.addresses.count(), 1)
+
+    # User is able to list groups of near-duplicate addresses
+    def testUserAbilityToFindNearDuplicatesEndpoint(self):
+        Address.objects.create(user=self.user, street='133-137 Fetter Ln', city='London', postcode='EC4A 2BB', country='United Kingdom')
+        Address.objects.create(user=self.user, street='133-137 Fetter Lanes', city='London', postcode='ec4a2bb', country='United Kingdom')
+        Address.objects.create(user=self.user, street='Rope street', city='London', postcode='SE16 7FJ', country='United Kingdom')
+        Address.objects.create(user=self.user_alt, street='133 Fetter Lane', city='London', postcode='EC4A 2BB', country='United Kingdom')
+        self.authenticate_client(self.username, self.password)
+
+        response = self.client.get("/api/addresses/duplicates", format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['groups']), 1)
+        self.assertEqual([x['street'] for x in response.data['groups'][0]], ['133-137 Fetter Ln', '133-137 Fetter Lanes'])
+
+    # The OpenAPI schema is built ahead of time and served from the file
+    def testPrebuiltOpenAPISchemaEndpoint(self):
+        with tempfile.TemporaryDirectory() as directory, self.settings(ADDRESS_BOOK_SCHEMA_FILE=os.path.join(directory, 'openapi.json')):
+            response = self.client.get("/openapi.json")
+            self.assertEqual(response.status_code, 404)
+
+            call_command('build_openapi_schema', stdout=io.StringIO(), stderr=io.StringIO())
+            response = self.client.get("/openapi.json")
+            self.assertEqual(response.status_code, 200)
+            schema = json.loads(response.content)
+            self.assertIn('/addresses', schema['paths'])
+            self.assertIn('/auth/login', schema['paths'])
+
+            response = self.client.get("/openapi.json", HTTP_IF_NONE_MATCH=response['ETag'])
+            self.assertEqual(response.status_code, 304)
+
+    # Under ASGI the address reads are async views running their queries on the database pool
+    @override_settings(ROOT_URLCONF='address_book.async_urls', ADDRESS_BOOK_ASYNC_DB_THREADS=0, ADDRESS_BOOK_EXPORT_BATCH_SIZE=2)
+    def testAsyncAddressViews(self):
+        self.create_sample_addresses(self.user, 5)
+        self.create_sample_addresses(self.user_alt, 2)
+        self.authenticate_client(self.username, self.password)
+        token = self.client._credentials['HTTP_AUTHORIZATION']
+        expected = list(self.user.addresses.order_by('id').values('id', 'street', 'city', 'postcode', 'country'))
+
+        def get(path):
+            return async_to_sync(self.async_client.get)(path, AUTHORIZATION=token)
+
+        with override_settings(ADDRESS_BOOK_SLOW_REQUEST_SECONDS=0), self.assertLogs('address_book.slow', level='WARNING') as logs:
+            response = get("/api/addresses")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['count'], 5)
+        self.assertIn('address_book_address', logs.output[0])
+
+        response = get("/api/addresses/%s" % expected[0]['id'])
+        self.assertEqual(response.json(), expected[0])
+
+        response = get("/api/addresses/export")
+        self.assertIsInstance(response, AsyncStreamingHttpResponse)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], expected)
+
+        response = get("/api/addresses/changes")
+        self.assertEqual([x['id'] for x in response.json()['changed']], [x['id'] for x in expected])
+
+        # writes on the same URLs keep working
+        data = {'street': 'Rope street', 'city': 'London', 'postcode': 'SE16 7FJ', 'country': 'United Kingdom'}
+        response = self.client.post("/api/addresses", data=data, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.user.addresses.count(), 6)
+
+    # Views run on the database pool keep their request transaction unless marked non-atomic
+    @override_settings(ADDRESS_BOOK_ASYNC_DB_THREADS=0)
+    def testAsyncViewKeepsRequestTransactions(self):
+        depths = {}
+
+        def view(request, name):
+            depths[name] = len(connections['default'].savepoint_ids)
+            return HttpResponse()
+
+        outside = len(connections['default'].savepoint_ids)
+        request = RequestFactory().get('/')
+        async_to_sync(async_view(view))(request, 'atomic')
+        async_to_sync(async_view(transaction.non_atomic_requests(view)))(request, 'non_atomic')
+        self.assertEqual(depths, {'atomic': outside + 1, 'non_atomic': outside})
+
+    # The address admin pages without counting the table and deletes through the signal path
+    @override_settings(ADDRESS_BOOK_ADMIN_COUNT_LIMIT=4)
+    def testAddressAdmin(self):
+        User.objects.filter(pk=self.user_alt.pk).update(is_staff=True, is_superuser=True)
+        self.create_sample_addresses(self.user, 5)
+        london = Address.objects.create(user=self.user, street='Rope street', city='London', postcode='SE16 7FJ', country='United Kingdom')
+        self.client.force_login(self.user_alt)
+        shard = sharding.shard_for_user(self.user.pk)
+
+        response = self.client.get("/admin/address_book/address/", {'shard': shard})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].paginator.count, 4)
+
+        response = self.client.get("/admin/address_book/address/", {'shard': shard, 'q': 'Rope London'})
+        self.assertEqual([address.pk for address in response.context['cl'].result_list], [london.pk])
+
+        response = self.client.get("/admin/address_book/address/add/")
+        self.assertContains(response, 'vForeignKeyRawIdAdminField')
+        response = self.client.get("/admin/address_book/address/%s/change/" % london.pk)
+        self.assertContains(response, 'Rope street')
+        self.assertNotContains(response, 'vForeignKeyRawIdAdminField')
+
+        ids = list(self.user.addresses.values_list('pk', flat=True)[:2])
+        data = {'action': 'delete_selected_addresses', '_selected_action': ids}
+        response = self.client.post("/admin/address_book/address/?shard=%s" % shard, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.user.addresses.count(), 4)
+        tombstones = AddressTombstone.objects.filter(user=self.user).values_list('address_id', flat=True)
+        self.assertEqual(sorted(tombstones), sorted(ids))
+
+    # The address admin shows the users of addresses on other shards, loaded from the default database at once
+    def testAddressAdminOnShard(self):
+        User.objects.filter(pk=self.user_alt.pk).update(is_staff=True, is_superuser=True)
+        ShardPlacement.objects.update_or_create(user=self.user, defaults={'alias': 'shard1'})
+        sharding.shard_map.invalidate(self.user.pk)
+        self.create_sample_addresses(self.user, 3)
+        address = Address.objects.using('shard1').filter(user=self.user).first()
+        self.client.force_login(self.user_alt)
+
+        with CaptureQueriesContext(connections['default']) as queries:
+            response = self.client.get("/admin/address_book/address/", {'shard': 'shard1'})
+        self.assertEqual([row.user for row in response.context['cl'].result_list], [self.user] * 3)
+        self.assertEqual(len([query for query in queries if 'FROM "auth_user" WHERE "auth_user"."id" IN' in query['sql']]), 1)
+
+        response = self.client.get("/admin/address_book/address/%s/change/" % address.pk)
+        self.assertContains(response, self.username)
+        response = self.client.get("/admin/address_book/address/add/", {'user': self.user.pk})
+        self.assertContains(response, '%s</a></strong>' % self.username)
+
+    # Admin edits and deletes reach sync, versions and counts like API writes do
+    def testAddressAdminEditsNotifyAddressBook(self):
+        User.objects.filter(pk=self.user_alt.pk).update(is_staff=True, is_superuser=True)
+        london = Address.objects.create(user=self.user, street='Rope street', city='London', postcode='SE16 7FJ', country='United Kingdom')
+        dluga = Address.objects.create(user=self.user, street='Dluga', city='Gdansk', postcode='111-93', country='Poland')
+        shard = sharding.shard_for_user(self.user.pk)
+        orphan = Address.objects.using(shard).create(user=None, street='Fetter Ln', city='London', postcode='EC4A 2BB', country='United Kingdom')
+        self.authenticate_client(self.username, self.password)
+        cursor = self.client.get("/api/addresses/changes", format="json").data['cursor']
+        self.client.force_login(self.user_alt)
+
+        data = {'street': 'Rope street', 'city': 'Londonderry', 'postcode': 'BT48', 'country': 'United Kingdom'}
+        response = self.client.post("/admin/address_book/address/%s/change/" % london.pk, data)
+        self.assertEqual(response.status_code, 302)
+        response = self.client.post("/admin/address_book/address/%s/delete/" % dluga.pk, {'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+
+        changes = self.client.get("/api/addresses/changes", {'since': cursor}, format="json").data
+        self.assertEqual([x['city'] for x in changes['changed']], ['Londonderry'])
+        self.assertEqual(changes['deleted'], [dluga.pk])
+        response = self.client.get("/api/addresses/stats?by=city", format="json")
+        self.assertEqual([x['city'] for x in response.data['results']], ['Londonderry'])
+
+        # rows without a user belong to no address book and are simply removed
+        data = {'action': 'delete_selected_addresses', '_selected_action': [orphan.pk, london.pk]}
+        response = self.client.post("/admin/address_book/address/?shard=%s" % shard, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Address.objects.using(shard).filter(pk__in=[orphan.pk, london.pk]).exists())
+        self.assertEqual(self.client.get("/api/addresses/changes", {'since': cursor}, format="json").data['deleted'], [dluga.pk, london.pk])
+
+    # The slow request log keeps the slowest statements of the whole request, not the first ones
+    def testSlowRequestKeepsSlowestStatements(self):
+        stats = metrics.RequestStats(2)
+        # statements a to e take 1, 5, 2, 4 and 3 seconds
+        clock = [0, 1, 10, 15, 20, 22, 30, 34, 40, 43]
+        with mock.patch('address_book.metrics.time.perf_counter', side_effect=clock):
+            for sql in 'abcde':
+                stats.record_query(lambda *args: None, sql, None, False, {})
+        self.assertEqual(stats.queries, 5)
+        self.assertEqual(sorted(stats.sql, reverse=True), [(5, 'b'), (4, 'd')])
+
+    # Requests are timed per view and action and exposed as Prometheus metrics
+    def testMetricsEndpoint(self):
+        self.create_sample_addresses(self.user, 2)
+        self.authenticate_client(self.username, self.password)
+
+        with override_settings(ADDRESS_BOOK_SLOW_REQUEST_SECONDS=0):
+            with self.assertLogs('address_book.slow', level='WARNING') as logs:
+                response = self.client.get("/api/addresses", format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('AddressViewSet', logs.output[0])
+        self.assertIn('address_book_address', logs.output[0])
+
+        response = self.client.get("/metrics", REMOTE_ADDR='127.0.0.1')
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode()
+        labels = 'action="list",method="GET",view="AddressViewSet"'
+        self.assertIn('address_book_request_seconds_count{%s} 1' % labels, content)
+        self.assertIn('address_book_request_serializer_seconds_count{%s} 1' % labels, content)
+        self.assertIn('address_book_request_db_queries_bucket{%s,le="0"} 0' % labels, content)
+        self.assertIn('address_book_token_cache_hits_total', content)
+
+        response = self.client.get("/metrics", REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
+
+    # Unchanged address lists are served from cache and revalidated with ETags
+    def testAddressResponseCacheAndConditionalGet(self):
+        self.create_sample_addresses(self.user, 2)
+        self.authenticate_client(self.username, self.password)
+
+        response = self.client.get("/api/addresses", format="json")
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # neither the cached body nor the 304 touch the address table
+        with self.assertNumQueriesOnAllShards(1):
+            response = self.client.get("/api/addresses", format="json")
+        self.assertEqual(response.data['count'], 2)
+        with self.assertNumQueriesOnAllShards(1):
+            response = self.client.get("/api/addresses", HTTP_IF_NONE_MATCH=etag, format="json")
+        self.assertEqual(response.status_code, 304)
+
+        # any change moves the address book to a new version
+        response = self.client.post("/api/addresses", data={
+            "street": 'Rope street',
+            "city": 'London',
+            "postcode": 'SE16 7FJ',
+            "country": 'United Kingdom'
+        }, format="json")
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get("/api/addresses", HTTP_IF_NONE_MATCH=etag, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 3)
+        self.assertNotEqual(response['ETag'], etag)
+
+        response = self.client.delete("/api/addresses/delete_multiple", format="json")
+        response = self.client.get("/api/addresses", format="json")
+        self.assertEqual(response.data['count'], 0)
+
+    # The response cache is bounded by the size of the cached payloads, pages too large for it are not kept
+    def testResponseCacheIsBoundedByPayloadSize(self):
+        cache = LRUCache(10)
+        cache.set('a', 'first', size=6)
+        cache.set('b', 'second', size=6)
+        cache.set('c', 'huge', size=11)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (None, 'second', None))
+
+        self.create_sample_addresses(self.user, 20)
+        address = self.user.addresses.first()
+        self.authenticate_client(self.username, self.password)
+        small = len(JSONRenderer().render(AddressSerializer(address).data))
+        with mock.patch.object(response_cache, '_cache', LRUCache(small * 5)):
+            for _ in range(2):
+                self.client.get("/api/addresses?page_size=20", format="json")
+                self.client.get("/api/addresses/%s" % address.pk, format="json")
+            self.assertEqual(response_cache.stats(), {'hits': 1, 'misses': 3, 'size': 1})
+
+    # The fast read path renders exactly what AddressSerializer would
+    def testFastReadPathMatchesSerializerPayload(self):
+        self.create_sample_addresses(self.user, 3)
+        Address.objects.create(user=self.user, street='Długa "1"', city='Gdańsk', postcode='80-827', country='Polska')
+        self.authenticate_client(self.username, self.password)
+        addresses = list(self.user.addresses.order_by('id'))
+        renderer = JSONRenderer()
+
+        response = self.client.get("/api/addresses?pagination=cursor&page_size=100", format="json")
+        expected = renderer.render(AddressSerializer(addresses, many=True).data)
+        self.assertEqual(renderer.render(response.data['results']), expected)
+
+        response = self.client.get("/api/addresses/%s" % addresses[-1].id, format="json")
+        self.assertEqual(response.content, renderer.render(AddressSerializer(addresses[-1]).data))
+
+    # User is able to fetch only what changed since their last sync
+    def testUserAbilityToSyncChangesEndpoint(self):
+        self.authenticate_client(self.username, self.password)
+        data = [{
+            "street": 'Rope street',
+            "city": 'London',
+            "postcode": 'SE16 7FJ',
+            "country": 'United Kingdom'
+        }, {
+            "street": '133-137 Fetter Ln',
+            "city": 'London',
+            "postcode": 'EC4A 2BB',
+            "country": 'United Kingdom'
+        }, {
+            "street": 'Dluga',
+            "city": 'Gdansk',
+            "postcode": '111-93',
+            "country": 'Poland'
+        }]
+        response = self.client.post("/api/addresses/bulk", data=data, format="json")
+        ids = [x['id'] for x in response.data['results']]
+
+        # the initial sync pages through the whole book
+        response = self.client.get("/api/addresses/changes?limit=2", format="json")
+        self.assertEqual([x['id'] for x in response.data['changed']], ids[:2])
+        self.assertTrue(response.data['has_more'])
+        response = self.client.get("/api/addresses/changes?since=%s" % response.data['cursor'], format="json")
+        self.assertEqual([x['id'] for x in response.data['changed']], ids[2:])
+        self.assertFalse(response.data['has_more'])
+        cursor = response.data['cursor']
+
+        response = self.client.get("/api/addresses/changes?since=%s" % cursor, format="json")
+        self.assertEqual(response.data['changed'], [])
+        self.assertEqual(response.data['cursor'], cursor)
+
+        self.client.patch("/api/addresses/%s" % ids[0], data={'city': 'Manchester'}, format="json")
+        self.client.delete("/api/addresses/delete_multiple?ids=%s,%s" % (ids[1], ids[2]), format="json")
+        response = self.client.get("/api/addresses/changes?since=%s" % cursor, format="json")
+        self.assertEqual(response.data['changed'], [{
+            'id': ids[0],
+            'street': 'Rope street',
+            'city': 'Manchester',
+            'postcode': 'SE16 7FJ',
+            'country': 'United Kingdom'
+        }])
+        self.assertEqual(response.data['deleted'], ids[1:])
+
+        response = self.client.get("/api/addresses/changes?since=nope", format="json")
+        self.assertEqual(response.status_code, 400)
+
+    # Clients whose cursor is older than the pruned tombstones are told to sync from scratch
+    def testSyncAfterTombstonesArePruned(self):
+        self.authenticate_client(self.username, self.password)
+        rope = Address.objects.create(user=self.user, street='Rope street', city='London', postcode='SE16 7FJ', country='United Kingdom')
+        dluga = Address.objects.create(user=self.user, street='Dluga', city='Gdansk', postcode='111-93', country='Poland')
+        bump_version(self.user.pk)
+        stale = self.client.get("/api/addresses/changes", format="json").data['cursor']
+        self.client.delete("/api/addresses/%s" % rope.id, format="json")
+        recent = self.client.get("/api/addresses/changes?since=%s" % stale, format="json").data['cursor']
+        self.client.delete("/api/addresses/%s" % dluga.id, format="json")
+
+        # only the first tombstone is past the retention
+        AddressTombstone.objects.filter(user=self.user, address_id=rope.id).update(deleted=timezone.now() - timedelta(days=60))
+        out = io.StringIO()
+        with override_settings(ADDRESS_BOOK_TOMBSTONE_RETENTION=30 * 24 * 3600):
+            call_command('prune_tombstones', stdout=out)
+        self.assertEqual(out.getvalue().strip(), 'Deleted 1 tombstones')
+        self.assertEqual(list(AddressTombstone.objects.filter(user=self.user).values_list('address_id', flat=True)), [dluga.id])
+
+        response = self.client.get("/api/addresses/changes?since=%s" % stale, format="json")
+        self.assertEqual(response.status_code, 410)
+        self.assertTrue(response.data['resync'])
+        response = self.client.get("/api/addresses/changes?since=%s" % recent, format="json")
+        self.assertEqual(response.data['deleted'], [dluga.id])
+        response = self.client.get("/api/addresses/changes", format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['changed'], [])
+
+    # User is able to patch many addresses at once, conflicts are reported per item
+    def testUserAbilityToBulkUpdateAddressesEndpoint(self):
+        rope = Address.objects.create(user=self.user, street='Rope street', city='London', postcode='SE16 7FJ', country='United Kingdom')
+        fetter = Address.objects.create(user=self.user, street='133-137 Fetter Ln', city='London', postcode='EC4A 2BB', country='United Kingdom')
+        dluga = Address.objects.create(user=self.user, street='Dluga', city='Gdansk', postcode='111-93', country='Poland')
+        other = Address.objects.create(user=self.user_alt, street='Dluga', city='Gdansk', postcode='111-93', country='Poland')
+        self.authenticate_client(self.username, self.password)
+
+        data = [
+            {'id': rope.id, 'postcode': 'SE16 7FK'},
+            {'id': fetter.id, 'street': 'rope st'},
+            {'id': dluga.id, 'city': 'Sopot', 'postcode': '81-001'},
+            {'id': other.id, 'city': 'Sopot'},
+            {'id': dluga.id, 'city': 'Gdynia'},
+            {'id': rope.id + 1000},
+            {'city': 'Paris'},
+            {'id': rope.id, 'street': ''},
+        ]
+        response = self.client.patch("/api/addresses/bulk", data=data, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [x['status'] for x in response.data['results']],
+            ['updated', 'duplicate', 'updated', 'not_found', 'invalid', 'not_found', 'invalid', 'invalid']
+        )
+
+        rope.refresh_from_db()
+        fetter.refresh_from_db()
+        dluga.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(rope.postcode, 'SE16 7FK')
+        self.assertEqual(fetter.street, '133-137 Fetter Ln')
+        self.assertEqual((dluga.city, dluga.postcode), ('Sopot', '81-001'))
+        self.assertEqual(other.city, 'Gdansk')
+
+        # an address can take over values another one gives up earlier in the same request
+        data = [
+            {'id': dluga.id, 'street': 'Dluga 2'},
+            {'id': rope.id, 'street': 'Dluga', 'city': 'Sopot', 'country': 'Poland'},
+        ]
+        response = self.client.patch("/api/addresses/bulk", data=data, format="json")
+        self.assertEqual(response.data['updated'], 2)
+        rope.refresh_from_db()
+        self.assertEqual((rope.street, rope.city), ('Dluga', 'Sopot'))
+
+    # Reads go to a replica unless the user has just written, writes always go to the primary
+    @override_settings(ADDRESS_BOOK_DATABASE_REPLICAS={alias: ['replica1'] for alias in settings.ADDRESS_BOOK_SHARDS})
+    def testReadReplicaRouting(self):
+        with sharding.use_shard('default'):
+            self.assertEqual(router.db_for_read(Address), 'default')
+            with routers.replica_reads():
+                self.assertEqual(router.db_for_read(Address), 'replica1')
+                self.assertEqual(router.db_for_read(User), 'default')
+                self.assertEqual(router.db_for_write(Address), 'default')
+                routers.use_primary()
+                self.assertEqual(router.db_for_read(Address), 'default')
+        self.assertFalse(router.allow_migrate('replica1', 'address_book'))
+
+        self.authenticate_client(self.username, self.password)
+        self.assertFalse(routers.is_pinned(self.user.pk))
+        data = {"street": 'Rope street', "city": 'London', "postcode": 'SE16 7FJ', "country": 'United Kingdom'}
+        response = self.client.post("/api/addresses", data=data, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertTrue(routers.is_pinned(self.user.pk))
+
+        # the replica alias does not exist here, so this only works when read from the primary
+        response = self.client.get("/api/addresses")
+        self.assertEqual(response.data['count'], 1)
+
+    # Persistent connections are pinged at the start of a request at most once per interval
+    def testConnectionHealthCheckInterval(self):
+        connection = connections['default']
+        connection.ensure_connection()
+        connection.address_book_checked = None
+        with mock.patch.object(connection, 'is_usable', return_value=True) as is_usable:
+            routers.check_connections()
+            routers.check_connections()
+            self.assertEqual(is_usable.call_count, 1)
+            with self.settings(ADDRESS_BOOK_CONN_HEALTH_CHECK_INTERVAL=0):
+                routers.check_connections()
+            self.assertEqual(is_usable.call_count, 2)
+
+    # Under ASGI the health checks run on the pool thread that holds the connections, not on the signal's thread
+    def testConnectionHealthCheckRunsInDatabasePool(self):
+        checked = []
+        with mock.patch('address_book.async_views.routers.check_connections', side_effect=lambda: checked.append(threading.get_ident())):
+            worker = async_to_sync(db_pool.run)(threading.get_ident)
+        self.assertEqual(checked, [worker])
+        self.assertNotEqual(worker, threading.get_ident())
+
+    # Users spread over the shards and adding a shard only moves users onto the new one
+    def testShardHashRing(self):
+        ring = sharding.HashRing(['default', 'shard1', 'shard2'], 64)
+        placed = {user_id: ring.get(user_id) for user_id in range(3000)}
+        for alias in ('default', 'shard1', 'shard2'):
+            self.assertGreater(list(placed.values()).count(alias), 600)
+
+        grown = sharding.HashRing(['default', 'shard1', 'shard2', 'shard3'], 64)
+        moved = {user_id for user_id, alias in placed.items() if grown.get(user_id) != alias}
+        self.assertTrue(all(grown.get(user_id) == 'shard3' for user_id in moved))
+        self.assertLess(len(moved), 1500)
+
+    # An address book moved to another shard keeps its ids, versions and tombstones
+    @skipUnless(len(settings.ADDRESS_BOOK_SHARDS) > 1, 'needs ADDRESS_BOOK_DB_SHARDS')
+    def testMoveAddressBookBetweenShards(self):
+        self.authenticate_client(self.username, self.password)
+        data = [
+            {"street": 'Rope street', "city": 'London', "postcode": 'SE16 7FJ', "country": 'United Kingdom'},
+            {"street": 'Dluga', "city": 'Gdansk', "postcode": '111-93', "country": 'Poland'},
+        ]
+        self.client.post("/api/addresses/bulk", data=data, format="json")
+        response = self.client.get("/api/addresses", format="json")
+        ids = sorted(x['id'] for x in response.data['results'])
+        self.client.delete("/api/addresses/%s" % ids[1])
+        changes = self.client.get("/api/addresses/changes?since=0", format="json").data
+
+        source = sharding.shard_for_user(self.user.pk)
+        target = next(alias for alias in settings.ADDRESS_BOOK_SHARDS if alias != source)
+        self.assertEqual(Address.objects.using(source).filter(user=self.user).count(), 1)
+        self.assertTrue(sharding.move_user(self.user.pk, target, grace=0))
+        self.assertEqual(sharding.shard_for_user(self.user.pk), target)
+        self.assertFalse(Address.objects.using(source).filter(user=self.user).exists())
+
+        response = self.client.get("/api/addresses", format="json")
+        self.assertEqual([x['id'] for x in response.data['results']], ids[:1])
+        self.assertEqual(self.client.get("/api/addresses/changes?since=0", format="json").data, changes)
+
+        data = {"street": 'Fetter Ln', "city": 'London', "postcode": 'EC4A 2BB', "country": 'United Kingdom'}
+        response = self.client.post("/api/addresses", data=data, format="json")
+        self.assertEqual(response.status_code, 201)
+        start = settings.ADDRESS_BOOK_SHARDS.index(target) * sharding.ID_SPACE
+        self.assertTrue(start < response.data['id'] or target == 'default')
+
+    # Writers that looked up the shard before a move started are refused instead of writing to the old shard
+    def testMoveRefusesWritesInFlight(self):
+        data = {"street": 'Rope street', "city": 'London', "postcode": 'SE16 7FJ', "country": 'United Kingdom'}
+        with sharding.for_user(self.user.pk, write=True):
+            ShardPlacement.objects.filter(user=self.user).update(moving=True)
+            with self.assertRaises(sharding.AddressBookMoving):
+                list(bulk_insert_addresses(self.user, [(0, data)]))
+        self.authenticate_client(self.username, self.password)
+        response = self.client.post("/api/addresses", data=data, format="json")
+        self.assertEqual(response.status_code, 503)
+
+    # Addresses written to the old shard while a move finishes are copied over before it is emptied
+    @skipUnless(len(settings.ADDRESS_BOOK_SHARDS) > 1, 'needs ADDRESS_BOOK_DB_SHARDS')
+    def testMoveCopiesLateWrites(self):
+        def late_write(grace):
+            if ShardPlacement.objects.get(user=self.user).alias != target:
+                return
+            # a writer bypassing the placement lock, with the old placement still cached
+            sharding.shard_map.cache.set(self.user.pk, source)
+            with sharding.use_shard(source), transaction.atomic(using=source):
+                list(_insert_address_rows(self.user, [(0, data)]))
+            sharding.shard_map.invalidate(self.user.pk)
+
+        data = {"street": 'Rope street', "city": 'London', "postcode": 'SE16 7FJ', "country": 'United Kingdom'}
+        source = sharding.shard_for_user(self.user.pk)
+        target = next(alias for alias in settings.ADDRESS_BOOK_SHARDS if alias != source)
+        with mock.patch('address_book.sharding.time.sleep', side_effect=late_write):
+            self.assertTrue(sharding.move_user(self.user.pk, target))
+        self.assertFalse(Address.objects.using(source).filter(user=self.user).exists())
+        moved = Address.objects.using(target).get(user=self.user)
+        self.assertEqual(moved.street, 'Rope street')
+        self.assertEqual(AddressBookVersion.objects.using(target).get(user=self.user).version, moved.change_version)
+        self.assertEqual(
+            list(AddressCount.objects.using(target).filter(user=self.user, kind=AddressCount.COUNTRY).values_list('country', 'count')),
+            [('United Kingdom', 1)]
+        )
+
+    # Rebalancing a user moves their share of the global address counts along with them
+    def testRebalanceKeepsGlobalStats(self):
+        def assertCountsMatchRebuild():
+            # every shard's counts, its totals included, match a rebuild from its addresses
+            def counts():
+                return {
+                    alias: set(AddressCount.objects.using(alias).filter(count__gt=0).values_list('user_id', 'kind', 'country', 'city', 'count'))
+                    for alias in settings.ADDRESS_BOOK_SHARDS
+                }
+            kept = counts()
+            for alias in settings.ADDRESS_BOOK_SHARDS:
+                stats.rebuild_counts(using=alias)
+            self.assertEqual(counts(), kept)
+            response = self.client.get("/api/addresses/stats?scope=global&by=city", format="json")
+            self.assertEqual(response.data['results'], totals)
+
+        self.authenticate_client(self.username, self.password)
+        self.client.post("/api/addresses/bulk", data=[
+            {"street": 'Rope street', "city": 'London', "postcode": 'SE16 7FJ', "country": 'United Kingdom'},
+            {"street": 'Dluga', "city": 'Gdansk', "postcode": '111-93', "country": 'Poland'},
+        ], format="json")
+        self.authenticate_client(self.username_alt, self.password_alt)
+        self.client.post("/api/addresses", data={"street": 'Sopocka', "city": 'Gdansk', "postcode": '80-001', "country": 'Poland'}, format="json")
+        User.objects.filter(pk=self.user_alt.pk).update(is_staff=True)
+        token_cache.clear()
+        totals = self.client.get("/api/addresses/stats?scope=global&by=city", format="json").data['results']
+        self.assertEqual(sum(row['count'] for row in totals), 3)
+
+        home = sharding.shard_for_user(self.user.pk)
+        away = next(alias for alias in settings.ADDRESS_BOOK_SHARDS if alias != home)
+        self.assertTrue(sharding.move_user(self.user.pk, away, grace=0))
+        assertCountsMatchRebuild()
+        out = io.StringIO()
+        call_command('rebalance_shards', grace=0, stdout=out)
+        self.assertIn('user %s: %s -> %s' % (self.user.pk, away, home), out.getvalue())
+        assertCountsMatchRebuild()
+
+    # Address counts follow creates, updates and deletes and match a rebuild from scratch
+    def testAddressStatsEndpoint(self):
+        self.authenticate_client(self.username, self.password)
+        data = [
+            {"street": 'Rope street', "city": 'London', "postcode": 'SE16 7FJ', "country": 'United Kingdom'},
+            {"street": '133-137 Fetter Ln', "city": 'London', "postcode": 'EC4A 2BB', "country": 'United Kingdom'},
+            {"street": 'Dluga', "city": 'Gdansk', "postcode": '111-93', "country": 'Poland'},
+            {"street": 'Monte Cassino', "city": 'Sopot', "postcode": '81-001', "country": 'Poland'},
+        ]
+        response = self.client.post("/api/addresses/bulk", data=data, format="json")
+        ids = [x['id'] for x in response.data['results']]
+        self.client.patch("/api/addresses/%s" % ids[1], data={"city": 'Manchester'}, format="json")
+        self.client.delete("/api/addresses/%s" % ids[3])
+
+        response = self.client.get("/api/addresses/stats", format="json")
+        self.assertEqual(response.data['results'], [{'country': 'United Kingdom', 'count': 2}, {'country': 'Poland', 'count': 1}])
+        response = self.client.get("/api/addresses/stats?by=city&country=United Kingdom", format="json")
+        self.assertEqual(response.data['results'], [
+            {'country': 'United Kingdom', 'city': 'London', 'count': 1},
+            {'country': 'United Kingdom', 'city': 'Manchester', 'count': 1},
+        ])
+        response = self.client.get("/api/addresses/stats?scope=global", format="json")
+        self.assertEqual(response.status_code, 403)
+
+        # addresses written behind the API's back only show up after a rebuild
+        self.create_sample_addresses(self.user_alt, 3)
+        self.user_alt.is_staff = True
+        self.user_alt.save()
+        self.authenticate_client(self.username_alt, self.password_alt)
+        totals = {row['country']: row['count'] for row in self.client.get("/api/addresses/stats?scope=global", format="json").data['results']}
+        self.assertEqual(totals['Poland'], 1)
+        call_command('rebuild_address_stats', stdout=io.StringIO())
+        response = self.client.get("/api/addresses/stats?scope=global", format="json")
+        self.assertEqual(sum(row['count'] for row in response.data['results']), 6)
+        self.assertEqual({row['country']: row['count'] for row in response.data['results']}.get('Poland'), totals['Poland'])
+
+    # Grid lookups agree with a full scan of the points
+    def testGeoGridIndex(self):
+        rng = random.Random(7)
+        points = [(pk, rng.uniform(49, 55), rng.uniform(-6, 20)) for pk in range(2000)]
+        index = GridIndex(points, 0.1)
+        for lat, lon in ((51.5, -0.12), (54.35, 18.65), (60.0, 40.0)):
+            scan = sorted((distance_km(lat, lon, point_lat, point_lon), pk) for pk, point_lat, point_lon in points)
+            self.assertEqual(index.nearest(lat, lon, 5), scan[:5])
+            self.assertEqual(index.within(lat, lon, 50), [match for match in scan if match[0] <= 50])
+
+    # Addresses are geocoded from the postcode dataset and found by distance
+    def testUserAbilityToFindAddressesNearPointEndpoint(self):
+        dataset = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        self.addCleanup(os.remove, dataset.name)
+        dataset.write('postcode,latitude,longitude\nSE16 7FJ,51.4985,-0.0532\nEC4A 2BB,51.5163,-0.1090\n80-001,54.3520,18.6466\n')
+        dataset.close()
+
+        self.authenticate_client(self.username, self.password)
+        data = [
+            {"street": 'Rope street', "city": 'London', "postcode": 'se167fj', "country": 'United Kingdom'},
+            {"street": '133-137 Fetter Ln', "city": 'London', "postcode": 'EC4A 2BB', "country": 'United Kingdom'},
+            {"street": 'Dluga', "city": 'Gdansk', "postcode": '80-001', "country": 'Poland'},
+        ]
+        with override_settings(ADDRESS_BOOK_POSTCODE_DATASET=dataset.name):
+            self.client.post("/api/addresses/bulk", data=data, format="json")
+
+        response = self.client.get("/api/addresses/near?lat=51.5074&lon=-0.1278&k=2", format="json")
+        self.assertEqual([x['street'] for x in response.data['results']], ['133-137 Fetter Ln', 'Rope street'])
+        self.assertAlmostEqual(response.data['results'][0]['distance'], 1.5, delta=0.2)
+        response = self.client.get("/api/addresses/near?lat=54.35&lon=18.65&radius=10", format="json")
+        self.assertEqual([x['street'] for x in response.data['results']], ['Dluga'])
+        response = self.client.get("/api/addresses/near?lat=north&lon=0", format="json")
+        self.assertEqual(response.status_code, 400)
+
+        # addresses stored before the dataset was configured are picked up by the command
+        Address.objects.create(user=self.user, street='Sopocka', city='Gdansk', postcode='80-001 ', country='Poland')
+        call_command('geocode_addresses', dataset.name, '--missing-only', stdout=io.StringIO())
+        response = self.client.get("/api/addresses/near?lat=54.35&lon=18.65&radius=10", format="json")
+        self.assertEqual(sorted(x['street'] for x in response.data['results']), ['Dluga', 'Sopocka'])
+
+    # Fake address generation gives the same rows for the same seed, whatever the worker count
+    def testGenerateFakeAddressesIsReproducible(self):
+        def generate(workers):
+            call_command(
+                'generate_fake_addresses', users=2, per_user=5, seed=3, batch_size=2, workers=workers, stdout=io.StringIO()
+            )
+            users = User.objects.filter(username__startswith='fake_3_').order_by('username')
+            return {
+                user.username: sorted(user.addresses.values_list('street', 'city', 'postcode', 'country', 'fingerprint'))
+                for user in users
+            }
+
+        first = generate(1)
+        self.assertEqual([len(rows) for rows in first.values()], [5, 5])
+        # every batch moves the address book to a new version, so sync clients pick the rows up
+        user = User.objects.filter(username__startswith='fake_3_').first()
+        versions = set(user.addresses.values_list('change_version', flat=True))
+        self.assertEqual(versions, {1, 2, 3})
+        self.assertEqual(AddressBookVersion.objects.get(user=user).version, 3)
+        for user in User.objects.filter(username__startswith='fake_3_'):
+            user.addresses.all().delete()
+        self.assertEqual(generate(2), first)
+
+    # A tiny benchmark run reports every scenario, with the addresses seeded on the benchmark user's shard
+    def testBenchmarkReport(self):
+        report = BenchmarkCommand(stdout=io.StringIO(), stderr=io.StringIO()).run([5], 2, 7)
+        self.assertEqual(
+            {key: value for key, value in report.items() if key != 'sizes'},
+            {'database': connections['default'].vendor, 'shards': len(settings.ADDRESS_BOOK_SHARDS), 'requests': 2, 'seed': 7}
+        )
+        reads = ['list_first_page', 'list_deep_page', 'list_cursor', 'filter', 'retrieve']
+        scenarios = report['sizes']['5']
+        self.assertEqual(
+            set(scenarios),
+            {'login', 'create', 'delete_multiple', 'logout', *reads, *(name + '_cached' for name in reads)}
+        )
+        for name, result in scenarios.items():
+            self.assertEqual(
+                set(result), {'p50_ms', 'p95_ms', 'p99_ms', 'mean_ms', 'throughput_rps', 'queries_per_request', 'status_codes'}
+            )
+            self.assertEqual(sum(result['status_codes'].values()), 2)
+            self.assertTrue(all(code.startswith('2') for code in result['status_codes']), name)
+        # cache hits skip the queries of the view
+        self.assertLess(scenarios['list_first_page_cached']['queries_per_request'], scenarios['list_first_page']['queries_per_request'])
+
+        user = User.objects.get(username='benchmark')
+        seeded = Address.objects.using(sharding.shard_for_user(user.pk)).filter(user=user).exclude(city='Benchmark')
+        self.assertEqual(seeded.count(), 5)
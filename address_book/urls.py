@@ -1,9 +1,14 @@
+from django.urls import path
 from rest_framework import routers
 
-from .views import AuthViewSet, AddressViewSet
+from .views import AuthViewSet, AddressViewSet, JobViewSet, metrics_view, openapi_schema_view
 
 router = routers.DefaultRouter(trailing_slash=False)
 router.register('api/auth', AuthViewSet, basename='auth')
 router.register('api/addresses', AddressViewSet, basename='addresses')
+router.register('api/jobs', JobViewSet, basename='jobs')
 
-urlpatterns = router.urls
\ No newline at end of file
+urlpatterns = router.urls + [
+    path('metrics', metrics_view, name='metrics'),
+    path('openapi.json', openapi_schema_view, name='openapi-schema'),
+]
\ No newline at end of file
@@ -1,9 +1,272 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
 from django.contrib.auth import authenticate
+from django.db import IntegrityError, router, transaction
 from rest_framework import serializers
 
+from . import sharding
+from .fingerprint import address_fingerprint
+from .models import Address
+from .signals import addresses_changed
+
+# Fields describing an address in addresses_changed notifications
+ADDRESS_ROW_FIELDS = ('id', 'user_id', 'street', 'city', 'postcode', 'country')
+
 
 def get_and_authenticate_user(username, password):
     user = authenticate(username=username, password=password)
     if user is None:
         raise serializers.ValidationError("Invalid username/password. Please try again!")
     return user
+
+
+class LRUCache:
+    """
+    Thread safe mapping bounded to ``max_size`` entries that expire after ``ttl`` seconds.
+
+    Entries stored with a ``size`` weigh that much instead of one, which bounds
+    the cache by e.g. bytes rather than by entries.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires, size = item
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+                self._total -= size
+            self.misses += 1
+            return default
+
+    def set(self, key, value, size=1):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._remove(key)
+            if size > self.max_size:
+                # would push out everything else and still not fit
+                return
+            self._data[key] = (value, expires, size)
+            self._total += size
+            while self._total > self.max_size:
+                _, (_, _, evicted) = self._data.popitem(last=False)
+                self._total -= evicted
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._total = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._total -= item[2]
+
+
+def address_row(address):
+    return {field: getattr(address, field) for field in ADDRESS_ROW_FIELDS}
+
+
+def address_key(data):
+    return address_fingerprint(data['street'], data['city'], data['country'])
+
+
+def existing_address_keys(user, keys):
+    """
+    Map each of the fingerprints ``keys`` already stored in the user's address book to its id.
+    """
+    if not keys:
+        return {}
+    query_set = Address.objects.filter(user=user, fingerprint__in=keys)
+    return dict(query_set.values_list('fingerprint', 'id'))
+
+
+def bulk_insert_addresses(user, rows, batch_size=None):
+    """
+    Insert ``(ref, data)`` pairs for ``user`` using chunked ``bulk_create`` calls.
+
+    Yields ``(ref, address)`` for each row, where address is None when the row
+    clashes with an existing address or with an earlier row of ``rows``. Each
+    chunk is a transaction of its own when no transaction is open.
+    """
+    batch_size = batch_size or settings.ADDRESS_BOOK_BULK_BATCH_SIZE
+    chunk = []
+    for ref, data in rows:
+        chunk.append((ref, data))
+        if len(chunk) >= batch_size:
+            yield from _insert_address_chunk(user, chunk)
+            chunk = []
+    if chunk:
+        yield from _insert_address_chunk(user, chunk)
+
+
+def _insert_address_chunk(user, chunk):
+    # the rows and their addresses_changed commit together, on their own unless
+    # the caller holds a transaction
+    with sharding.write_transaction(user.pk):
+        return _insert_address_rows(user, chunk)
+
+
+def _insert_address_rows(user, chunk):
+    # earlier chunks are already in the database, so checking the chunk
+    # against stored rows also de-duplicates across the whole input
+    keys = [address_key(data) for _, data in chunk]
+    seen = set(existing_address_keys(user, set(keys)))
+    results = []
+    pending = []
+    for (ref, data), key in zip(chunk, keys):
+        if key in seen:
+            results.append((ref, None))
+            continue
+        seen.add(key)
+        address = Address(user=user, fingerprint=key, **data)
+        results.append((ref, address))
+        pending.append(address)
+
+    db = router.db_for_write(Address, user_id=user.pk)
+    try:
+        with transaction.atomic(using=db):
+            Address.objects.using(db).bulk_create(pending)
+    except IntegrityError:
+        # a concurrent request inserted one of the rows, retry one by one
+        for index, (ref, address) in enumerate(results):
+            if address is None:
+                continue
+            address.pk = None
+            try:
+                with transaction.atomic(using=db):
+                    address.save()
+            except IntegrityError:
+                results[index] = (ref, None)
+
+    # not every backend returns primary keys from bulk_create
+    missing = [address for _, address in results if address is not None and address.pk is None]
+    if missing:
+        ids = existing_address_keys(user, {address.fingerprint for address in missing})
+        for address in missing:
+            address.pk = ids.get(address.fingerprint)
+
+    created = [address_row(address) for _, address in results if address is not None]
+    if created:
+        addresses_changed.send(sender=Address, created=created)
+    return results
+
+
+def bulk_update_addresses(user, changes, batch_size=None):
+    """
+    Apply ``(ref, address, data)`` changes to addresses of ``user`` with batched UPDATEs.
+
+    Changes are checked in order as if applied one at a time, and a change that
+    would give its address the same fingerprint as another address is skipped.
+    Returns ``(ref, address)`` pairs with address None for skipped changes.
+    """
+    batch_size = batch_size or settings.ADDRESS_BOOK_BULK_BATCH_SIZE
+    touched = {address.pk: address.fingerprint for _, address, _ in changes}
+    wanted = {address_key({**address_row(address), **data}) for _, address, data in changes}
+    owners = {fingerprint: pk for fingerprint, pk in existing_address_keys(user, wanted).items() if pk not in touched}
+    owners.update({fingerprint: pk for pk, fingerprint in touched.items()})
+
+    results = []
+    updated = []
+    for ref, address, data in changes:
+        old = address_row(address)
+        fingerprint = address_key({**old, **data})
+        if owners.get(fingerprint, address.pk) != address.pk:
+            results.append((ref, None))
+            continue
+        if owners.get(address.fingerprint) == address.pk:
+            del owners[address.fingerprint]
+        owners[fingerprint] = address.pk
+        for field, value in data.items():
+            setattr(address, field, value)
+        address.fingerprint = fingerprint
+        results.append((ref, address))
+        updated.append((old, address))
+
+    fields = ['street', 'city', 'postcode', 'country', 'fingerprint']
+    addresses = [address for _, address in updated]
+    db = router.db_for_write(Address, user_id=user.pk)
+    try:
+        with transaction.atomic(using=db):
+            Address.objects.using(db).bulk_update(addresses, fields, batch_size=batch_size)
+    except IntegrityError:
+        # a single UPDATE can trip over rows handing fingerprints to each
+        # other, replay the changes one by one in order instead
+        failed = set()
+        for address in addresses:
+            try:
+                with transaction.atomic(using=db):
+                    Address.objects.using(db).filter(pk=address.pk).update(**{field: getattr(address, field) for field in fields})
+            except IntegrityError:
+                failed.add(address.pk)
+        results = [(ref, None if address is not None and address.pk in failed else address) for ref, address in results]
+        updated = [(old, address) for old, address in updated if address.pk not in failed]
+
+    if updated:
+        addresses_changed.send(sender=Address, updated=[(old, address_row(address)) for old, address in updated])
+    return results
+
+
+def iter_batches(query_set, fields, batch_size):
+    """
+    Yield lists of ``values_list`` rows of ``query_set`` walked by primary key.
+
+    Every batch is a separate keyset query, so memory stays bounded and no
+    cursor is held open between batches.
+    """
+    last = None
+    while True:
+        batch_set = query_set.order_by('pk')
+        if last is not None:
+            batch_set = batch_set.filter(pk__gt=last)
+        rows = list(batch_set.values_list('pk', *fields)[:batch_size])
+        if not rows:
+            return
+        last = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+
+def delete_addresses(query_set, user_id, batch_size=None, progress=None):
+    """
+    Delete the addresses ``query_set`` selects from the address book of
+    ``user_id`` in bounded chunks and return how many were removed.
+
+    ``progress`` is called with the number of rows deleted so far after every chunk.
+    """
+    batch_size = batch_size or settings.ADDRESS_BOOK_DELETE_BATCH_SIZE
+    deleted = 0
+    while True:
+        with sharding.write_transaction(user_id):
+            rows = list(query_set.order_by('pk').values(*ADDRESS_ROW_FIELDS)[:batch_size])
+            if not rows:
+                return deleted
+            count, _ = Address.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+            addresses_changed.send(sender=Address, deleted=rows)
+            deleted += count
+        if progress is not None:
+            progress(deleted)
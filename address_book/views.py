@@ -1,23 +1,50 @@
+import hashlib
+import os
+from contextlib import ExitStack
+
+from django.conf import settings
 from django.contrib.auth import get_user_model, logout
 from django.core.exceptions import ImproperlyConfigured
-from django.db import IntegrityError
+from django.db import IntegrityError, router, transaction
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.views.decorators.http import condition, require_safe
 from rest_framework.authtoken.models import Token
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.exceptions import APIException
+from rest_framework.permissions import SAFE_METHODS, AllowAny, IsAdminUser, IsAuthenticated
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.response import Response
+from django_filters.rest_framework import DjangoFilterBackend
 
-from . import serializers
-from .models import Address
-from .utils import get_and_authenticate_user
+from . import exports, imports, jobs, metrics, routers, serializers, sharding, sync
+from .authentication import issue_token, token_cache
+from .autocomplete import AUTOCOMPLETE_FIELDS, autocomplete_index
+from .caching import VersionedCacheMixin, get_version
+from .fingerprint import find_near_duplicates
+from .geo import geo_index
+from .models import Address, Job
+from .pagination import AddressCursorPagination, AddressPageNumberPagination
+from .search import AddressSearchFilter
+from .signals import addresses_changed
+from .stats import STATS_KINDS, get_counts
+from .utils import (
+    address_row, bulk_insert_addresses, bulk_update_addresses, delete_addresses, get_and_authenticate_user, iter_batches
+)
 
 User = get_user_model()
 
 
+class AddressBookUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Address book is being moved, try again shortly.'
+    default_code = 'address_book_moving'
+
+
 class AuthViewSet(viewsets.GenericViewSet):
     permission_classes = [AllowAny, ]
     serializer_class = serializers.EmptySerializer
+    filter_backends = []
     serializer_classes = {
         'login': serializers.UserLoginSerializer,
     }
@@ -27,20 +54,22 @@ class AuthViewSet(viewsets.GenericViewSet):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         user = get_and_authenticate_user(**serializer.validated_data)
-        # if token already exist then remove before re-creating
-        is_tokened = Token.objects.filter(user=user).first()
-        if is_tokened:
-            user.auth_token.delete()
-        data = serializers.AuthUserSerializer(user).data
+        token = issue_token(user)
+        data = serializers.AuthUserSerializer(user, context={'token': token}).data
         return Response(data=data, status=status.HTTP_200_OK)
 
     @action(methods=['POST', ], detail=False, permission_classes=(IsAuthenticated, ))
     def logout(self, request):
         logout(request)
         Token.objects.filter(key=request.auth.key).delete()
+        token_cache.invalidate(request.auth.key)
         data = {'success': 'Sucessfully logged out'}
         return Response(data=data, status=status.HTTP_200_OK)
 
+    @action(methods=['GET', ], detail=False, permission_classes=(IsAdminUser, ))
+    def cache_stats(self, request):
+        return Response(data=token_cache.stats(), status=status.HTTP_200_OK)
+
     def get_serializer_class(self):
 
         if not isinstance(self.serializer_classes, dict):
@@ -51,16 +80,87 @@ class AuthViewSet(viewsets.GenericViewSet):
         return super().get_serializer_class()
 
 
-class AddressViewSet(viewsets.ModelViewSet):
+class AddressViewSet(VersionedCacheMixin, viewsets.ModelViewSet):
     queryset = Address.objects.all()
     serializer_class = serializers.AddressSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = AddressPageNumberPagination
+    filter_backends = [DjangoFilterBackend, AddressSearchFilter]
     filter_fields = ["street", "city", "postcode", "country"]
 
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        # reads skip ATOMIC_REQUESTS on every shard, initial() opens the transaction for writes
+        view = super().as_view(actions, **initkwargs)
+        for alias in settings.ADDRESS_BOOK_SHARDS:
+            view = transaction.non_atomic_requests(using=alias)(view)
+        return view
+
+    def dispatch(self, request, *args, **kwargs):
+        # initial() adds the user's shard, and the write transaction on it, once the user is known
+        with ExitStack() as self.request_context:
+            if request.method in SAFE_METHODS:
+                self.request_context.enter_context(routers.replica_reads())
+            response = super().dispatch(request, *args, **kwargs)
+
+        if request.method not in SAFE_METHODS and response.status_code < 400 and self.request.user.is_authenticated:
+            # the pin lives in the shared cache, only worth a round trip when there are replicas
+            if routers.replicas_of(sharding.shard_for_user(self.request.user.pk)):
+                routers.pin_to_primary(self.request.user.pk)
+        return response
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS:
+            alias = self.request_context.enter_context(sharding.for_user(request.user.pk))
+            if routers.replicas_of(alias) and routers.is_pinned(request.user.pk):
+                routers.use_primary()
+            return
+
+        try:
+            if self.action in ('import_file', 'delete_multiple'):
+                # imports and bulk deletes commit chunk by chunk instead of holding one transaction for the whole request
+                self.request_context.enter_context(sharding.for_user(request.user.pk, write=True))
+            else:
+                self.request_context.enter_context(sharding.write_transaction(request.user.pk))
+        except sharding.AddressBookMoving:
+            raise AddressBookUnavailable()
+
     def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):
+            # schema generation, there is no user
+            return self.queryset.none()
         query_set = self.queryset.filter(user=self.request.user)
         return query_set
 
+    def is_fast_read(self):
+        if getattr(self, 'swagger_fake_view', False):
+            return False
+        return self.action in ('list', 'retrieve') and self.request.method == 'GET'
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        if self.is_fast_read():
+            # plain dicts of the serialized columns, no model instances
+            queryset = queryset.values(*serializers.ADDRESS_FIELDS)
+        return queryset
+
+    def get_serializer_class(self):
+        if self.is_fast_read():
+            return serializers.AddressReadSerializer
+        return super().get_serializer_class()
+
+    @property
+    def paginator(self):
+        # clients opt into keyset pagination, page numbers stay the default
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            if 'cursor' in params or params.get('pagination') == 'cursor':
+                self._paginator = AddressCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
     def create(self, request, *args, **kwargs):
         try:
             return super().create(request, *args, **kwargs)
@@ -68,8 +168,289 @@ class AddressViewSet(viewsets.ModelViewSet):
             content = {'error': 'User already have this address'}
             return Response(content, status=status.HTTP_400_BAD_REQUEST)
 
+    def update(self, request, *args, **kwargs):
+        try:
+            return super().update(request, *args, **kwargs)
+        except IntegrityError as exc:
+            content = {'error': 'User already have this address'}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        address = serializer.save(user=self.request.user)
+        addresses_changed.send(sender=Address, created=[address_row(address)])
+
+    def perform_update(self, serializer):
+        old = address_row(serializer.instance)
+        address = serializer.save()
+        addresses_changed.send(sender=Address, updated=[(old, address_row(address))])
+
+    def perform_destroy(self, instance):
+        row = address_row(instance)
+        instance.delete()
+        addresses_changed.send(sender=Address, deleted=[row])
+
+    @action(detail=False, methods=['POST'], name='Bulk create')
+    def bulk(self, request, *args, **kwargs):
+        """
+        [{"street": "...", "city": "...", "postcode": "...", "country": "..."}, ...]
+
+        """
+
+        if not isinstance(request.data, list):
+            content = {'error': 'Expected a list of addresses'}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+        if len(request.data) > settings.ADDRESS_BOOK_BULK_MAX_ITEMS:
+            content = {'error': 'Too many addresses, the limit is %s' % settings.ADDRESS_BOOK_BULK_MAX_ITEMS}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+
+        results = []
+        valid = []
+        for index, item in enumerate(request.data):
+            serializer = self.get_serializer(data=item)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+                results.append(None)
+            else:
+                results.append({'index': index, 'status': 'invalid', 'errors': serializer.errors})
+
+        for index, address in bulk_insert_addresses(request.user, valid):
+            if address is None:
+                results[index] = {'index': index, 'status': 'duplicate', 'error': 'User already have this address'}
+            else:
+                results[index] = {'index': index, 'status': 'created', 'id': address.pk}
+
+        summary = {'created': 0, 'duplicate': 0, 'invalid': 0}
+        for result in results:
+            summary[result['status']] += 1
+        summary['results'] = results
+        response_status = status.HTTP_201_CREATED if summary['created'] else status.HTTP_200_OK
+        return Response(summary, status=response_status)
+
+    @bulk.mapping.patch
+    def bulk_update(self, request, *args, **kwargs):
+        """
+        [{"id": 1, "postcode": "..."}, {"id": 2, "city": "..."}, ...]
+
+        """
+
+        if not isinstance(request.data, list):
+            content = {'error': 'Expected a list of address changes'}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+        if len(request.data) > settings.ADDRESS_BOOK_BULK_MAX_ITEMS:
+            content = {'error': 'Too many addresses, the limit is %s' % settings.ADDRESS_BOOK_BULK_MAX_ITEMS}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+
+        def get_id(item):
+            pk = item.get('id') if isinstance(item, dict) else None
+            return pk if isinstance(pk, int) and not isinstance(pk, bool) else None
+
+        # only the user's own addresses can be changed
+        addresses = self.get_queryset().in_bulk([get_id(item) for item in request.data if get_id(item) is not None])
+
+        results = []
+        changes = []
+        seen = set()
+        for index, item in enumerate(request.data):
+            pk = get_id(item)
+            if pk is None:
+                results.append({'index': index, 'status': 'invalid', 'errors': {'id': ['A valid integer is required.']}})
+                continue
+            if pk not in addresses:
+                results.append({'index': index, 'status': 'not_found', 'id': pk})
+                continue
+            if pk in seen:
+                results.append({'index': index, 'status': 'invalid', 'errors': {'id': ['Address is changed more than once.']}})
+                continue
+            seen.add(pk)
+            data = {key: value for key, value in item.items() if key != 'id'}
+            serializer = self.get_serializer(addresses[pk], data=data, partial=True)
+            if serializer.is_valid():
+                changes.append((index, addresses[pk], serializer.validated_data))
+                results.append(None)
+            else:
+                results.append({'index': index, 'status': 'invalid', 'errors': serializer.errors})
+
+        with transaction.atomic(using=router.db_for_write(Address)):
+            for index, address in bulk_update_addresses(request.user, changes):
+                if address is None:
+                    results[index] = {'index': index, 'status': 'duplicate', 'error': 'User already have this address'}
+                else:
+                    results[index] = {'index': index, 'status': 'updated', 'id': address.pk}
+
+        summary = {'updated': 0, 'duplicate': 0, 'invalid': 0, 'not_found': 0}
+        for result in results:
+            summary[result['status']] += 1
+        summary['results'] = results
+        return Response(summary, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['GET'], name='Changes')
+    def changes(self, request, *args, **kwargs):
+        """
+        ?since=<cursor>&limit=1000
+
+        """
+
+        try:
+            since = sync.parse_cursor(self.request.query_params['since']) if 'since' in self.request.query_params else sync.START
+            limit = min(int(self.request.query_params.get('limit', settings.ADDRESS_BOOK_SYNC_PAGE_SIZE)), settings.ADDRESS_BOOK_SYNC_PAGE_SIZE)
+        except ValueError:
+            return Response({'error': 'since must be a cursor and limit a number'}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1:
+            return Response({'error': 'limit must be positive'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            data = sync.get_changes(request.user, since, limit, serializers.ADDRESS_FIELDS)
+        except sync.ResyncRequired:
+            content = {'error': 'Changes since this cursor are no longer kept, sync again without since', 'resync': True}
+            return Response(content, status=status.HTTP_410_GONE)
+        return Response(data, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['GET'], name='Near duplicates')
+    def duplicates(self, request, *args, **kwargs):
+        """
+        ?threshold=0.85
+
+        """
+
+        try:
+            threshold = float(self.request.query_params.get('threshold', settings.ADDRESS_BOOK_DUPLICATE_THRESHOLD))
+        except ValueError:
+            return Response({'error': 'threshold must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+
+        query_set = self.get_queryset()
+        fields = ('street', 'city', 'postcode', 'country')
+        rows = (row for batch in iter_batches(query_set, ('id', *fields), settings.ADDRESS_BOOK_EXPORT_BATCH_SIZE) for row in batch)
+        groups = find_near_duplicates(rows, threshold)
+        addresses = query_set.in_bulk([pk for group in groups for pk in group])
+        data = [self.get_serializer([addresses[pk] for pk in group], many=True).data for group in groups]
+        return Response({'groups': data}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['GET'], name='Autocomplete')
+    def autocomplete(self, request, *args, **kwargs):
+        """
+        ?field=city|country|postcode&prefix=lon&limit=10
+
+        """
+
+        field = self.request.query_params.get('field', 'city')
+        if field not in AUTOCOMPLETE_FIELDS:
+            content = {'error': 'Unsupported field, use one of: %s' % ', '.join(AUTOCOMPLETE_FIELDS)}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(int(self.request.query_params.get('limit', 10)), settings.ADDRESS_BOOK_AUTOCOMPLETE_MAX_LIMIT)
+        except ValueError:
+            return Response({'error': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+
+        prefix = self.request.query_params.get('prefix', '').strip()
+        results = autocomplete_index.complete(request.user.pk, field, prefix, limit) if prefix else []
+        return Response({'field': field, 'results': results}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['GET'], name='Near')
+    def near(self, request, *args, **kwargs):
+        """
+        ?lat=51.5&lon=-0.12&radius=5 for addresses within 5 km, nearest first, or ?lat=51.5&lon=-0.12&k=10 for the 10 nearest
+
+        """
+
+        params = self.request.query_params
+        try:
+            lat, lon = float(params['lat']), float(params['lon'])
+        except (KeyError, ValueError):
+            return Response({'error': 'lat and lon must be numbers'}, status=status.HTTP_400_BAD_REQUEST)
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            return Response({'error': 'lat or lon out of range'}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(int(params.get('k', 10)), settings.ADDRESS_BOOK_GEO_MAX_RESULTS)
+            radius = float(params['radius']) if 'radius' in params else None
+        except ValueError:
+            return Response({'error': 'k and radius must be numbers'}, status=status.HTTP_400_BAD_REQUEST)
+
+        index = geo_index.get(request.user.pk)
+        if radius is not None:
+            matches = index.within(lat, lon, radius, limit)
+        else:
+            matches = index.nearest(lat, lon, limit)
+        addresses = self.get_queryset().in_bulk([pk for _, pk in matches])
+        matches = [(distance, addresses[pk]) for distance, pk in matches if pk in addresses]
+        data = self.get_serializer([address for _, address in matches], many=True).data
+        results = [{**item, 'distance': round(distance, 3)} for (distance, _), item in zip(matches, data)]
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['GET'], name='Stats')
+    def stats(self, request, *args, **kwargs):
+        """
+        ?by=country|city&country=Poland&limit=50&scope=user|global
+
+        """
+
+        kind = self.request.query_params.get('by', 'country')
+        if kind not in STATS_KINDS:
+            content = {'error': 'Unsupported by, use one of: %s' % ', '.join(STATS_KINDS)}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+        scope = self.request.query_params.get('scope', 'user')
+        if scope not in ('user', 'global'):
+            return Response({'error': 'Unsupported scope, use one of: user, global'}, status=status.HTTP_400_BAD_REQUEST)
+        if scope == 'global' and not request.user.is_staff:
+            return Response({'error': 'Only staff can read global stats'}, status=status.HTTP_403_FORBIDDEN)
+        try:
+            limit = min(int(self.request.query_params.get('limit', 50)), settings.ADDRESS_BOOK_STATS_MAX_LIMIT)
+        except ValueError:
+            return Response({'error': 'limit must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+
+        user_id = request.user.pk if scope == 'user' else None
+        results = get_counts(kind, user_id, self.request.query_params.get('country'), limit)
+        return Response({'by': kind, 'scope': scope, 'results': results}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['POST'], name='Import', url_path='import')
+    def import_file(self, request, *args, **kwargs):
+        """
+        multipart upload of a CSV or NDJSON "file", ?input=csv|ndjson overrides the file extension,
+        rows are committed in batches so a failed import can be rerun, stored rows count as duplicates
+
+        """
+
+        upload = request.FILES.get('file')
+        if upload is None:
+            content = {'error': 'Upload the addresses as "file"'}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+
+        input_format = self.request.query_params.get('input') or upload.name.rsplit('.', 1)[-1].lower()
+        if input_format not in imports.IMPORT_FORMATS:
+            content = {'error': 'Unsupported input, use one of: %s' % ', '.join(imports.IMPORT_FORMATS)}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            stats = imports.import_addresses(request.user, upload.file, input_format)
+        except sharding.AddressBookMoving:
+            # the batches stored so far stay, a retry skips them as duplicates
+            raise AddressBookUnavailable()
+        return Response(stats, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=['GET', 'POST'], name='Export')
+    def export(self, request, *args, **kwargs):
+        """
+        ?output=ndjson|csv, a POST writes the export in a job to fetch from api/jobs/<id>/download
+
+        """
+
+        output = self.request.query_params.get('output', 'ndjson')
+        if output not in exports.CONTENT_TYPES:
+            content = {'error': 'Unsupported output, use one of: %s' % ', '.join(exports.CONTENT_TYPES)}
+            return Response(content, status=status.HTTP_400_BAD_REQUEST)
+
+        if request.method == 'POST':
+            params = self.request.query_params
+            filters = {field: params[field] for field in self.filter_fields if field in params}
+            job = jobs.submit(request.user, 'export_addresses', output=output, filters=filters, q=params.get('q'))
+            content = {'job': job.pk, 'status': job.status}
+            return Response(content, status=status.HTTP_202_ACCEPTED)
+
+        # the body is streamed after dispatch() returns, so pin the database chosen now
+        query_set = self.filter_queryset(self.get_queryset())
+        query_set = query_set.using(query_set.db)
+        response = StreamingHttpResponse(exports.export_addresses(query_set, output), content_type=exports.CONTENT_TYPES[output])
+        response['Content-Disposition'] = 'attachment; filename="addresses.%s"' % output
+        return response
 
     @action(detail=False, methods=['DELETE'], name='Delete multiple')
     def delete_multiple(self, request, *args, **kwargs):
@@ -86,7 +467,70 @@ class AddressViewSet(viewsets.ModelViewSet):
         else:
             query_set = self.queryset.filter(user=self.request.user)
 
-        for entry in query_set:
-            entry.delete()
+        # large deletes are handed off to a background job so the request stays short
+        threshold = settings.ADDRESS_BOOK_PURGE_ASYNC_THRESHOLD
+        if (not ids or len(ids) > threshold) and query_set.values('pk')[threshold:threshold + 1].exists():
+            # the job only deletes what the address book holds now, not rows written after this request
+            job = jobs.submit(request.user, 'purge_addresses', ids=ids, version=get_version(request.user.pk))
+            content = {'job': job.pk, 'status': job.status}
+            return Response(content, status=status.HTTP_202_ACCEPTED)
+
+        delete_addresses(query_set, request.user.pk)
 
         return Response({'success': 'deleted entries: %s' % ids}, status=status.HTTP_204_NO_CONTENT)
+
+
+class JobViewSet(viewsets.ReadOnlyModelViewSet):
+    queryset = Job.objects.all()
+    serializer_class = serializers.JobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        if getattr(self, 'swagger_fake_view', False):
+            return self.queryset.none()
+        return self.queryset.filter(user=self.request.user).order_by('-pk')
+
+    @action(detail=True, methods=['GET'], name='Download')
+    def download(self, request, *args, **kwargs):
+        job = self.get_object()
+        if job.status != Job.DONE or not (job.result or {}).get('file'):
+            return Response({'error': 'Job has no file to download'}, status=status.HTTP_404_NOT_FOUND)
+        path = os.path.join(settings.ADDRESS_BOOK_EXPORT_DIR, job.result['file'])
+        if not os.path.exists(path):
+            return Response({'error': 'Job file has expired'}, status=status.HTTP_410_GONE)
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename='addresses.%s' % path.rsplit('.', 1)[-1], content_type=job.result['content_type'])
+
+
+def metrics_view(request):
+    if request.META.get('REMOTE_ADDR') not in settings.ADDRESS_BOOK_METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4')
+
+
+_schema_cache = {}
+
+
+def _schema_file():
+    # re-read only when build_openapi_schema replaced the file
+    path = settings.ADDRESS_BOOK_SCHEMA_FILE
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _schema_cache.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as stream:
+            content = stream.read()
+        cached = _schema_cache[path] = (mtime, content, hashlib.sha1(content).hexdigest())
+    return cached
+
+
+@require_safe
+@condition(etag_func=lambda request: (_schema_file() or (None, None, None))[2])
+def openapi_schema_view(request):
+    schema = _schema_file()
+    if schema is None:
+        raise Http404('No schema, run build_openapi_schema')
+    response = HttpResponse(schema[1], content_type='application/json')
+    response['Cache-Control'] = 'public, max-age=%s' % settings.ADDRESS_BOOK_DOCS_CACHE_SECONDS
+    return response
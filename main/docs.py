@@ -0,0 +1,30 @@
+"""
+API documentation, only routed when drf_yasg is installed (see main/urls.py).
+"""
+from django.conf import settings
+from django.urls import re_path
+from drf_yasg.views import get_schema_view
+from drf_yasg import openapi
+from rest_framework.permissions import AllowAny
+
+
+api_info = openapi.Info(
+    title="AddressBook API",
+    default_version='v1',
+    description="Basic API description"
+)
+
+# Swagger documentation setup
+schema_view = get_schema_view(
+    api_info,
+    public=True,
+    permission_classes=[AllowAny],
+)
+
+cache_timeout = settings.ADDRESS_BOOK_DOCS_CACHE_SECONDS
+
+urlpatterns = [
+    re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=cache_timeout), name='schema-json'),
+    re_path(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=cache_timeout), name='schema-swagger-ui'),
+    re_path(r'^redoc/$', schema_view.with_ui('redoc', cache_timeout=cache_timeout), name='schema-redoc'),
+]
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -47,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'address_book.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,18 +83,82 @@ WSGI_APPLICATION = 'main.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
+# ADDRESS_BOOK_DB=sqlite runs on a local SQLite file instead of the docker-compose
+# Postgres. ADDRESS_BOOK_DB_REPLICAS lists read replica hosts for Postgres, or a
+# number of replica aliases for SQLite that all point at the same local file.
+# ADDRESS_BOOK_DB_SHARDS adds address shards the same way, as Postgres hosts or
+# as a number of extra SQLite files. The test suite gets one extra shard when
+# none are configured, so every run covers the shard routing.
+DATABASE_BACKEND = os.environ.get('ADDRESS_BOOK_DB', 'postgresql')
+DATABASE_REPLICAS = os.environ.get('ADDRESS_BOOK_DB_REPLICAS', '')
+DATABASE_SHARDS = os.environ.get('ADDRESS_BOOK_DB_SHARDS', '')
+TESTING = sys.argv[1:2] == ['test']
+CONN_MAX_AGE = int(os.environ.get('ADDRESS_BOOK_CONN_MAX_AGE', 60))
+
+if DATABASE_BACKEND == 'sqlite':
+    PRIMARY_DATABASE = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.sqlite3',
+    }
+    REPLICA_DATABASES = [PRIMARY_DATABASE] * int(DATABASE_REPLICAS or 0)
+    SHARD_DATABASES = [
+        dict(PRIMARY_DATABASE, NAME=BASE_DIR / ('db.shard%s.sqlite3' % index))
+        for index in range(1, int(DATABASE_SHARDS or TESTING) + 1)
+    ]
+else:
+    PRIMARY_DATABASE = {
         'ENGINE': 'django.db.backends.postgresql',
         'NAME': 'postgres',
         'USER': 'postgres',
         'PASSWORD': 'postgres',
-        'HOST': 'db',
+        'HOST': os.environ.get('ADDRESS_BOOK_DB_HOST', 'db'),
         'PORT': 5432,
+    }
+    REPLICA_DATABASES = [dict(PRIMARY_DATABASE, HOST=host) for host in DATABASE_REPLICAS.split(',') if host]
+    SHARD_DATABASES = [dict(PRIMARY_DATABASE, HOST=host) for host in DATABASE_SHARDS.split(',') if host]
+    if TESTING and not DATABASE_SHARDS:
+        # a second test database on the primary server
+        SHARD_DATABASES = [dict(PRIMARY_DATABASE, TEST={'NAME': 'test_postgres_shard1'})]
+
+DATABASES = {
+    'default': {
+        **PRIMARY_DATABASE,
+        "ATOMIC_REQUESTS": True,
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+    }
+}
+for index, replica in enumerate(REPLICA_DATABASES, 1):
+    DATABASES['replica%s' % index] = {
+        **replica,
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'TEST': {'MIRROR': 'default'},
+    }
+for index, shard in enumerate(SHARD_DATABASES, 1):
+    DATABASES['shard%s' % index] = {
+        **shard,
         "ATOMIC_REQUESTS": True,
+        'CONN_MAX_AGE': CONN_MAX_AGE,
     }
+
+DATABASE_ROUTERS = ['address_book.routers.AddressBookRouter']
+
+# "shared" holds state worker processes should agree on, like replica pins. It is
+# per process until ADDRESS_BOOK_SHARED_CACHE_BACKEND/LOCATION point it at
+# memcached, as docker-compose does.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'shared': {
+        'BACKEND': os.environ.get('ADDRESS_BOOK_SHARED_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('ADDRESS_BOOK_SHARED_CACHE_LOCATION', 'address_book_shared'),
+    },
 }
 
+# Password checks of logins and basic auth run on ADDRESS_BOOK_PASSWORD_HASH_WORKERS
+
+AUTHENTICATION_BACKENDS = ['address_book.authentication.PooledModelBackend']
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -117,10 +184,133 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10,
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.BasicAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'address_book.authentication.CachedTokenAuthentication',
     ]
 }
 
+SWAGGER_SETTINGS = {
+    'DEFAULT_INFO': 'main.docs.api_info',
+}
+
+# Address book tuning
+
+# Rows per INSERT statement used by bulk address endpoints
+ADDRESS_BOOK_BULK_BATCH_SIZE = 500
+# Maximum number of addresses accepted by a single bulk request
+ADDRESS_BOOK_BULK_MAX_ITEMS = 10000
+# Rows removed per DELETE statement by set-based deletes
+ADDRESS_BOOK_DELETE_BATCH_SIZE = 1000
+# Rows parsed, inserted and committed per batch when importing files
+ADDRESS_BOOK_IMPORT_BATCH_SIZE = 2000
+# Rows fetched per query while streaming an export
+ADDRESS_BOOK_EXPORT_BATCH_SIZE = 2000
+# Upper bound for the client chosen ?page_size= of address listings
+ADDRESS_BOOK_MAX_PAGE_SIZE = 1000
+# The admin counts filtered address lists up to this many rows and pages no further,
+# unfiltered ones use the table statistics
+ADDRESS_BOOK_ADMIN_COUNT_LIMIT = 10000
+# delete_multiple hands off to a background purge job above this many rows
+ADDRESS_BOOK_PURGE_ASYNC_THRESHOLD = 10000
+
+# Most changes returned by one api/addresses/changes call
+ADDRESS_BOOK_SYNC_PAGE_SIZE = 1000
+# Seconds tombstones of deleted addresses are kept for syncing clients, prune_tombstones
+# removes older ones and clients with an older cursor are told to sync from scratch
+ADDRESS_BOOK_TOMBSTONE_RETENTION = 30 * 24 * 3600
+
+# Most rows returned by one api/addresses/stats call
+ADDRESS_BOOK_STATS_MAX_LIMIT = 500
+
+# Postcode,latitude,longitude CSV used to geocode new and changed addresses,
+# geocode_addresses fills in the existing ones
+ADDRESS_BOOK_POSTCODE_DATASET = os.environ.get('ADDRESS_BOOK_POSTCODE_DATASET')
+# Proximity queries use per user grids of CELL_DEGREES cells, an LRU keeps
+# CACHE_SIZE of them for TTL seconds
+ADDRESS_BOOK_GEO_CELL_DEGREES = 0.1
+ADDRESS_BOOK_GEO_INDEX_CACHE_SIZE = 100
+ADDRESS_BOOK_GEO_INDEX_TTL = 600
+ADDRESS_BOOK_GEO_MAX_RESULTS = 1000
+
+# Street similarity (0-1) above which two addresses are reported as near-duplicates
+ADDRESS_BOOK_DUPLICATE_THRESHOLD = 0.85
+
+# Autocomplete keeps the suggestions of CACHE_SIZE users in memory for TTL seconds,
+# at most MAX_VALUES distinct values per field and user
+ADDRESS_BOOK_AUTOCOMPLETE_CACHE_SIZE = 1000
+ADDRESS_BOOK_AUTOCOMPLETE_TTL = 600
+ADDRESS_BOOK_AUTOCOMPLETE_MAX_VALUES = 10000
+ADDRESS_BOOK_AUTOCOMPLETE_MAX_LIMIT = 50
+
+# Authenticated tokens are remembered for TTL seconds in a per-process LRU of SIZE
+# entries, so other workers accept a revoked token for up to TTL seconds. ALIAS
+# names a memcached entry of CACHES to share them instead, revoking them everywhere at once.
+ADDRESS_BOOK_TOKEN_CACHE_SIZE = 10000
+ADDRESS_BOOK_TOKEN_CACHE_TTL = 10
+ADDRESS_BOOK_TOKEN_CACHE_ALIAS = os.environ.get('ADDRESS_BOOK_TOKEN_CACHE_ALIAS') or None
+# Tokens expire TTL seconds after their last use (None keeps them forever), the
+# expiry moves forward at most once per REFRESH_SECONDS. With REUSE a login keeps
+# the user's valid token instead of replacing it. sweep_expired_tokens deletes expired ones.
+ADDRESS_BOOK_TOKEN_TTL = 14 * 24 * 3600
+ADDRESS_BOOK_TOKEN_REFRESH_SECONDS = 3600
+ADDRESS_BOOK_TOKEN_REUSE = True
+# Password checks run on this many threads with up to QUEUE more waiting,
+# further logins get a 503. 0 checks passwords on the request thread.
+ADDRESS_BOOK_PASSWORD_HASH_WORKERS = 4
+ADDRESS_BOOK_PASSWORD_HASH_QUEUE = 64
+
+# List and detail responses are cached per user and address book version in an
+# LRU holding about BYTES of their JSON, entries also expire after TTL seconds
+ADDRESS_BOOK_RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+ADDRESS_BOOK_RESPONSE_CACHE_TTL = 300
+
+# Requests slower than this are logged to "address_book.slow" with their MAX_SQL slowest statements
+ADDRESS_BOOK_SLOW_REQUEST_SECONDS = 1.0
+ADDRESS_BOOK_SLOW_REQUEST_MAX_SQL = 50
+# Clients allowed to scrape the Prometheus metrics at /metrics
+ADDRESS_BOOK_METRICS_ALLOWED_IPS = ['127.0.0.1']
+
+# Replica aliases serving address reads, per primary alias
+ADDRESS_BOOK_DATABASE_REPLICAS = {'default': [alias for alias in DATABASES if alias.startswith('replica')]}
+# After a write the user's reads stay on the primary for this long, the pin is
+# kept in the CACHES entry PIN_CACHE_ALIAS so every worker process honours it
+ADDRESS_BOOK_REPLICA_PIN_SECONDS = 5
+ADDRESS_BOOK_REPLICA_PIN_CACHE_ALIAS = 'shared'
+# Ping persistent connections at the start of a request, at most once per
+# INTERVAL seconds for each connection
+ADDRESS_BOOK_CONN_HEALTH_CHECKS = True
+ADDRESS_BOOK_CONN_HEALTH_CHECK_INTERVAL = 10
+
+# Aliases holding address books, users are spread over them with a consistent
+# hash of RING_POINTS spots per shard. Only append: an alias' position picks the
+# id range of its addresses.
+ADDRESS_BOOK_SHARDS = ['default', *(alias for alias in DATABASES if alias.startswith('shard'))]
+ADDRESS_BOOK_SHARD_RING_POINTS = 64
+# Processes remember where a user's address book lives for TTL seconds
+ADDRESS_BOOK_SHARD_CACHE_SIZE = 100000
+ADDRESS_BOOK_SHARD_CACHE_TTL = 60
+
+# Background jobs run in a thread pool of this size with the "threads" backend,
+# with "worker" they wait in the database for the run_job_worker command
+ADDRESS_BOOK_JOBS_BACKEND = os.environ.get('ADDRESS_BOOK_JOBS_BACKEND', 'threads')
+ADDRESS_BOOK_JOBS_THREADS = 2
+# Running jobs without a progress report for this long are given to another worker
+ADDRESS_BOOK_JOBS_STALE_SECONDS = 600
+# Files written by export jobs
+ADDRESS_BOOK_EXPORT_DIR = BASE_DIR / 'exports'
+# Run jobs inline when submitted, handy for tests and debugging
+ADDRESS_BOOK_JOBS_EAGER = False
+
+# Prebuilt OpenAPI schema served at /openapi.json, written by build_openapi_schema
+ADDRESS_BOOK_SCHEMA_FILE = BASE_DIR / 'openapi.json'
+# The live swagger views regenerate the schema at most this often
+ADDRESS_BOOK_DOCS_CACHE_SECONDS = 3600
+
+# Serve address list, retrieve, export and changes as async views, main/asgi.py
+# turns it on. Their ORM calls run on ASYNC_DB_THREADS threads per process,
+# which also bounds the process' database connections.
+ADDRESS_BOOK_ASYNC_VIEWS = os.environ.get('ADDRESS_BOOK_ASYNC_VIEWS', '') == '1'
+ADDRESS_BOOK_ASYNC_DB_THREADS = int(os.environ.get('ADDRESS_BOOK_ASYNC_DB_THREADS', 32))
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.2/topics/i18n/
 
@@ -13,28 +13,16 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path, include, re_path
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
-from rest_framework.permissions import AllowAny
+from django.urls import path, include
 
 
-# Swagger documentation setup
-schema_view = get_schema_view(
-    openapi.Info(
-        title="AddressBook API",
-        default_version='v1',
-        description="Basic API description"
-    ),
-    public=True,
-    permission_classes=[AllowAny],
-)
-
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('', include('address_book.urls')),
-    re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
-    re_path(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
-    re_path(r'^redoc/$', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    path('', include('address_book.async_urls' if settings.ADDRESS_BOOK_ASYNC_VIEWS else 'address_book.urls')),
 ]
+
+# the production profile leaves the docs out, /openapi.json serves the prebuilt schema
+if 'drf_yasg' in settings.INSTALLED_APPS:
+    urlpatterns.append(path('', include('main.docs')))